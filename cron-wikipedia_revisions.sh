@@ -9,13 +9,15 @@ date_string=$(date +%Y%m%d)
 revs_log="enwp-revisions-${date_string}.log"
 ./wikipedia/scripts/wikiproject_scraper.py 2> >(tee wikipedia/logs/${revs_log})
 
-./wikipedia/scripts/fetch_enwiki_revisions.py 2> >(tee -a wikipedia/logs/${revs_log})
+# the published files are complete histories. --incremental would write
+# only the new revisions, to revisions_delta files instead
+./wikipedia/scripts/fetch_enwiki_revisions.py --compression xz 2> >(tee -a wikipedia/logs/${revs_log})
 mv wikipedia/logs/${revs_log} /var/www/covid19/wikipedia/logs/
 
 revs_tsv="digobs_covid19-wikipedia-enwiki_revisions-${date_string}.tsv"
 mv wikipedia/data/${revs_tsv} /var/www/covid19/wikipedia
 
+# the json is compressed as it is written
 revs_json="digobs_covid19-wikipedia-enwiki_revisions-${date_string}.json"
-xz wikipedia/data/${revs_json}
 mv wikipedia/data/${revs_json}.xz /var/www/covid19/wikipedia
 
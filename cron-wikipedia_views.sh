@@ -14,6 +14,9 @@ view_log="daily_views-${date_string}.log"
 
 # get the list of files
 ./wikipedia/scripts/fetch_enwiki_daily_views.py -d "${date_string}" 2> >(tee -a wikipedia/logs/${view_log})
+
+# add the day to the consolidated store before the tsv is moved
+./wikipedia/scripts/pageview_store.py ingest wikipedia/data/digobs_covid19-wikipedia-enwiki_dailyviews-${date_string}.tsv 2> >(tee -a wikipedia/logs/${view_log})
 mv wikipedia/logs/${view_log} /var/www/covid19/wikipedia/logs/${view_log}
 
 cd wikipedia/data
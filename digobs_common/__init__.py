@@ -0,0 +1,5 @@
+# Code shared by the Wikipedia scripts in wikipedia/scripts and the keyword
+# scripts in keywords/src: the on-disk HTTP response cache (http_cache)
+# and rate limiting with retries (rate_limit). Both folders have a
+# digobs_common symlink to here, so the scripts import it straight from
+# the repository, however they are started.
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# An on-disk cache of HTTP responses, used by the Wikipedia fetchers
+# (through digobs), wikiproject_scraper.py and the keyword scripts in
+# keywords/src, so reruns and backfills don't ask the APIs the same
+# questions again. Each of them keeps its cache in its own folder, set
+# with configure().
+#
+# Responses are kept for a TTL that depends on the endpoint (see
+# default_ttls). Once an entry is stale it is revalidated with
+# If-None-Match/If-Modified-Since if the server gave us an ETag or
+# Last-Modified, so an unchanged response costs a 304 instead of the whole
+# body. Bodies are stored compressed, in files named after their sha256,
+# and an sqlite index maps each request to its body. When the cache grows
+# past its size cap the least recently used entries are dropped.
+#
+###############################################################################
+
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zlib
+import requests
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from functools import partial
+from os import path, makedirs, remove, replace, getpid
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+default_max_size = 2 * 1024 ** 3
+
+hour = 60 * 60
+day = 24 * hour
+
+# Pageviews for a day don't change once they are published, but the last
+# day or two may not be published yet, and a range ending then would be
+# missing them. So ranges that end more than two days ago are kept for a
+# month, and the rest for an hour.
+def pageview_ttl(match):
+    end = datetime.strptime(match.group(1), "%Y%m%d").replace(tzinfo=timezone.utc)
+    if datetime.now(timezone.utc) - end > timedelta(days=2):
+        return 30 * day
+    return hour
+
+# How long responses from each endpoint stay fresh, in seconds, as
+# (regular expression, TTL) pairs matched against the full request URL.
+# The TTL can also be a function of the match. The first match wins, and
+# anything that doesn't match isn't cached.
+# Revision histories and page info aren't cached at all, since the
+# incremental fetches need to see new edits (and TitleResolver already
+# keeps where titles point).
+default_ttls = [
+    (r'/metrics/pageviews/per-article/.*/daily/\d{10}/(\d{8})\d{2}$', pageview_ttl),
+    # the WikiProject's article list, so the views and revisions crons
+    # don't both scrape it
+    (r'/w/api\.php\?(.*&)?list=categorymembers', 12 * hour),
+    # Wikidata searches and label queries from the keyword scripts
+    (r'^https?://(www\.)?wikidata\.org/w/api\.php\?(.*&)?list=search', day),
+    (r'^https?://query\.wikidata\.org/', day),
+    (r'^https?://meta\.wikimedia\.org/w/api\.php\?(.*&)?action=parse', day),
+]
+
+# the headers kept with a cached response. Content-Length and
+# Content-Encoding are dropped since we store the decoded body.
+kept_headers = ['Content-Type', 'ETag', 'Last-Modified', 'Date', 'Cache-Control']
+
+class ResponseCache:
+    def __init__(self, folder, max_size=default_max_size, ttls=default_ttls):
+        self.folder = folder
+        self.max_size = max_size
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.counts = {'hits' : 0, 'misses' : 0, 'revalidated' : 0, 'stored' : 0, 'evicted' : 0}
+        self.lock = threading.Lock()
+
+        makedirs(path.join(folder, 'bodies'), exist_ok=True)
+        # several scripts may share the cache at once
+        self.conn = sqlite3.connect(path.join(folder, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY,
+                               url TEXT NOT NULL,
+                               status INTEGER NOT NULL,
+                               headers TEXT NOT NULL,
+                               body TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               etag TEXT,
+                               last_modified TEXT,
+                               stored REAL NOT NULL,
+                               used REAL NOT NULL);""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used);")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses;").fetchone()[0]
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            match = pattern.search(url)
+            if match:
+                return ttl(match) if callable(ttl) else ttl
+        return 0
+
+    def body_path(self, digest):
+        return path.join(self.folder, 'bodies', digest[:2], digest)
+
+    def read_body(self, digest):
+        try:
+            with open(self.body_path(digest), 'rb') as infile:
+                return zlib.decompress(infile.read())
+        except (OSError, zlib.error):
+            return None
+
+    # bodies are named after their contents, so a body that many requests
+    # share is only stored once
+    def write_body(self, body):
+        digest = hashlib.sha256(body).hexdigest()
+        body_path = self.body_path(digest)
+        if not path.exists(body_path):
+            makedirs(path.dirname(body_path), exist_ok=True)
+            tmp_path = f"{body_path}.{getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as outfile:
+                outfile.write(zlib.compress(body, 6))
+            replace(tmp_path, body_path)
+        return (digest, path.getsize(body_path))
+
+    def lookup(self, key):
+        with self.lock:
+            return self.conn.execute("SELECT url, status, headers, body, etag, last_modified, stored FROM responses WHERE key = ?;",
+                                     (key,)).fetchone()
+
+    def touch(self, key, stored=None, etag=None, last_modified=None):
+        with self.lock, self.conn:
+            if stored is None:
+                self.conn.execute("UPDATE responses SET used = ? WHERE key = ?;", (time.time(), key))
+            else:
+                self.conn.execute("""UPDATE responses SET used = ?, stored = ?,
+                                       etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified)
+                                     WHERE key = ?;""",
+                                  (time.time(), stored, etag, last_modified, key))
+
+    def store(self, key, url, response):
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+        digest, size = self.write_body(response.content)
+        headers = {name : response.headers[name] for name in kept_headers if name in response.headers}
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("""INSERT OR REPLACE INTO responses (key, url, status, headers, body, size, etag, last_modified, stored, used)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                                  (key, url, response.status_code, json.dumps(headers), digest, size,
+                                   response.headers.get('ETag', None), response.headers.get('Last-Modified', None), now, now))
+            self.counts['stored'] = self.counts['stored'] + 1
+            self.size = self.size + size
+            if self.size > self.max_size:
+                self.evict()
+
+    # Drops the least recently used entries until the cache is back under
+    # 90% of its cap. The size is counted again first, since other
+    # processes may have added or dropped entries too. Call with the lock.
+    def evict(self):
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses;").fetchone()[0]
+        target = 0.9 * self.max_size
+        if self.size <= target:
+            return
+
+        dropped = []
+        for key, digest, size in self.conn.execute("SELECT key, body, size FROM responses ORDER BY used;").fetchall():
+            if self.size <= target:
+                break
+            dropped.append((key, digest))
+            self.size = self.size - size
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE key = ?;", [(key,) for key, _ in dropped])
+        for digest in set(digest for _, digest in dropped):
+            if self.conn.execute("SELECT 1 FROM responses WHERE body = ? LIMIT 1;", (digest,)).fetchone() is None:
+                try:
+                    remove(self.body_path(digest))
+                except OSError:
+                    pass
+        self.counts['evicted'] = self.counts['evicted'] + len(dropped)
+        logging.debug(f"evicted {len(dropped)} responses from the http cache")
+
+    def response(self, url, status, headers, body):
+        response = requests.Response()
+        response.status_code = status
+        response.reason = HTTPStatus(status).phrase
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = url
+        response._content = body
+        response.from_cache = True
+        return response
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts[name] + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, size=self.size)
+
+    # Makes a request through the cache. send(**kwargs) makes the request
+    # for real. Only GET requests for endpoints with a TTL are cached, and
+    # only 200 responses are kept.
+    def request(self, send, method, url, **kwargs):
+        if method.upper() != 'GET' or kwargs.get('data', None) or kwargs.get('files', None):
+            return send(**kwargs)
+
+        full_url = requests.Request(method, url, params=kwargs.get('params', None)).prepare().url
+        ttl = self.ttl(full_url)
+        if ttl <= 0:
+            return send(**kwargs)
+
+        key = hashlib.sha256(f"GET {full_url}".encode()).hexdigest()
+        entry = self.lookup(key)
+        body = None
+        if entry is not None:
+            cached_url, status, headers, digest, etag, last_modified, stored = entry
+            body = self.read_body(digest)
+
+        if body is not None:
+            if time.time() - stored < ttl:
+                self.touch(key)
+                self.count('hits')
+                return self.response(cached_url, status, json.loads(headers), body)
+
+            # ask the server whether what we have is still good
+            if etag is not None or last_modified is not None:
+                conditional = dict(kwargs.get('headers', None) or {})
+                if etag is not None:
+                    conditional['If-None-Match'] = etag
+                if last_modified is not None:
+                    conditional['If-Modified-Since'] = last_modified
+                kwargs = dict(kwargs, headers=conditional)
+
+        response = send(**kwargs)
+        if response.status_code == 304 and body is not None:
+            self.touch(key, stored=time.time(), etag=response.headers.get('ETag', None),
+                       last_modified=response.headers.get('Last-Modified', None))
+            self.count('revalidated')
+            return self.response(cached_url, status, json.loads(headers), body)
+
+        self.count('misses')
+        if response.status_code == 200:
+            self.store(key, full_url, response)
+        return response
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# A requests session that goes through a ResponseCache. Subclasses can
+# override send_uncached to change how requests that miss are made.
+class CachedSession(requests.Session):
+    def __init__(self, cache=None):
+        super().__init__()
+        self.cache = cache if cache is not None else shared_cache()
+
+    def send_uncached(self, method, url, **kwargs):
+        return super().request(method, url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        if self.cache is None:
+            return self.send_uncached(method, url, **kwargs)
+        return self.cache.request(partial(self.send_uncached, method, url), method, url, **kwargs)
+
+# The cache every session shares unless it is given its own, opened the
+# first time it's needed. There is none until configure() says where it
+# lives, and configure(None) turns it off again.
+settings = {'folder' : None, 'max_size' : default_max_size}
+shared = None
+shared_lock = threading.Lock()
+
+def configure(folder, max_size=default_max_size):
+    global shared
+    with shared_lock:
+        if shared is not None:
+            shared.close()
+            shared = None
+        settings['folder'] = folder
+        settings['max_size'] = max_size
+
+def shared_cache():
+    global shared
+    with shared_lock:
+        if shared is None and settings['folder']:
+            shared = ResponseCache(settings['folder'], settings['max_size'])
+        return shared
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Rate limiting and retries for the requests the Wikipedia scripts and the
+# keyword scripts make: a token bucket per host, a retry budget for the
+# whole run, and a requests session that sends everything through them
+# (and through http_cache).
+#
+###############################################################################
+
+import itertools
+import logging
+import random
+import threading
+import time
+import requests
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from urllib.parse import urlparse
+from digobs_common import http_cache
+
+# requests per second for hosts a RateLimiter isn't given a rate for
+default_rate_limit = 25
+
+# A token bucket that lets rate requests per second through, with bursts
+# of up to burst requests. acquire() reserves a token and sleeps until it
+# is due, so threads sharing the bucket queue up in order. After a 429 the
+# rate is halved, and each success then wins a little of it back.
+class TokenBucket:
+    def __init__(self, rate, burst=None, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    # hold every request to this host for seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logging.warning(f"Warning: slowing down to {self.rate:.2f} requests per second")
+
+    def recover(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.min_rate / 10)
+
+# Caps retries across a whole run at minimum plus ratio times the number
+# of requests, so a broken endpoint fails fast instead of being retried
+# for hours.
+class RetryBudget:
+    def __init__(self, ratio=0.2, minimum=100):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.requests = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.requests = self.requests + 1
+
+    def spend(self):
+        with self.lock:
+            if self.retries >= self.minimum + self.ratio * self.requests:
+                return False
+            self.retries = self.retries + 1
+            return True
+
+# Bytes of a response as they came over the wire (so before any gzip is
+# undone), or the length of the content if the server didn't say.
+def response_size(response):
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return len(response.content or b'')
+
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Errors that come from the request itself rather than from the network or
+# the server, so sending it again can't help.
+fatal_errors = (requests.exceptions.InvalidURL,
+                requests.exceptions.InvalidSchema,
+                requests.exceptions.MissingSchema,
+                requests.exceptions.InvalidHeader,
+                requests.exceptions.URLRequired)
+
+# A rate-limit and retry layer for requests. Each
+# host gets its own token bucket, and failures (retry_statuses, and any
+# requests error apart from fatal_errors, like a dropped connection or a
+# truncated body) are retried with exponential backoff and jitter,
+# honouring Retry-After up to max_delay, until either max_tries or the
+# retry budget runs out. Which statuses are retried can be narrowed with
+# retry_statuses. The number of requests open at
+# once can also be capped, both per host and overall, which keeps many
+# fetches running side by side from piling onto one host. If metrics is
+# given (like digobs.metrics), every attempt, retry and give-up is
+# recorded with it.
+class RateLimiter:
+    def __init__(self, rate_limits=None, default_rate=default_rate_limit, max_tries=10, base_delay=1, max_delay=120, budget=None, metrics=None, retry_statuses=retry_statuses):
+        self.rate_limits = rate_limits if rate_limits is not None else {}
+        self.metrics = metrics
+        self.default_rate = default_rate
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.budget = budget if budget is not None else RetryBudget()
+        self.buckets = {}
+        self.connections = None
+        self.host_connections = None
+        self.host_slots = {}
+        self.lock = threading.Lock()
+
+    # caps the requests open at once, overall and to any one host. None
+    # means no cap.
+    def set_connection_limits(self, max_connections=None, host_connections=None):
+        with self.lock:
+            self.connections = threading.BoundedSemaphore(max_connections) if max_connections else None
+            self.host_connections = host_connections
+            self.host_slots = {}
+
+    @contextmanager
+    def slot(self, host):
+        with self.lock:
+            connections = self.connections
+            if self.host_connections and host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.host_connections)
+            host_slot = self.host_slots.get(host, None)
+
+        with ExitStack() as stack:
+            if connections is not None:
+                stack.enter_context(connections)
+            if host_slot is not None:
+                stack.enter_context(host_slot)
+            yield
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate_limits.get(host, self.default_rate))
+            return self.buckets[host]
+
+    def record(self, name, *args):
+        if self.metrics is not None:
+            getattr(self.metrics, name)(*args)
+
+    # a server can ask for any Retry-After, but we never wait longer than
+    # max_delay
+    def backoff(self, attempt, response=None):
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def request(self, send, method, url):
+        host = urlparse(url).hostname
+        bucket = self.bucket(host)
+        self.budget.record_request()
+
+        for attempt in itertools.count():
+            bucket.acquire()
+            try:
+                with self.slot(host):
+                    start = time.monotonic()
+                    response = send()
+                error = None
+                self.record('record_request', url, time.monotonic() - start, response.status_code, response_size(response))
+            except fatal_errors:
+                raise
+            except requests.RequestException as e:
+                response = None
+                error = e
+                self.record('record_request', url, time.monotonic() - start, type(e).__name__)
+
+            if response is not None and response.status_code not in self.retry_statuses:
+                bucket.recover()
+                return response
+
+            reason = error if response is None else response.status_code
+            if attempt + 1 >= self.max_tries or not self.budget.spend():
+                logging.critical(f"Error: giving up on {method} {url} after {attempt + 1} tries ({reason})")
+                self.record('record_give_up', url)
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self.backoff(attempt, response)
+            self.record('record_retry', url)
+            if response is not None and response.status_code == 429:
+                bucket.throttle()
+                bucket.pause(delay)
+
+            logging.warning(f"Warning: {reason} from {url}, retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+def retry_after_seconds(response):
+    if response is None or 'Retry-After' not in response.headers:
+        return None
+
+    retry_after = response.headers['Retry-After']
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (parsedate_to_datetime(retry_after) - datetime.now(tz=timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# A requests session that sends everything through limiter, a
+# RateLimiter. mwapi sessions accept one of these. Requests first go
+# through the shared http_cache, so the ones it can answer cost nothing.
+class LimitedSession(http_cache.CachedSession):
+    def __init__(self, limiter, timeout=60, cache=None):
+        super().__init__(cache)
+        self.limiter = limiter
+        self.timeout = timeout
+
+    def send_uncached(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        send = partial(super().send_uncached, method, url, **kwargs)
+        return self.limiter.request(send, method, url)
@@ -1,6 +1,28 @@
 #!/bin/bash
 
-for line in $(cat missing_view_data); do 
-	OVERRIDE_DATE_STRING=${line} bash ./cron-wikipedia_views.sh
+WORKING_DIR="/data/users/bmh1867/covid19"
+cd $WORKING_DIR
+
+TZ="UTC"
+start_date=$(sort missing_view_data | head -n 1)
+end_date=$(sort missing_view_data | tail -n 1)
+
+view_log="daily_views-${start_date}-${end_date}.log"
+./wikipedia/scripts/wikiproject_scraper.py 2> >(tee wikipedia/logs/${view_log})
+
+# fetch the whole range with one request per article and one file per day
+./wikipedia/scripts/fetch_enwiki_daily_views.py --start "${start_date}" --end "${end_date}" 2> >(tee -a wikipedia/logs/${view_log})
+
+# add the days to the consolidated store before the tsvs are moved
+./wikipedia/scripts/pageview_store.py ingest $(for date_string in $(cat missing_view_data); do echo wikipedia/data/digobs_covid19-wikipedia-enwiki_dailyviews-${date_string}.tsv; done) 2> >(tee -a wikipedia/logs/${view_log})
+mv wikipedia/logs/${view_log} /var/www/covid19/wikipedia/logs/${view_log}
+
+cd wikipedia/data
+for date_string in $(cat ../../missing_view_data); do
+    find digobs_covid19-wikipedia-enwiki_dailyviews-${date_string}.tsv digobs_covid19-wikipedia-enwiki_dailyviews-${date_string}.json | while read line; do
+        mkdir -p /var/www/covid19/wikipedia/$line
+        mv $line /var/www/covid19/wikipedia/$line
+    done
 done
 
+cd ../..
@@ -20,13 +20,13 @@ python3 find_wikidataitems_listed.py --url "https://meta.wikimedia.org/wiki/User
 # #https://meta.wikimedia.org/wiki/User:Diego_(WMF)/COVID-19_Pages
 # python3 find_wikidataitems_listed.py --url https://meta.wikimedia.org/wiki/User:Diego_(WMF)/COVID-19_Pages --output ../output/intermediate/Diego_wikidata_ids.txt
 
-echo "Finding translations from Wikidata using sparql"
-python3 wikidata_translations.py  ../output/intermediate/$(date '+%Y-%m-%d')_MGerlach_wikidata_ids.txt --topN 100000 --output ../output/csv/$(date '+%Y-%m-%d')_wikidata_item_labels_MGerlach.csv
+mkdir -p ../output/csv/diffs
 
 echo "Finding translations from Wikidata using sparql"
-python3 wikidata_translations.py  ../output/intermediate/wikidata_search_results_from_gtrends.csv  ../output/intermediate/wikidata_search_results.csv --topN 10 20 --output ../output/csv/$(date '+%Y-%m-%d')_wikidata_item_labels_gtrends.csv
+python3 wikidata_translations.py  ../output/intermediate/$(date '+%Y-%m-%d')_MGerlach_wikidata_ids.txt --topN 100000 --store --output ../output/csv/diffs/$(date '+%Y-%m-%d')_wikidata_item_labels_MGerlach_diff.csv
 
-cat ../output/csv/$(date '+%Y-%m-%d')_wikidata_item_labels_MGerlach.csv ../output/csv/$(date '+%Y-%m-%d')_wikidata_item_labels_gtrends.csv > ../output/csv/$(date '+%Y-%m-%d')_wikidata_item_labels.csv
+echo "Finding translations from Wikidata using sparql"
+python3 wikidata_translations.py  ../output/intermediate/wikidata_search_results_from_gtrends.csv  ../output/intermediate/wikidata_search_results.csv --topN 10 20 --store --output ../output/csv/diffs/$(date '+%Y-%m-%d')_wikidata_item_labels_gtrends_diff.csv
 
-rm latest.csv
-ln -s $(ls -tr | tail -n 1) latest.csv
+# the labels of every item from today's runs, and latest.csv pointing at them
+python3 wikidata_translations.py --store --snapshot ../output/csv/$(date '+%Y-%m-%d')_wikidata_item_labels.csv
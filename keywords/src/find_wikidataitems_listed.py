@@ -2,21 +2,26 @@ import mwapi
 from urllib.parse import urlparse
 import argparse
 from defaults import user_agent
+from wikidata_api_calls import get_http_session, http_cache_folder
+from digobs_common import http_cache
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--url", help='url to mediawiki page with list of entities to extract',default='https://meta.wikimedia.org/wiki/User:MGerlach_(WMF)/covid_related_pages_reading_sessions')
 parser.add_argument("--output", help='path_to_output file', type=str, default='../output/intermediate/Mgerlach_wikidata_ids.txt')
+parser.add_argument("--http-cache", help="folder of the on-disk HTTP response cache, or '' for none. defaults to ../output/intermediate/http_cache", type=str, default=http_cache_folder)
 
 args = parser.parse_args()
+http_cache.configure(args.http_cache or None)
 
 url = args.url
 urlparsed = urlparse(url)
 hostname = urlparsed.netloc
 
-api = mwapi.Session("https://" + hostname,user_agent=user_agent)
+# through the response cache, which keeps the parsed page for a day
+api = mwapi.Session("https://" + hostname,user_agent=user_agent,session=get_http_session())
 page = urlparsed.path.replace("/wiki/","")
 
-res = api.request(method='get',params={'action':'parse','page':page,'format':'json'})
+res = api.get(action='parse',page=page)
 
 res.keys()
 res['parse'].keys()
@@ -1,12 +1,22 @@
 # File defines functions for making api calls to find translations and transliterations for key terms.
 import mwapi
 import requests
-import sys
-import time
+from os import path
 from defaults import user_agent
+from digobs_common import http_cache
+from digobs_common.rate_limit import RateLimiter, LimitedSession
+
+# responses are cached on disk, apart from the Wikipedia scripts' cache,
+# once a script turns the cache on with http_cache.configure
+http_cache_folder = path.join(path.dirname(path.abspath(__file__)), '..', 'output', 'intermediate', 'http_cache')
+
+def get_http_session():
+    session = http_cache.CachedSession()
+    session.headers.update({'User-Agent' : user_agent})
+    return session
 
 def get_wikidata_api():
-    session = mwapi.Session(host="https://wikidata.org/w/api.php", user_agent=user_agent)
+    session = mwapi.Session(host="https://www.wikidata.org", user_agent=user_agent, session=get_http_session())
     return session
 
 def search_wikidata(session, term, *args, **kwargs):
@@ -28,8 +38,44 @@ def search_wikidata(session, term, *args, **kwargs):
 
     return results
 
-def run_sparql_query(q):
-    results = requests.get("https://query.wikidata.org/bigdata/namespace/wdq/sparql",params={"format":"json","query":q})
-    time.sleep(2)
-    return results
+# the latest revision id of each item, asking about 50 at a time. items
+# that don't exist are left out. page info isn't cached, so these are
+# always current.
+def get_lastrevids(session, itemids):
+    itemids = list(itemids)
+    lastrevids = {}
+    for i in range(0, len(itemids), 50):
+        response = session.get(action='query',
+                               prop='info',
+                               titles='|'.join(itemids[i:i+50]))
+        for page in response['query'].get('pages', {}).values():
+            if 'missing' not in page and 'invalid' not in page:
+                lastrevids[page['title']] = page['lastrevid']
+    return lastrevids
+
+# the query service allows 5 queries at once per client and a minute of
+# query time per minute, so queries go through a rate limiter,
+# which also retries them when we're throttled. Queries answered by the
+# cache don't count. A 500 is how the query service says a query timed
+# out, and it would only time out again, so those aren't retried.
+sparql_url = "https://query.wikidata.org/bigdata/namespace/wdq/sparql"
+sparql_limiter = RateLimiter(rate_limits={'query.wikidata.org' : 1}, max_tries=4, retry_statuses={429, 502, 503, 504})
+sparql_limiter.set_connection_limits(host_connections=4)
+sparql_session = None
+
+def get_sparql_session():
+    global sparql_session
+    if sparql_session is None:
+        # a little longer than the query service's own 60 second limit
+        sparql_session = LimitedSession(sparql_limiter, timeout=90)
+        sparql_session.headers.update({'User-Agent' : user_agent})
+    return sparql_session
+
+# queries whose answers have to be current, like the labels stored with
+# the version they came from, can skip the cache with cached=False
+def run_sparql_query(q, cached=True):
+    params = {"format":"json","query":q}
+    if not cached:
+        return get_sparql_session().send_uncached('GET', sparql_url, params=params)
+    return get_sparql_session().get(sparql_url, params=params)
 
@@ -1,13 +1,67 @@
 # generate a list of wikidata items related to keywords
 from os import path
-from sys import stdout
-from wikidata_api_calls import search_wikidata, get_wikidata_api
+from sys import stdout, stderr
+from wikidata_api_calls import search_wikidata, get_wikidata_api, http_cache_folder
+from digobs_common import http_cache
 import csv
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+import json
+import sqlite3
+import threading
+
+default_search_store = path.join(path.dirname(path.abspath(__file__)), '..', 'output', 'intermediate', 'wikidata_search_store.sqlite')
+
+# the results of every search we've made, keyed on the normalized term and
+# the date it was searched, so each run only has to search new terms
+class Search_Store:
+    def __init__(self, filename=default_search_store):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS searches (
+                               term TEXT NOT NULL,
+                               searched TEXT NOT NULL,
+                               results TEXT NOT NULL,
+                               PRIMARY KEY (term, searched));""")
+        self.conn.commit()
+
+    # the latest results for term, if it was searched on or after since
+    def get(self, term, since=None):
+        row = self.conn.execute("SELECT results FROM searches WHERE term = ? AND searched >= ? ORDER BY searched DESC LIMIT 1;",
+                                (term, (since or date.min).isoformat())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # only the fields Wikidata_Result uses are kept
+    def put(self, term, results, searched=None):
+        results = [{key : result[key] for key in ('title', 'pageid', 'timestamp')} for result in results]
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO searches (term, searched, results) VALUES (?, ?, ?);",
+                              (term, (searched or date.today()).isoformat(), json.dumps(results)))
+
+    def close(self):
+        self.conn.close()
 
 class Wikidata_ResultSet:
-    def __init__(self):
+    def __init__(self, store=None):
         self.results = []
+        self.store = store
+
+    # the stored results of each term searched in the last refresh_days days
+    def from_store(self, terms, refresh_days=30):
+        if self.store is None:
+            return {}
+        since = date.today() - timedelta(days=refresh_days)
+        found = {}
+        for term in terms:
+            results = self.store.get(term, since)
+            if results is not None:
+                found[term] = results
+        return found
+
+    def to_store(self, found):
+        if self.store is not None:
+            for term, results in found.items():
+                self.store.put(term, results)
 
     def extend(self, term, results):
         self.results.append(
@@ -51,12 +105,53 @@ class Wikidata_Result:
                 self.search_position,
                 self.timestamp]
     
-def run_wikidata_searches(terms):
-    api = get_wikidata_api()
-    resultset = Wikidata_ResultSet()
+# the trends files repeat the same queries on many dates, so terms that
+# only differ in whitespace are searched once
+def normalize_term(term):
+    return ' '.join(term.split())
+
+# search each distinct term we don't have recent results for once, a few
+# at a time, then give every input term its results in the original order.
+# if any search fails this raises once the others are stored, unless
+# allow_failures is set, in which case the failed terms are left out.
+def run_wikidata_searches(terms, threads=4, store=None, refresh_days=30, allow_failures=False):
+    local = threading.local()
+
+    def _search(term):
+        # mwapi sessions aren't shared between threads
+        if not hasattr(local, 'api'):
+            local.api = get_wikidata_api()
+        return search_wikidata(local.api, term)
+
+    resultset = Wikidata_ResultSet(store)
+    unique_terms = list(dict.fromkeys(normalize_term(term) for term in terms))
+    found = resultset.from_store(unique_terms, refresh_days)
+    new_terms = [term for term in unique_terms if term not in found]
+    print(f"searching {len(new_terms)} of {len(unique_terms)} terms", file=stderr)
+
+    # each search is stored as soon as it's done, so one that fails doesn't
+    # lose the others. failed terms are searched again next run.
+    failed = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(_search, term) : term for term in new_terms}
+        for future in as_completed(futures):
+            term = futures[future]
+            try:
+                found[term] = future.result()
+            except Exception as e:
+                print(f"search for {term!r} failed: {e}", file=stderr)
+                failed.append(term)
+                continue
+            resultset.to_store({term : found[term]})
+
+    if failed:
+        if not allow_failures:
+            raise RuntimeError(f"{len(failed)} of {len(new_terms)} searches failed; run again to retry them, or pass --allow-failures to leave them out")
+        print(f"{len(failed)} searches failed and are left out", file=stderr)
+
     for term in terms:
-        search_results = search_wikidata(api, term)
-        resultset.extend(term, search_results)
+        if normalize_term(term) in found:
+            resultset.extend(term, found[normalize_term(term)])
     return resultset
 
 def read_google_trends_files(terms_files):
@@ -67,14 +162,14 @@ def read_google_trends_files(terms_files):
         yield row['query']
 
 
-def trawl_google_trends(terms_files, outfile = None, mode='w'):
+def trawl_google_trends(terms_files, outfile = None, mode='w', threads=4, store=None, refresh_days=30, allow_failures=False):
     terms = list(read_google_trends_files(terms_files))
-    resultset = run_wikidata_searches(terms)
+    resultset = run_wikidata_searches(terms, threads, store, refresh_days, allow_failures)
     resultset.to_csv(outfile, mode)
 
-def trawl_base_terms(infiles, outfile = None, mode='w'):
+def trawl_base_terms(infiles, outfile = None, mode='w', threads=4, store=None, refresh_days=30, allow_failures=False):
     terms = list(chain(* (open(infile,'r') for infile in infiles)))
-    resultset = run_wikidata_searches(terms)
+    resultset = run_wikidata_searches(terms, threads, store, refresh_days, allow_failures)
     resultset.to_csv(outfile, mode)
 
     ## search each of the base terms in wikidata
@@ -88,8 +183,19 @@ if __name__ == "__main__":
     parser.add_argument('--use-gtrends', action='store_true', help = 'toggle whether the input is the output from google trends')
     parser.add_argument('--output', type=str, help='an output file. defaults to stdout')
     parser.add_argument('--overwrite', action='store_true', help = 'overwrite existing output files instead of appending')
+    parser.add_argument('--threads', type=int, default=4, help='how many searches to run at once. defaults to 4')
+    parser.add_argument('--search-store', type=str, default=default_search_store, help="sqlite file of earlier searches, so only new terms are searched. '' to search every term. defaults to ../output/intermediate/wikidata_search_store.sqlite")
+    parser.add_argument('--refresh-days', type=int, default=30, help='search terms again once their stored results are this many days old. defaults to 30')
+    parser.add_argument('--allow-failures', action='store_true', help='write the results even if some searches fail, leaving those terms out. by default a failed search stops the run before anything is written, with the other searches stored')
+    parser.add_argument('--http-cache', type=str, default=http_cache_folder, help="folder of the on-disk HTTP response cache, or '' for none. defaults to ../output/intermediate/http_cache")
     args = parser.parse_args()
-    if args.use_gtrends:
-        trawl_google_trends(args.inputs, args.output)
-    else:
-        trawl_base_terms(args.inputs, args.output)
+    http_cache.configure(args.http_cache or None)
+    store = Search_Store(args.search_store) if args.search_store else None
+    try:
+        if args.use_gtrends:
+            trawl_google_trends(args.inputs, args.output, threads=args.threads, store=store, refresh_days=args.refresh_days, allow_failures=args.allow_failures)
+        else:
+            trawl_base_terms(args.inputs, args.output, threads=args.threads, store=store, refresh_days=args.refresh_days, allow_failures=args.allow_failures)
+    finally:
+        if store is not None:
+            store.close()
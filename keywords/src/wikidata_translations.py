@@ -1,8 +1,23 @@
-from wikidata_api_calls import run_sparql_query
+from wikidata_api_calls import run_sparql_query, get_wikidata_api, get_lastrevids, http_cache_folder
+from digobs_common import http_cache
 from itertools import chain, islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import bz2
 import csv
+import gzip
+import json
+import re
+import requests
+import shutil
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+import sqlite3
+from datetime import date
 from json import JSONDecodeError
-from os import path
+from os import path, remove, replace, symlink
 
 class LabelData:
     __slots__ = ['itemid','label','langcode','is_alt']
@@ -20,7 +35,7 @@ class LabelData:
                 self.langcode,
                 self.is_alt]
 
-def GetAllLabels(in_csvs, outfile, topNs):
+def LoadItemIds(in_csvs, topNs):
 
     def load_item_ids(in_csv, topN=5):
         with open(in_csv,'r',newline='') as infile:
@@ -31,60 +46,318 @@ def GetAllLabels(in_csvs, outfile, topNs):
 
     ids = set(chain(* map(lambda in_csv, topN: load_item_ids(in_csv, topN), in_csvs, topNs)))
     ids = ids.union(open("../resources/main_items.txt"))
+    return ids
+
+def GetAllLabels(in_csvs, outfile, topNs, threads=3, chunksize=100, dump=None):
+    ids = LoadItemIds(in_csvs, topNs)
     
-    labeldata = GetItemLabels(ids)
+    if dump is not None:
+        labeldata = GetItemLabelsFromDump(ids, dump, threads)
+    else:
+        labeldata = GetItemLabels(ids, threads, chunksize)
 
     with open(outfile, 'w', newline='') as of:
         writer = csv.writer(of)
         writer.writerow(LabelData.__slots__)
         writer.writerows(map(LabelData.to_list,labeldata))
 
-    
-def GetItemLabels(itemids):
-
-    def run_query_and_parse(query, is_alt):
-        results = run_sparql_query(query)
-        try:
-            jobj = results.json()
-
-            res = jobj.get('results',None)
-            if res is not None:
-                res = res.get('bindings',None)
-            if res is None:
-                raise requests.APIError(f"got invalid response from wikidata for {query % itemid}")
-
-            for info in res:
-                yield LabelData(info, is_alt)
-
-        except JSONDecodeError as e:
-            print(e)
-            print(query)
-            
-    def prep_query(query, prop, itemids):
-        values = ' '.join(('wd:{0}'.format(id) for id in itemids))
-        return query.format(prop, values)
-    
+default_label_store = path.join(path.dirname(path.abspath(__file__)), '..', 'output', 'intermediate', 'wikidata_label_store.sqlite')
+
+# every label we've fetched, and the revision of the item it came from,
+# so a run only has to ask for the labels of items that changed. items
+# also remember the last day they were asked for, which is what goes into
+# a snapshot.
+class Label_Store:
+    def __init__(self, filename=default_label_store):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS items (
+                               item TEXT PRIMARY KEY,
+                               lastrevid INTEGER,
+                               seen TEXT NOT NULL);""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS labels (
+                               item TEXT NOT NULL,
+                               itemid TEXT NOT NULL,
+                               label TEXT NOT NULL,
+                               langcode TEXT,
+                               is_alt INTEGER NOT NULL,
+                               UNIQUE (item, label, langcode, is_alt));""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS labels_item ON labels (item);")
+        self.conn.commit()
+
+    def lastrevids(self):
+        return dict(self.conn.execute("SELECT item, lastrevid FROM items;"))
+
+    def labels(self, item):
+        return set((itemid, label, langcode, bool(is_alt)) for itemid, label, langcode, is_alt in
+                   self.conn.execute("SELECT itemid, label, langcode, is_alt FROM labels WHERE item = ?;", (item,)))
+
+    def mark_seen(self, items, day):
+        with self.conn:
+            self.conn.executemany("INSERT INTO items (item, lastrevid, seen) VALUES (?, NULL, ?) ON CONFLICT (item) DO UPDATE SET seen = excluded.seen;",
+                                  [(item, day) for item in items])
+
+    # replaces the labels of item, returning the rows that were added and
+    # the rows that were removed
+    def update(self, item, lastrevid, rows):
+        old = self.labels(item)
+        new = set(tuple(row) for row in rows)
+        with self.conn:
+            self.conn.execute("DELETE FROM labels WHERE item = ?;", (item,))
+            self.conn.executemany("INSERT OR IGNORE INTO labels (item, itemid, label, langcode, is_alt) VALUES (?, ?, ?, ?, ?);",
+                                  [(item,) + row for row in new])
+            self.conn.execute("UPDATE items SET lastrevid = ? WHERE item = ?;", (lastrevid, item))
+        return (sorted(new - old, key=label_order), sorted(old - new, key=label_order))
+
+    def latest_day(self):
+        return self.conn.execute("SELECT MAX(seen) FROM items;").fetchone()[0]
+
+    # the labels of every item seen on day, as LabelData rows
+    def snapshot(self, day):
+        rows = self.conn.execute("""SELECT labels.item, itemid, label, langcode, is_alt FROM labels JOIN items ON labels.item = items.item
+                                    WHERE items.seen = ? ORDER BY labels.item;""", (day,))
+        current = None
+        item_rows = []
+        for item, itemid, label, langcode, is_alt in chain(rows, [(None, None, None, None, None)]):
+            if item != current:
+                yield from sorted(item_rows, key=label_order)
+                current = item
+                item_rows = []
+            item_rows.append([itemid, label, langcode, bool(is_alt)])
+
+    def close(self):
+        self.conn.close()
+
+# labels then aliases, each alphabetically by language
+def label_order(row):
+    return (row[3], row[2] or '', row[1])
+
+# like GetAllLabels, but only asks for the labels of items that are new or
+# have been edited since we last asked, keeps them in store, and writes
+# just the labels that were added or removed to diff_file
+def UpdateLabels(in_csvs, diff_file, topNs, store, threads=3, chunksize=100, day=None, dump=None):
+    day = day or date.today().isoformat()
+    items = set(id.strip() for id in LoadItemIds(in_csvs, topNs) if id.strip())
+    store.mark_seen(items, day)
+    stored = store.lastrevids()
+
+    failed = []
+    labels = {}
+    # a dump has the revision each item's labels came from
+    if dump is not None:
+        entities = {entity['id'] : entity for entity in ReadDumpEntities(dump, sorted(items), threads)}
+        lastrevids = {item : entity.get('lastrevid', 0) for item, entity in entities.items()}
+        changed = [item for item in sorted(items) if stored.get(item, None) != lastrevids.get(item, 0)]
+        for item in changed:
+            if item in entities:
+                labels[item] = [labeldata.to_list() for labeldata in DumpLabels(entities[item])]
+
+    else:
+        # the api says which items changed, but what's stored with the
+        # labels is the version the query service had, bypassing the cache.
+        # if the query service is behind, the item is fetched again next
+        # run. items it doesn't have yet are left for next run too, and
+        # items that have been deleted get 0, so their labels are removed
+        # once.
+        apirevids = get_lastrevids(get_wikidata_api(), items)
+        changed = [item for item in sorted(items) if stored.get(item, None) != apirevids.get(item, 0)]
+        print(f"getting labels for {len(changed)} of {len(items)} items that are new or changed", file=sys.stderr)
+        lastrevids = {}
+        for labeldata in GetItemLabels(changed, threads, chunksize, failed=failed, versions=lastrevids, cached=False):
+            labels.setdefault(labeldata.itemid.split('/')[-1], []).append(labeldata.to_list())
+        lagging = [item for item in changed if item in apirevids and item not in lastrevids and item not in failed]
+        if lagging:
+            print(f"the query service doesn't have {len(lagging)} items yet: {' '.join(lagging)}", file=sys.stderr)
+            failed.extend(lagging)
+
+    with open(diff_file, 'w', newline='') as of:
+        writer = csv.writer(of)
+        writer.writerow(LabelData.__slots__ + ['change'])
+        for item in changed:
+            # try items we couldn't get again next time
+            if item in failed:
+                continue
+            added, removed = store.update(item, lastrevids.get(item, 0), labels.get(item, []))
+            writer.writerows(list(row) + ['removed'] for row in removed)
+            writer.writerows(list(row) + ['added'] for row in added)
+
+# writes every label of the items the store saw on day (by default, its
+# latest run) to outfile, and points latest.csv in the same folder at it
+def WriteSnapshot(store, outfile, day=None):
+    day = day or store.latest_day()
+    with open(outfile, 'w', newline='') as of:
+        writer = csv.writer(of)
+        writer.writerow(LabelData.__slots__)
+        writer.writerows(store.snapshot(day))
+
+    latest = path.join(path.dirname(outfile), 'latest.csv')
+    tmp = latest + '.tmp'
+    if path.lexists(tmp):
+        remove(tmp)
+    symlink(path.basename(outfile), tmp)
+    replace(tmp, latest)
+
+# the query service gives up on queries after a minute, so a chunk that
+# takes this long or returns this many rows is too big
+slow_query = 20
+big_query = 50000
+
+# fetch the labels and aliases of itemids, a chunk of items per query and
+# a few queries at a time. chunks start at chunksize items and grow while
+# the queries are quick, and shrink when they are slow. a chunk that
+# fails is split in half and both halves are tried again. items that
+# still fail on their own are added to failed. if versions is given, the
+# revision the query service has of each item goes into it, and items it
+# doesn't have are left out. cached=False skips the http cache.
+def GetItemLabels(itemids, threads=3, chunksize=100, max_chunksize=1000, failed=None, versions=None, cached=True):
+
     base_query = """
-    SELECT DISTINCT ?item ?label WHERE {{
-    ?item {0} ?label;
-    VALUES ?item  {{ {1} }}
+    SELECT DISTINCT ?item ?version ?label ?is_alt WHERE {{
+    VALUES ?item {{ {0} }}
+    ?item schema:version ?version .
+    OPTIONAL {{
+    {{ ?item rdfs:label ?label . BIND(false AS ?is_alt) }}
+    UNION
+    {{ ?item skos:altLabel ?label . BIND(true AS ?is_alt) }}
+    }}
     }}"""
 
-    # we can't get all the items at once. how about 100 at a time?
-    chunksize = 100
-    itemids = (id for id in itemids)
-    chunk = list(islice(itemids, chunksize))
-    calls = []
-    while len(chunk) > 0:
-        label_query = prep_query(base_query, "rdfs:label", chunk)
-        altLabel_query = prep_query(base_query, "skos:altLabel", chunk)
-        label_results = run_query_and_parse(label_query,  is_alt=False)
-        altLabel_results = run_query_and_parse(altLabel_query, is_alt=True)
-        calls.extend([label_results, altLabel_results])
-        chunk = list(islice(itemids, chunksize))
-
-    return chain(*calls)
-        
+    def run_query_and_parse(chunk):
+        query = base_query.format(' '.join(('wd:{0}'.format(id) for id in chunk)))
+        start = time.monotonic()
+        results = run_sparql_query(query, cached=cached)
+        results.raise_for_status()
+        res = results.json().get('results',{}).get('bindings',None)
+        if res is None:
+            raise ValueError(f"got invalid response from wikidata for {' '.join(chunk)}")
+        # an item without any labels still has a row, for its version
+        chunk_versions = {info['item']['value'].split('/')[-1] : int(info['version']['value']) for info in res}
+        chunk_labels = [LabelData(info, info['is_alt']['value'] == 'true') for info in res if 'label' in info]
+        return (chunk_labels, chunk_versions, time.monotonic() - start)
+
+    itemids = list(dict.fromkeys(id.strip() for id in itemids if id.strip()))
+    remaining = iter(itemids)
+    retries = deque()
+    labels = {}
+    failed = failed if failed is not None else []
+
+    def next_chunk():
+        if retries:
+            return retries.popleft()
+        return list(islice(remaining, chunksize))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        running = {}
+        while True:
+            while len(running) < threads:
+                chunk = next_chunk()
+                if len(chunk) == 0:
+                    break
+                running[executor.submit(run_query_and_parse, chunk)] = chunk
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = running.pop(future)
+                try:
+                    chunk_labels, chunk_versions, seconds = future.result()
+                except (requests.RequestException, JSONDecodeError, ValueError) as e:
+                    if len(chunk) == 1:
+                        print(f"giving up on {chunk[0]}: {e}", file=sys.stderr)
+                        failed.append(chunk[0])
+                    else:
+                        print(f"splitting a chunk of {len(chunk)} items that failed: {e}", file=sys.stderr)
+                        half = len(chunk) // 2
+                        retries.extendleft([chunk[half:], chunk[:half]])
+                        chunksize = max(1, min(chunksize, half))
+                    continue
+
+                for item in chunk_labels:
+                    labels.setdefault(item.itemid.split('/')[-1], []).append(item)
+                if versions is not None:
+                    versions.update(chunk_versions)
+
+                if seconds > slow_query or len(chunk_labels) > big_query:
+                    chunksize = max(1, chunksize // 2)
+                elif seconds < slow_query / 4 and len(chunk_labels) < big_query / 4:
+                    chunksize = min(max_chunksize, chunksize + chunksize // 2)
+
+    if failed:
+        print(f"couldn't get labels for {len(failed)} items: {' '.join(failed)}", file=sys.stderr)
+
+    # labels then aliases of each item, each alphabetically by language, in
+    # the order the items came in
+    return chain(* (sorted(labels.get(id, []), key=lambda item: label_order(item.to_list())) for id in itemids))
+
+# parallel decompressors to try for each kind of dump, before falling
+# back to python's own
+decompressors = {'.bz2' : [['lbzip2', '-n', '{threads}', '-dc'], ['pbzip2', '-p{threads}', '-dc']],
+                 '.gz' : [['pigz', '-p', '{threads}', '-dc']]}
+
+@contextmanager
+def open_dump(dump_file, threads=4):
+    ext = path.splitext(dump_file)[1]
+    for command in decompressors.get(ext, []):
+        if shutil.which(command[0]) is not None:
+            process = subprocess.Popen([arg.format(threads=threads) for arg in command] + [dump_file], stdout=subprocess.PIPE)
+            try:
+                yield process.stdout
+            finally:
+                process.stdout.close()
+                process.kill()
+                process.wait()
+            return
+
+    if ext in decompressors:
+        print(f"no parallel decompressor for {dump_file}, using one thread", file=sys.stderr)
+    opener = {'.bz2' : bz2.open, '.gz' : gzip.open}.get(ext, open)
+    with opener(dump_file, 'rb') as infile:
+        yield infile
+
+# an entity's own id comes before any other id in its line of the dump,
+# so the first id on a line is the entity's. properties and lexemes have
+# to match too, or the first item their claims mention would be taken
+# for theirs.
+entity_id = re.compile(rb'"id":"([A-Z]\d+)"')
+
+# the entities of itemids in a wikidata json dump (like
+# latest-all.json.bz2), which has one entity per line. lines for other
+# entities are skipped without parsing them. stops once every item is
+# found.
+def ReadDumpEntities(dump_file, itemids, threads=4):
+    wanted = set(itemid.encode() for itemid in itemids)
+    with open_dump(dump_file, threads) as infile:
+        for line in infile:
+            match = entity_id.search(line)
+            if match is None or match.group(1) not in wanted:
+                continue
+            entity = json.loads(line.rstrip().rstrip(b','))
+            if entity.get('id', None) != match.group(1).decode():
+                continue
+            yield entity
+            wanted.discard(match.group(1))
+            if not wanted:
+                break
+
+# the labels and then aliases of an entity from the dump, as the LabelData
+# the query service would have given us
+def DumpLabels(entity):
+    item = {'value' : f"http://www.wikidata.org/entity/{entity['id']}"}
+    labels = [LabelData({'item' : item, 'label' : {'value' : label['value'], 'xml:lang' : label['language']}}, False)
+              for label in entity.get('labels', {}).values()]
+    aliases = [LabelData({'item' : item, 'label' : {'value' : alias['value'], 'xml:lang' : alias['language']}}, True)
+               for language_aliases in entity.get('aliases', {}).values() for alias in language_aliases]
+    return labels + aliases
+
+# like GetItemLabels, but reads the labels from a local dump instead of
+# asking the query service
+def GetItemLabelsFromDump(itemids, dump_file, threads=4):
+    itemids = list(dict.fromkeys(id.strip() for id in itemids if id.strip()))
+    labels = {entity['id'] : DumpLabels(entity) for entity in ReadDumpEntities(dump_file, itemids, threads)}
+    missing = [id for id in itemids if id not in labels]
+    if missing:
+        print(f"{len(missing)} items aren't in {dump_file}", file=sys.stderr)
+    return chain(* (labels.get(id, []) for id in itemids))
 
 def find_new_output_file(output, i = 1):
     if path.exists(output):
@@ -97,12 +370,30 @@ def find_new_output_file(output, i = 1):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser("Use wikidata to find translations of terms")
-    parser.add_argument('inputs', type=str, nargs='+', help='one or more files to read. the inputs are generated by wikidata_search.py')
+    parser.add_argument('inputs', type=str, nargs='*', help='one or more files to read. the inputs are generated by wikidata_search.py')
     parser.add_argument('--topN', type=int, nargs='+', help='limit number of wikidata search results to use, can pass one arg for each source.')
     parser.add_argument('--output', type=str, help='an output file. defaults to stdout',default=20)
+    parser.add_argument('--threads', type=int, default=3, help='how many sparql queries to run at once. defaults to 3')
+    parser.add_argument('--chunksize', type=int, default=100, help='how many items to ask for in the first query. later queries ask for more or fewer depending on how long they take. defaults to 100')
+    parser.add_argument('--store', type=str, nargs='?', const=default_label_store, default=None, help='keep labels in this sqlite store and only ask for the labels of new or edited items. --output then gets just the labels that were added or removed. defaults to ../output/intermediate/wikidata_label_store.sqlite')
+    parser.add_argument('--dump', type=str, default=None, help='read labels from a local wikidata json dump (latest-all.json.bz2 or .gz) instead of the query service. --threads is then the number of threads to decompress it with')
+    parser.add_argument('--snapshot', type=str, default=None, help='write every label of the items in the latest run of --store to this file, and point latest.csv next to it at it')
+    parser.add_argument('--http-cache', type=str, default=http_cache_folder, help="folder of the on-disk HTTP response cache, or '' for none. defaults to ../output/intermediate/http_cache")
 
     args = parser.parse_args()
+    http_cache.configure(args.http_cache or None)
 
-    output = find_new_output_file(args.output)
+    if args.store is None:
+        if args.snapshot is not None:
+            parser.error("--snapshot needs --store")
+        output = find_new_output_file(args.output)
+        GetAllLabels(args.inputs, output, topNs=args.topN, threads=args.threads, chunksize=args.chunksize, dump=args.dump)
 
-    GetAllLabels(args.inputs, output, topNs=args.topN)
+    else:
+        store = Label_Store(args.store)
+        if args.inputs:
+            output = find_new_output_file(args.output)
+            UpdateLabels(args.inputs, output, topNs=args.topN, store=store, threads=args.threads, chunksize=args.chunksize, dump=args.dump)
+        if args.snapshot is not None:
+            WriteSnapshot(store, args.snapshot)
+        store.close()
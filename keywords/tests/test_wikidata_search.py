@@ -0,0 +1,44 @@
+# tests of searching wikidata with stored results, with the search api
+# replaced by a function that makes up results
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+import wikidata_search
+
+def fake_search(calls, failing=()):
+    def search(api, term):
+        calls.append(term)
+        if term in failing:
+            raise ValueError(f"no results for {term}")
+        return [{'title' : f"Q{len(term)}", 'pageid' : len(term), 'timestamp' : '2020-04-01T00:00:00Z'}]
+    return search
+
+def rows(resultset):
+    return [result.to_list() for results in resultset.results for result in results]
+
+def test_terms_are_searched_once(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(wikidata_search, 'search_wikidata', fake_search(calls))
+    monkeypatch.setattr(wikidata_search, 'get_wikidata_api', lambda: None)
+    resultset = wikidata_search.run_wikidata_searches(["covid\n", "covid  19", " mask", "covid"])
+    assert sorted(calls) == ["covid", "covid 19", "mask"]
+    assert [row[0] for row in rows(resultset)] == ["covid", "covid  19", "mask", "covid"]
+
+def test_failed_searches_keep_the_rest(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(wikidata_search, 'search_wikidata', fake_search(calls, failing={"bad"}))
+    monkeypatch.setattr(wikidata_search, 'get_wikidata_api', lambda: None)
+    store = wikidata_search.Search_Store(str(tmp_path / "store.sqlite"))
+
+    with pytest.raises(RuntimeError, match="1 of 3 searches failed"):
+        wikidata_search.run_wikidata_searches(["covid", "bad", "mask"], store=store)
+
+    # only the failed term is searched again
+    calls.clear()
+    resultset = wikidata_search.run_wikidata_searches(["covid", "bad", "mask"], store=store, allow_failures=True)
+    assert calls == ["bad"]
+    assert [row[0] for row in rows(resultset)] == ["covid", "mask"]
+    store.close()
@@ -0,0 +1,166 @@
+# tests of reading labels from a local wikidata json dump, on a small
+# fixture dump written out by the tests, and from a stand-in for the
+# query service
+import bz2
+import csv
+import gzip
+import json
+import re
+import sys
+from os import path
+
+import requests
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+import wikidata_translations
+
+def item(id, lastrevid=100):
+    return {"type" : "item", "id" : id, "lastrevid" : lastrevid,
+            "labels" : {"en" : {"language" : "en", "value" : f"{id} label"},
+                        "de" : {"language" : "de", "value" : f"{id} Name"}},
+            "aliases" : {"en" : [{"language" : "en", "value" : f"{id} alias"}]},
+            "claims" : {}}
+
+# a property whose claims mention Q5 before Q5's own line
+def property_mentioning(id):
+    return {"type" : "property", "datatype" : "wikibase-item", "id" : "P31", "lastrevid" : 7,
+            "labels" : {"en" : {"language" : "en", "value" : "instance of"}},
+            "claims" : {"P1" : [{"id" : "P31$abc", "mainsnak" : {"datavalue" : {"value" : {"entity-type" : "item", "id" : id}}}}]}}
+
+def write_dump(filename, entities, opener=open):
+    with opener(filename, 'wb') as outfile:
+        outfile.write(b"[\n" + b",\n".join(json.dumps(entity, separators=(',', ':')).encode() for entity in entities) + b"\n]\n")
+    return str(filename)
+
+def test_labels_from_dump(tmp_path):
+    dump = write_dump(tmp_path / "dump.json.gz", [item("Q1"), item("Q2"), item("Q3")], gzip.open)
+    rows = [labeldata.to_list() for labeldata in wikidata_translations.GetItemLabelsFromDump(["Q3\n", "Q1", "Q404"], dump)]
+    assert rows == [["http://www.wikidata.org/entity/Q3", "Q3 label", "en", False],
+                    ["http://www.wikidata.org/entity/Q3", "Q3 Name", "de", False],
+                    ["http://www.wikidata.org/entity/Q3", "Q3 alias", "en", True],
+                    ["http://www.wikidata.org/entity/Q1", "Q1 label", "en", False],
+                    ["http://www.wikidata.org/entity/Q1", "Q1 Name", "de", False],
+                    ["http://www.wikidata.org/entity/Q1", "Q1 alias", "en", True]]
+
+def test_property_claims_are_not_the_item(tmp_path):
+    dump = write_dump(tmp_path / "dump.json.bz2", [property_mentioning("Q5"), item("Q5")], bz2.open)
+    entities = list(wikidata_translations.ReadDumpEntities(dump, ["Q5"]))
+    assert [entity['id'] for entity in entities] == ["Q5"]
+    rows = list(wikidata_translations.GetItemLabelsFromDump(["Q5"], dump))
+    assert len(rows) == 3
+
+def test_update_labels_from_dump(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "resources").mkdir()
+    (tmp_path / "run").mkdir()
+    (tmp_path / "resources" / "main_items.txt").write_text("Q5\n")
+    (tmp_path / "run" / "in.csv").write_text("search_term,itemid,pageid,search_position,timestamp\nx,Q1,1,0,t\n")
+    monkeypatch.chdir(tmp_path / "run")
+
+    store = wikidata_translations.Label_Store(str(tmp_path / "store.sqlite"))
+    dump = write_dump(tmp_path / "dump.json.bz2", [item("Q1"), property_mentioning("Q5"), item("Q5")], bz2.open)
+    wikidata_translations.UpdateLabels(["in.csv"], str(tmp_path / "diff1.csv"), [5], store, day="2020-04-01", dump=dump)
+
+    # nothing changed, so the second run has nothing to add or remove
+    wikidata_translations.UpdateLabels(["in.csv"], str(tmp_path / "diff2.csv"), [5], store, day="2020-04-02", dump=dump)
+    with open(tmp_path / "diff1.csv", newline='') as infile:
+        first = list(csv.DictReader(infile))
+    with open(tmp_path / "diff2.csv", newline='') as infile:
+        second = list(csv.DictReader(infile))
+    assert sorted(row['itemid'].split('/')[-1] for row in first) == ["Q1"] * 3 + ["Q5"] * 3
+    assert set(row['change'] for row in first) == {'added'}
+    assert second == []
+
+    snapshot = tmp_path / "snapshot.csv"
+    wikidata_translations.WriteSnapshot(store, str(snapshot))
+    with open(snapshot, newline='') as infile:
+        assert len(list(csv.DictReader(infile))) == 6
+    assert path.islink(tmp_path / "latest.csv")
+    store.close()
+
+# a run_sparql_query that answers label queries from item(), at the
+# revision in revisions (100 by default), recording the items each query
+# asked for and whether it could be cached. items missing from revisions
+# aren't in the query service, and queries about failing items get a 500.
+def fake_sparql(queries, failing=(), revisions=None, cached_queries=None):
+    def run_sparql_query(query, cached=True):
+        ids = re.findall(r'wd:(Q\d+)', query)
+        queries.append(ids)
+        if cached_queries is not None:
+            cached_queries.append(cached)
+        response = requests.Response()
+        if any(id in failing for id in ids):
+            response.status_code = 500
+            response._content = b'timeout'
+            return response
+        bindings = []
+        for id in reversed(ids):
+            if revisions is not None and id not in revisions:
+                continue
+            entity = item(id, revisions[id] if revisions is not None else 100)
+            labels = [(label, False) for label in entity['labels'].values()] + [(alias, True) for aliases in entity['aliases'].values() for alias in aliases]
+            for label, is_alt in labels:
+                bindings.append({'item' : {'value' : f"http://www.wikidata.org/entity/{id}"},
+                                 'version' : {'value' : str(entity['lastrevid'])},
+                                 'label' : {'value' : label['value'], 'xml:lang' : label['language']},
+                                 'is_alt' : {'value' : 'true' if is_alt else 'false'}})
+        response.status_code = 200
+        response._content = json.dumps({'results' : {'bindings' : bindings}}).encode()
+        return response
+    return run_sparql_query
+
+def test_labels_from_the_query_service(monkeypatch):
+    queries = []
+    monkeypatch.setattr(wikidata_translations, 'run_sparql_query', fake_sparql(queries))
+    ids = [f"Q{n}" for n in range(1, 60)]
+    rows = [labeldata.to_list() for labeldata in wikidata_translations.GetItemLabels(ids, threads=1, chunksize=3)]
+    # quick queries grow the chunks by half each time
+    assert [len(chunk) for chunk in queries] == [3, 4, 6, 9, 13, 19, 5]
+    # labels then aliases of each item, each by language, in input order
+    assert rows[:3] == [["http://www.wikidata.org/entity/Q1", "Q1 Name", "de", False],
+                        ["http://www.wikidata.org/entity/Q1", "Q1 label", "en", False],
+                        ["http://www.wikidata.org/entity/Q1", "Q1 alias", "en", True]]
+    assert [row[0].split('/')[-1] for row in rows[::3]] == ids
+
+def test_failing_chunks_are_split(monkeypatch):
+    queries = []
+    monkeypatch.setattr(wikidata_translations, 'run_sparql_query', fake_sparql(queries, failing={"Q3"}))
+    failed = []
+    rows = list(wikidata_translations.GetItemLabels([f"Q{n}" for n in range(1, 5)], threads=1, chunksize=4, failed=failed))
+    assert failed == ["Q3"]
+    assert sorted(set(row.itemid.split('/')[-1] for row in rows)) == ["Q1", "Q2", "Q4"]
+    assert queries[:3] == [["Q1", "Q2", "Q3", "Q4"], ["Q1", "Q2"], ["Q3", "Q4"]]
+
+# the store keeps the revision the query service's labels came from, not
+# the one the api knows about
+def test_update_labels_from_the_query_service(tmp_path, monkeypatch):
+    (tmp_path / "resources").mkdir()
+    (tmp_path / "run").mkdir()
+    (tmp_path / "resources" / "main_items.txt").write_text("Q5\n")
+    (tmp_path / "run" / "in.csv").write_text("search_term,itemid,pageid,search_position,timestamp\nx,Q1,1,0,t\nx,Q2,2,0,t\nx,Q3,3,0,t\n")
+    monkeypatch.chdir(tmp_path / "run")
+    monkeypatch.setattr(wikidata_translations, 'get_wikidata_api', lambda: None)
+
+    def run(apirevids, revisions, day):
+        queries, cached = [], []
+        monkeypatch.setattr(wikidata_translations, 'get_lastrevids', lambda api, items: dict(apirevids))
+        monkeypatch.setattr(wikidata_translations, 'run_sparql_query', fake_sparql(queries, revisions=revisions, cached_queries=cached))
+        wikidata_translations.UpdateLabels(["in.csv"], str(tmp_path / f"diff-{day}.csv"), [5], store, day=day)
+        assert set(cached) <= {False}
+        with open(tmp_path / f"diff-{day}.csv", newline='') as infile:
+            return (sorted(id for chunk in queries for id in chunk), list(csv.DictReader(infile)))
+
+    store = wikidata_translations.Label_Store(str(tmp_path / "store.sqlite"))
+    # the query service is behind on Q2 and doesn't have Q3 yet, and Q5
+    # has been deleted
+    queried, diff = run({"Q1" : 100, "Q2" : 120, "Q3" : 100}, {"Q1" : 100, "Q2" : 110}, "2020-04-01")
+    assert queried == ["Q1", "Q2", "Q3", "Q5"]
+    assert store.lastrevids() == {"Q1" : 100, "Q2" : 110, "Q3" : None, "Q5" : 0}
+    assert sorted(row['itemid'].split('/')[-1] for row in diff) == ["Q1"] * 3 + ["Q2"] * 3
+
+    # once it has caught up, only the items it was missing are asked for
+    queried, diff = run({"Q1" : 100, "Q2" : 120, "Q3" : 100}, {"Q1" : 100, "Q2" : 120, "Q3" : 100}, "2020-04-02")
+    assert queried == ["Q2", "Q3"]
+    assert store.lastrevids() == {"Q1" : 100, "Q2" : 120, "Q3" : 100, "Q5" : 0}
+    assert sorted(row['itemid'].split('/')[-1] for row in diff) == ["Q3"] * 3
+    store.close()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Benchmarks the fetchers against mock_wikimedia_server.py, so performance
+# changes can be measured offline.
+#
+# It (1) starts the mock server and makes up an article list and tracker
+# database, (2) runs each fetcher in its own process with digobs pointed
+# at the mock server, and (3) reports wall time, requests/sec, rows/sec
+# and peak RSS for each, optionally adding them to a JSON lines file so
+# runs can be compared over time.
+#
+###############################################################################
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import runpy
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+import digobs
+import mock_wikimedia_server
+
+scripts_folder = os.path.dirname(os.path.abspath(__file__))
+
+fetchers = ['wikiproject_scraper', 'fetch_enwiki_daily_views', 'fetch_enwiki_revisions', 'fetch_revisions']
+
+# modules a fetcher needs beyond what digobs does, so it can be skipped
+# where they aren't installed
+fetcher_modules = {'fetch_enwiki_revisions' : ['mw']}
+
+# Runs in the child process: points digobs at the mock server and runs
+# the fetcher as if it had been started from the command line.
+def run_fetcher(base_url, rate_limit, script, script_args):
+    sys.path.insert(0, scripts_folder)
+    digobs.view_api_url = base_url + mock_wikimedia_server.pageview_prefix.rstrip('/')
+    digobs.api_url = base_url + "/{project}/w/api.php"
+    digobs.rate_limits[urlparse(base_url).hostname] = rate_limit
+
+    sys.argv = [script] + script_args
+    runpy.run_path(script, run_name="__main__")
+
+def make_inputs(folder, articles, projects):
+    article_file = os.path.join(folder, "articles.txt")
+    titles = [f"Mock article {n}" for n in range(articles)]
+    # a few of the things real lists have: missing pages and duplicates
+    titles = titles + [f"Missing article {n}" for n in range(max(1, articles // 50))] + titles[:max(1, articles // 50)]
+    with open(article_file, 'w') as outfile:
+        outfile.write('\n'.join(titles) + '\n')
+
+    input_db = os.path.join(folder, "AllWikidataItems.sqlite")
+    conn = sqlite3.connect(input_db)
+    conn.execute("CREATE TABLE pagesPerProjectTable (project TEXT, page TEXT);")
+    conn.executemany("INSERT INTO pagesPerProjectTable (project, page) VALUES (?, ?);",
+                     [(project, title) for project in projects for title in titles[:articles // len(projects)]])
+    conn.commit()
+    conn.close()
+
+    return (article_file, input_db)
+
+def fetcher_args(fetcher, folder, article_file, input_db):
+    output_folder = os.path.join(folder, fetcher)
+    os.mkdir(output_folder)
+    # each fetcher starts with an empty response cache of its own
+    common = ['--metrics_file', os.path.join(output_folder, 'metrics.json'),
+              '--http_cache', os.path.join(output_folder, 'http_cache')]
+    caches = ['--title_cache', os.path.join(output_folder, 'title_cache.sqlite'),
+              '--journal', os.path.join(output_folder, 'journal.sqlite')] + common
+
+    if fetcher == 'wikiproject_scraper':
+        return (output_folder, ['-o', os.path.join(output_folder, 'articles.txt')] + common)
+    elif fetcher == 'fetch_enwiki_daily_views':
+        return (output_folder, ['-o', output_folder, '-i', article_file, '-d', '20200401'] + caches)
+    elif fetcher == 'fetch_enwiki_revisions':
+        return (output_folder, ['-o', output_folder, '-i', article_file,
+                                '-s', os.path.join(output_folder, 'revision_state.sqlite')] + caches)
+    elif fetcher == 'fetch_revisions':
+        return (output_folder, ['-o', output_folder, '-i', article_file, '-d', input_db,
+                                '--pagelist_cache', os.path.join(output_folder, 'pagelist_cache.sqlite'),
+                                '-s', os.path.join(output_folder, 'revision_state.sqlite')] + caches)
+
+# rows in the tsv (or, for the scraper, txt) files a fetcher wrote
+def count_rows(output_folder):
+    rows = 0
+    for folder, subfolders, filenames in os.walk(output_folder):
+        for filename in filenames:
+            if filename.endswith('.tsv') or filename.endswith('.txt'):
+                with open(os.path.join(folder, filename), 'r') as infile:
+                    lines = sum(1 for line in infile)
+                rows = rows + (lines if filename.endswith('.txt') else max(0, lines - 1))
+    return rows
+
+def run_benchmark(fetcher, server, args, folder, article_file, input_db):
+    output_folder, script_args = fetcher_args(fetcher, folder, article_file, input_db)
+    script = os.path.join(scripts_folder, f"{fetcher}.py")
+    command = [sys.executable, os.path.abspath(__file__), '--run_fetcher', server.base_url, str(args.rate_limit), script] + script_args
+
+    stats_before = server.stats()
+    start = time.perf_counter()
+    with open(os.path.join(folder, f"{fetcher}.log"), 'w') as log:
+        process = subprocess.Popen(command, cwd=scripts_folder, stdout=log, stderr=log)
+        pid, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    # the same exit code Popen.wait() would give, negative for a signal
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    stats_after = server.stats()
+
+    requests = sum(stats_after['requests'].values()) - sum(stats_before['requests'].values())
+    rows = count_rows(output_folder)
+    return {'fetcher' : fetcher,
+            'ok' : process.returncode == 0,
+            'wall_time' : wall_time,
+            'requests' : requests,
+            'requests_per_sec' : requests / wall_time,
+            'rows' : rows,
+            'rows_per_sec' : rows / wall_time,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb' : usage.ru_maxrss / 1024,
+            'bytes_downloaded' : stats_after['bytes_sent'] - stats_before['bytes_sent'],
+            'log' : os.path.join(folder, f"{fetcher}.log")}
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--run_fetcher':
+        base_url, rate_limit, script = sys.argv[2:5]
+        run_fetcher(base_url, float(rate_limit), script, sys.argv[5:])
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark the fetchers against a local mock of the Wikimedia APIs.')
+    parser.add_argument('fetchers', help=f"Fetchers to run. Default: all of {', '.join(fetchers)}.", nargs='*', default=[])
+    parser.add_argument('-n', '--articles', help='Number of articles to fetch. Default: 200.', type=int, default=200)
+    parser.add_argument('--projects', help='Projects in the made up tracker database for fetch_revisions.py. Default: en.wikipedia de.wikipedia.', nargs='+', default=['en.wikipedia', 'de.wikipedia'])
+    parser.add_argument('--rate_limit', help='Requests per second the fetchers allow themselves to the mock server. Default: 100.', type=float, default=100)
+    parser.add_argument('-o', '--results', help='Add the results to this JSON lines file.', type=str, default=None)
+    parser.add_argument('--keep', help='Keep the outputs and logs instead of deleting them.', action='store_true')
+    parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel)
+    mock_wikimedia_server.add_server_args(parser)
+    args = parser.parse_args()
+    for fetcher in args.fetchers:
+        if fetcher not in fetchers:
+            parser.error(f"no fetcher called {fetcher}, choose from {', '.join(fetchers)}")
+
+    logging.basicConfig(level=args.logging_level)
+
+    server = mock_wikimedia_server.make_server(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"mock server at {server.base_url}")
+
+    folder = tempfile.mkdtemp(prefix="digobs_benchmark_")
+    article_file, input_db = make_inputs(folder, args.articles, args.projects)
+
+    results = []
+    for fetcher in args.fetchers or fetchers:
+        missing = [module for module in fetcher_modules.get(fetcher, []) if importlib.util.find_spec(module) is None]
+        if missing:
+            logging.warning(f"Warning: skipping {fetcher}, which needs {', '.join(missing)}")
+            continue
+
+        logging.info(f"running {fetcher}")
+        result = run_benchmark(fetcher, server, args, folder, article_file, input_db)
+        if not result['ok']:
+            logging.error(f"{fetcher} failed, see {result['log']}")
+        results.append(result)
+
+    server.shutdown()
+    server.server_close()
+
+    print(f"{'fetcher':<26} {'ok':<4} {'wall (s)':>9} {'requests':>9} {'req/s':>8} {'rows':>8} {'rows/s':>9} {'peak RSS (MB)':>14}")
+    for result in results:
+        print(f"{result['fetcher']:<26} {'yes' if result['ok'] else 'no':<4} {result['wall_time']:>9.2f} {result['requests']:>9} "
+              f"{result['requests_per_sec']:>8.1f} {result['rows']:>8} {result['rows_per_sec']:>9.1f} {result['peak_rss_mb']:>14.1f}")
+
+    if args.results:
+        try:
+            commit = digobs.git_hash(short=True)
+        except subprocess.CalledProcessError:
+            commit = None
+        settings = {name : getattr(args, name) for name in ('articles', 'rate_limit', 'latency', 'jitter', 'error_rate', 'throttle_rate',
+                                                            'revisions_per_page', 'content_size', 'recordings')}
+        with open(args.results, 'a') as outfile:
+            for result in results:
+                print(json.dumps(dict(result, timestamp=str(datetime.now()), commit=commit, settings=settings)), file=outfile)
+
+    if args.keep:
+        logging.info(f"outputs and logs are in {folder}")
+    else:
+        shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    main()
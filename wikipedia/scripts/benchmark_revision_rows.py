@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Micro-benchmark for turning revisions from the API into tsv rows.
+#
+# It times (1) the way rows used to be built, which prepared a requests
+# Request for every URL, built a fresh dict for the DictWriter, and (in
+# fetch_enwiki_revisions.py) ran git for every revision, against (2)
+# digobs.RevisionRows, and checks that both write the same tsv.
+#
+# The batches come from a file of recorded API responses, one JSON object
+# per line like the json output of fetch_revisions.py, or are made up if
+# no file is given.
+#
+###############################################################################
+
+import argparse
+import io
+import json
+import random
+import time
+from csv import DictWriter
+from requests import Request
+import digobs
+
+tsv_fields = ['title', 'pageid', 'namespace', 'revid', 'timestamp', 'user', 'userid', 'size', 'sha1',
+              'contentmodel', 'anon', 'minor', 'url', 'export_timestamp', 'export_commit']
+
+def made_up_batches(revisions, revisions_per_page=500):
+    revid = 900000000
+    batches = []
+    for pageid in range(revisions // revisions_per_page + 1):
+        revs = []
+        for i in range(min(revisions_per_page, revisions - pageid * revisions_per_page)):
+            revid = revid + random.randint(1, 1000)
+            rev = {'revid' : revid,
+                   'parentid' : revid - 1,
+                   'timestamp' : "2020-04-01T12:00:00Z",
+                   'user' : f"Editor {random.randint(1, 200)}",
+                   'userid' : random.randint(1, 10000000),
+                   'size' : random.randint(1000, 200000),
+                   'sha1' : f"{random.getrandbits(160):040x}",
+                   'slots' : {'main' : {'contentmodel' : 'wikitext'}},
+                   'comment' : "copyedit",
+                   'tags' : []}
+            if random.random() < 0.1:
+                rev['anon'] = ''
+            if random.random() < 0.3:
+                rev['minor'] = ''
+            revs.append(rev)
+        if revs:
+            title = f"COVID-19 pandemic in place {pageid} (2020–21)"
+            batches.append({'query' : {'pages' : {str(pageid) : {'pageid' : pageid, 'ns' : 0, 'title' : title, 'revisions' : revs}}}})
+    return batches
+
+# how rows were built before RevisionRows
+def old_write_batch(batch, project, export_info, tsv_writer, git_per_revision):
+    for page in batch.get('query',dict()).get('pages',dict()).values():
+        for rev in page.get('revisions',[]):
+            rev = dict(rev)
+            if "sha1" not in rev:
+                rev["sha1"] = ""
+            if "userhidden" in rev:
+                rev["user"] = ""
+                rev["userid"] = ""
+            rev["anon"] = "anon" in rev
+            rev["minor"] = "minor" in rev
+            rev['title'] = page.get('title','')
+            rev['pageid'] = page.get('pageid',None)
+            rev['namespace'] = page.get('ns',None)
+            rev['contentmodel'] = rev['slots']['main']['contentmodel']
+            rev['url'] = Request('GET', f'https://{project}.org/w/index.php',
+                                 params={'title' : rev['title'].replace(" ", "_"),
+                                         'oldid' : rev['revid']}).prepare().url
+            rev['export_timestamp'] = export_info['export_timestamp']
+            rev['export_commit'] = digobs.git_hash(short=True) if git_per_revision else export_info['export_commit']
+            tsv_writer.writerow({k: rev[k] for k in tsv_fields})
+
+def time_writes(write_batch, batches, repeat):
+    best = None
+    for i in range(repeat):
+        output = io.StringIO()
+        start = time.perf_counter()
+        write_batch(batches, output)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, output.getvalue())
+
+def main():
+    parser = argparse.ArgumentParser(description='Time building revision tsv rows the old way and with digobs.RevisionRows.')
+    parser.add_argument('-i', '--input_file', help='Recorded API responses, one JSON object per line. Default: made up batches.', type=str, default=None)
+    parser.add_argument('-n', '--revisions', help='Number of made up revisions. Default: 20000.', type=int, default=20000)
+    parser.add_argument('-r', '--repeat', help='Times to run each, keeping the fastest. Default: 3.', type=int, default=3)
+    parser.add_argument('--git_per_revision', help='Run git for every revision in the old way, as fetch_enwiki_revisions.py did. Slow.', action='store_true')
+    parser.add_argument('--project', help='Project the revisions are from. Default: en.wikipedia.', type=str, default='en.wikipedia')
+    args = parser.parse_args()
+
+    if args.input_file:
+        with open(args.input_file, 'r') as infile:
+            batches = [json.loads(line) for line in infile if line.strip()]
+    else:
+        batches = made_up_batches(args.revisions)
+
+    rows = sum(len(page.get('revisions',[])) for batch in batches for page in batch.get('query',dict()).get('pages',dict()).values())
+
+    export_time = "2020-04-01 00:00:00.000000"
+    tsv_export_info, json_export_info = digobs.export_metadata(export_time)
+
+    def old_way(batches, output):
+        tsv_writer = DictWriter(output, fieldnames=tsv_fields, delimiter="\t")
+        for batch in batches:
+            old_write_batch(batch, args.project, tsv_export_info, tsv_writer, args.git_per_revision)
+
+    def new_way(batches, output):
+        tsv_writer = DictWriter(output, fieldnames=tsv_fields, delimiter="\t", extrasaction='ignore')
+        revision_rows = digobs.RevisionRows(args.project, tsv_fields, tsv_export_info)
+        for batch in batches:
+            revision_rows.write_batch(batch, tsv_writer)
+
+    old_time, old_output = time_writes(old_way, batches, args.repeat)
+    new_time, new_output = time_writes(new_way, batches, args.repeat)
+
+    print(f"{rows} revisions in {len(batches)} batches")
+    print(f"old:          {rows / old_time:12.0f} rows/sec")
+    print(f"RevisionRows: {rows / new_time:12.0f} rows/sec ({old_time / new_time:.1f}x)")
+    print(f"same output:  {old_output == new_output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
-from requests import Request
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, quote_plus, urlparse
 import sys
+import argparse
+import atexit
+import io
+import lzma
 import subprocess
+import shutil
 import logging
+import zlib
 import itertools
+import threading
+import time
 import requests
 from functools import partial
-from csv import DictWriter
+from csv import DictWriter, DictReader
+from os import path, fsync, makedirs, replace
 import json
+import sqlite3
 import mwapi as api
+from digobs_common import http_cache
+from digobs_common.rate_limit import TokenBucket, RetryBudget, RateLimiter, LimitedSession, retry_after_seconds, retry_statuses, response_size
 
 user_agent = "COVID-19 Digital Observatory, a Community Data Science Collective project. (https://github.com/CommunityDataScienceCollective/COVID-19_Digital_Observatory)"
 
@@ -17,7 +32,7 @@ def git_hash(short=False):
     if short:
         return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
     else:
-        subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
 
 
 def init_logging(args):
@@ -35,35 +50,328 @@ def init_logging(args):
     logging.info(f"Last commit: {export_git_hash}")
     return(logging)
 
-def call_view_api(page, project, query_date):
-    url= f"https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/{project}/all-access/all-agents/{page}/daily/{query_date}00/{query_date}00"
-    response = requests.get(url)
+# where the APIs live. Both can be pointed somewhere else, e.g. at
+# mock_wikimedia_server.py for benchmarking.
+view_api_url = "https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article"
+api_url = "https://{project}.org/w/api.php"
+
+# Upper bounds (in seconds) of the buckets in the request latency
+# histograms, like a Prometheus histogram's.
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# The API endpoint a URL belongs to, for grouping requests. Pageview URLs
+# name the article and dates, so only the project is kept from those.
+def endpoint_name(url):
+    parsed = urlparse(url)
+    endpoint, found, rest = parsed.path.partition('/per-article/')
+    if found:
+        endpoint = endpoint + found + rest.split('/')[0]
+    return parsed.netloc + endpoint
+
+# Telemetry for a run. For each API endpoint it keeps a histogram of
+# request latencies, the bytes downloaded, retries, requests given up on
+# and a breakdown of the status codes (or exceptions) of every attempt,
+# which the RateLimiter records for every request. For each stage of a
+# run, optionally per project, it keeps how long it took and how many
+# rows it wrote. write() saves all of it as JSON, or as a Prometheus
+# textfile if the filename ends in .prom.
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.clock = time.monotonic()
+        self.complete = False
+        self.endpoints = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def endpoint(self, url):
+        name = endpoint_name(url)
+        if name not in self.endpoints:
+            self.endpoints[name] = {'requests' : 0,
+                                    'bytes' : 0,
+                                    'retries' : 0,
+                                    'given_up' : 0,
+                                    'statuses' : {},
+                                    'latency_sum' : 0.0,
+                                    'latency_buckets' : [0] * (len(latency_buckets) + 1)}
+        return self.endpoints[name]
+
+    # status is the HTTP status code, or the name of the exception if the
+    # request didn't get a response
+    def record_request(self, url, seconds, status, size=0):
+        bucket = next((i for i, bound in enumerate(latency_buckets) if seconds <= bound), len(latency_buckets))
+        with self.lock:
+            endpoint = self.endpoint(url)
+            endpoint['requests'] = endpoint['requests'] + 1
+            endpoint['bytes'] = endpoint['bytes'] + size
+            endpoint['statuses'][str(status)] = endpoint['statuses'].get(str(status), 0) + 1
+            endpoint['latency_sum'] = endpoint['latency_sum'] + seconds
+            endpoint['latency_buckets'][bucket] = endpoint['latency_buckets'][bucket] + 1
+
+    def record_retry(self, url):
+        with self.lock:
+            endpoint = self.endpoint(url)
+            endpoint['retries'] = endpoint['retries'] + 1
+
+    def record_give_up(self, url):
+        with self.lock:
+            endpoint = self.endpoint(url)
+            endpoint['given_up'] = endpoint['given_up'] + 1
+
+    def stage_entry(self, name, project):
+        if (name, project) not in self.stages:
+            self.stages[(name, project)] = {'seconds' : 0.0, 'runs' : 0, 'rows' : 0}
+        return self.stages[(name, project)]
+
+    # times the code inside it as a stage of the run. A stage that runs
+    # more than once (e.g. for each segment) adds up.
+    @contextmanager
+    def stage(self, name, project=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                stage = self.stage_entry(name, project)
+                stage['seconds'] = stage['seconds'] + seconds
+                stage['runs'] = stage['runs'] + 1
+
+    def add_rows(self, name, rows, project=None):
+        with self.lock:
+            stage = self.stage_entry(name, project)
+            stage['rows'] = stage['rows'] + rows
+
+    # marks the run as having got to the end, rather than failing part way
+    def finish(self):
+        self.complete = True
+
+    def summary(self, job=None):
+        with self.lock:
+            run_seconds = time.monotonic() - self.clock
+            endpoints = {}
+            for name, endpoint in sorted(self.endpoints.items()):
+                endpoint = dict(endpoint, statuses=dict(endpoint['statuses']), latency_buckets=list(endpoint['latency_buckets']))
+                endpoint['mean_latency'] = endpoint['latency_sum'] / endpoint['requests'] if endpoint['requests'] else None
+                endpoint['latency_buckets'] = dict(zip([str(bound) for bound in latency_buckets] + ['+Inf'],
+                                                       itertools.accumulate(endpoint['latency_buckets'])))
+                endpoints[name] = endpoint
+
+            stages = []
+            for (name, project), stage in sorted(self.stages.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                seconds = stage['seconds'] or run_seconds
+                stages.append(dict(stage, stage=name, project=project,
+                                   rows_per_sec=stage['rows'] / seconds if seconds else None))
+
+        return {'job' : job,
+                'started' : datetime.fromtimestamp(self.started, tz=timezone.utc).isoformat(),
+                'run_seconds' : run_seconds,
+                'complete' : self.complete,
+                'requests' : sum(endpoint['requests'] for endpoint in endpoints.values()),
+                'bytes' : sum(endpoint['bytes'] for endpoint in endpoints.values()),
+                'retries' : sum(endpoint['retries'] for endpoint in endpoints.values()),
+                'http_cache' : http_cache.shared.stats() if http_cache.shared is not None else None,
+                'endpoints' : endpoints,
+                'stages' : stages}
+
+    # Writes the metrics to a temporary file that then replaces filename,
+    # so whatever reads the sidecar never sees half of one.
+    def write(self, filename, job=None):
+        summary = self.summary(job)
+        folder = path.dirname(filename)
+        if folder:
+            makedirs(folder, exist_ok=True)
+
+        with open(filename + '.tmp', 'w') as outfile:
+            if filename.endswith('.prom'):
+                outfile.write(prometheus_text(summary))
+            else:
+                json.dump(summary, outfile, indent=2)
+                outfile.write('\n')
+        replace(filename + '.tmp', filename)
+        logging.info(f"Wrote run metrics to {filename}")
+
+    # writes the metrics when the script exits, even if it fails part way
+    def write_at_exit(self, filename, job=None):
+        atexit.register(self.write, filename, job)
+
+def prometheus_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items() if value is not None) + '}'
+
+# The summary of a run in the Prometheus text format, for the node
+# exporter's textfile collector.
+def prometheus_text(summary):
+    job = summary['job']
+    lines = ["# TYPE digobs_run_seconds gauge",
+             f"digobs_run_seconds{prometheus_labels(job=job)} {summary['run_seconds']}",
+             "# TYPE digobs_run_start_timestamp_seconds gauge",
+             f"digobs_run_start_timestamp_seconds{prometheus_labels(job=job)} {datetime.fromisoformat(summary['started']).timestamp()}",
+             "# TYPE digobs_run_complete gauge",
+             f"digobs_run_complete{prometheus_labels(job=job)} {int(summary['complete'])}"]
+
+    lines.append("# TYPE digobs_request_duration_seconds histogram")
+    for name, endpoint in summary['endpoints'].items():
+        for bound, count in endpoint['latency_buckets'].items():
+            lines.append(f"digobs_request_duration_seconds_bucket{prometheus_labels(job=job, endpoint=name, le=bound)} {count}")
+        lines.append(f"digobs_request_duration_seconds_sum{prometheus_labels(job=job, endpoint=name)} {endpoint['latency_sum']}")
+        lines.append(f"digobs_request_duration_seconds_count{prometheus_labels(job=job, endpoint=name)} {endpoint['requests']}")
+
+    for metric, key in [('digobs_request_bytes_total', 'bytes'),
+                        ('digobs_request_retries_total', 'retries'),
+                        ('digobs_requests_given_up_total', 'given_up')]:
+        lines.append(f"# TYPE {metric} counter")
+        for name, endpoint in summary['endpoints'].items():
+            lines.append(f"{metric}{prometheus_labels(job=job, endpoint=name)} {endpoint[key]}")
+
+    lines.append("# TYPE digobs_requests_total counter")
+    for name, endpoint in summary['endpoints'].items():
+        for status, count in sorted(endpoint['statuses'].items()):
+            lines.append(f"digobs_requests_total{prometheus_labels(job=job, endpoint=name, status=status)} {count}")
+
+    if summary['http_cache'] is not None:
+        lines.append("# TYPE digobs_http_cache_total counter")
+        for result in ('hits', 'misses', 'revalidated', 'stored', 'evicted'):
+            lines.append(f"digobs_http_cache_total{prometheus_labels(job=job, result=result)} {summary['http_cache'][result]}")
+        lines.append("# TYPE digobs_http_cache_bytes gauge")
+        lines.append(f"digobs_http_cache_bytes{prometheus_labels(job=job)} {summary['http_cache']['size']}")
+
+    for metric, key in [('digobs_stage_seconds', 'seconds'),
+                        ('digobs_stage_rows_total', 'rows')]:
+        lines.append(f"# TYPE {metric} {'gauge' if key == 'seconds' else 'counter'}")
+        for stage in summary['stages']:
+            lines.append(f"{metric}{prometheus_labels(job=job, stage=stage['stage'], project=stage['project'])} {stage[key]}")
+
+    return '\n'.join(lines) + '\n'
+
+# Where a run's metrics go by default: next to the logs the cron jobs
+# keep in wikipedia/logs.
+def metrics_filename(job, date):
+    return path.join("wikipedia/logs", f"{job.replace(' ', '_').replace('/', '-')}-{date}.metrics.json")
+
+metrics = Metrics()
+
+# Requests per second allowed to each host. The pageview API allows 100
+# per second, the action API has no hard limit but asks clients to be gentle.
+rate_limits = {'wikimedia.org' : 100}
+default_rate_limit = 25
+
+# every request the fetchers make goes through this, unless they are
+# given a limiter of their own
+rate_limiter = RateLimiter(rate_limits, default_rate_limit, metrics=metrics)
+
+# The Wikipedia scripts' HTTP response cache lives in wikipedia/data
+# wherever they are run from, so the cron jobs share it. Each script turns
+# it on in main(), with http_cache.configure, so importing digobs leaves
+# the cache alone.
+http_cache_folder = path.join(path.dirname(path.abspath(__file__)), '..', 'data', 'http_cache')
+
+# A LimitedSession through limiter, or the shared rate_limiter, so the
+# revision fetchers share the same limits as the view fetchers.
+def get_http_session(pool_size=10, limiter=None, cache=None):
+    session = LimitedSession(limiter if limiter is not None else rate_limiter, cache=cache)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent' : user_agent})
+    return session
+
+# Parses a shard given as "i/N" (counting from 0) for argparse.
+def parse_shard(shard):
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shards look like i/N, not {shard}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard {index} is not one of 0 to {count - 1}")
+    return (index, count)
+
+# Whether key belongs to shard, an (i, N) pair, or None for no sharding.
+# crc32 gives the same answer on every machine and every run, unlike hash().
+def in_shard(key, shard):
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(key.encode()) % count == index
+
+# The key pages are sharded on. Titles can't contain "|", so neither part
+# can run into the other.
+def shard_key(project, title):
+    return f"{project}|{title}"
+
+# Keeps the pages (or other units of work) of project that belong to
+# shard. Also returns where each one was in the whole list, which is the
+# order merge_shards.py puts the shards' output back in. Shard after
+# resolving titles, so a page listed under two names is only fetched by
+# one shard.
+def shard_pages(project, pages, shard):
+    positions = {page : position for position, page in enumerate(pages) if in_shard(shard_key(project, page), shard)}
+    return (list(positions), positions)
+
+# Goes into the names of a shard's output files, before the extension,
+# so shards can share a folder and merge_shards.py can find them.
+def shard_suffix(shard):
+    if shard is None:
+        return ""
+    return f".shard{shard[0]}of{shard[1]}"
+
+# Returns the list of daily view items for page between start_date and
+# end_date (inclusive, YYYYMMDD), or None if the API call failed.
+def get_view_items(page, project, start_date, end_date, session=None):
+    if session is None:
+        session = get_http_session()
+
+    page = quote(page.replace(' ', '_'), safe='')
+    url= f"{view_api_url}/{project}/all-access/all-agents/{page}/daily/{start_date}00/{end_date}00"
+    response = session.get(url)
     if response.ok:
-        return response.json().get('items',[None])[0]
+        return response.json().get('items',[])
 
     else:
         logging.warning(f"Failure: {response.status_code} from {url}")
-        print(response.json().get("detail",None))
         return None
 
-# This function writes out the view data to a json file (j_outfile)
-# and a tsv file (t_outfile), keeps track of failures,
-# and returns the number of successes and failures
-def process_view_responses(responses, j_outfile, t_outfile, logging = None):
-    
-    failures = len(list(itertools.takewhile(lambda r: r is None, responses)))
-    successes = 1
+def call_view_api(page, project, query_date, session=None):
+    items = get_view_items(page, project, query_date, query_date, session=session)
+    if items:
+        return items[0]
+    else:
+        return None
 
-    try:
-        first_response = next(responses)
-    except StopIteration:
-        logging.error("No valid responses")
-        exit()
+# Works like map(func, items) but runs up to concurrency calls at a time
+# on a thread pool. Results are yielded in input order, and at most
+# 2 * concurrency calls are in flight or waiting to be consumed.
+def map_concurrent(func, items, concurrency=10):
+    if concurrency <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * concurrency:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
 
-    dw = DictWriter(t_outfile, sorted(first_response.keys()), delimiter='\t')
-    dw.writeheader()
-    json.dump(first_response, j_outfile)
-    dw.writerow(first_response)
+# Fetch the view data for each page, keeping up to concurrency requests
+# open over a shared pool of keep-alive connections.
+def fetch_views(pages, project, query_date, concurrency=10):
+    session = get_http_session(pool_size=concurrency)
+    call_api = partial(call_view_api, project=project, query_date=query_date, session=session)
+    return map_concurrent(call_api, pages, concurrency=concurrency)
+
+# This function writes out the view data to a json file (j_outfile)
+# and a tsv file (t_outfile), and to a ColumnarWriter (c_writer) if we
+# have one, keeps track of failures,
+# and returns the number of successes and failures
+def process_view_responses(responses, j_outfile, t_outfile, logging = None, c_writer = None):
+    successes = 0
+    failures = 0
+    dw = None
 
     for response in responses:
         if response is None:
@@ -72,14 +380,526 @@ def process_view_responses(responses, j_outfile, t_outfile, logging = None):
         else:
             successes = successes + 1
 
+        # start writing the TSV file once we know the fields
+        if dw is None:
+            dw = DictWriter(t_outfile, sorted(response.keys()), delimiter='\t')
+            # a resumed file already has its header
+            if t_outfile.tell() == 0:
+                dw.writeheader()
+
         if logging is not None:
             logging.debug(f"printing data: {response}")
 
-        json.dump(response, j_outfile)
+        print(json.dumps(response), file=j_outfile)
         dw.writerow(response)
+        if c_writer is not None:
+            c_writer.writerow(response)
+
+    if dw is None and logging is not None:
+        logging.error("No valid responses")
 
     return (successes,failures)
         
+# Returns every date from start_date to end_date (inclusive) in YYYYMMDD format.
+def date_range(start_date, end_date):
+    start = datetime.strptime(start_date, "%Y%m%d")
+    end = datetime.strptime(end_date, "%Y%m%d")
+    return [(start + timedelta(days=i)).strftime("%Y%m%d") for i in range((end - start).days + 1)]
+
+# Fetch the view data for each page over a range of dates with one request
+# per page. Yields a list of daily items (or None on failure) for each page.
+def fetch_view_range(pages, project, start_date, end_date, concurrency=10):
+    session = get_http_session(pool_size=concurrency)
+    call_api = partial(get_view_items, project=project, start_date=start_date, end_date=end_date, session=session)
+    return map_concurrent(call_api, pages, concurrency=concurrency)
+
+# Like process_view_responses, but splits the responses from
+# fetch_view_range into one json and tsv file per day. outfiles maps each
+# date (YYYYMMDD) to a (j_outfile, t_outfile, c_writer) triple, where
+# c_writer is a ColumnarWriter or None. A page with no item for
+# a date counts as a failure for that date, just as a single day request
+# would have. Returns a dictionary of (successes, failures) by date.
+def process_view_range_responses(responses, outfiles, logging = None):
+    counts = {date : (0, 0) for date in outfiles}
+    writers = {}
+
+    for items in responses:
+        items_by_date = {item['timestamp'][:8] : item for item in items or []}
+
+        for date, (j_outfile, t_outfile, c_writer) in outfiles.items():
+            successes, failures = counts[date]
+            response = items_by_date.get(date, None)
+            if response is None:
+                counts[date] = (successes, failures + 1)
+                continue
+            else:
+                counts[date] = (successes + 1, failures)
+
+            if date not in writers:
+                writers[date] = DictWriter(t_outfile, sorted(response.keys()), delimiter='\t')
+                if t_outfile.tell() == 0:
+                    writers[date].writeheader()
+
+            if logging is not None:
+                logging.debug(f"printing data: {response}")
+
+            print(json.dumps(response), file=j_outfile)
+            writers[date].writerow(response)
+            if c_writer is not None:
+                c_writer.writerow(response)
+
+    if logging is not None:
+        for date in outfiles:
+            if date not in writers:
+                logging.error(f"No valid responses for {date}")
+
+    return counts
+
+# command lines for the compressors we can stream output into. They read
+# from stdin and the threads argument is filled in from open_output.
+compressors = {'xz' : (['xz', '--compress', '--stdout', '--threads={threads}'], '.xz'),
+               'zstd' : (['zstd', '--compress', '--stdout', '--quiet', '-T{threads}'], '.zst')}
+
+# Opens filename for writing text, optionally compressing it as it is
+# written by piping it through xz or zstd, so that the uncompressed data
+# never touches the disk. The compression suffix is added to filename.
+# threads=0 uses every core. The output is an ordinary .xz or .zst file
+# that decompresses to exactly the bytes we would have written
+# uncompressed.
+@contextmanager
+def open_output(filename, compression=None, threads=0):
+    if compression is None:
+        with open(filename, 'w') as outfile:
+            yield outfile
+        return
+
+    command, suffix = compressors[compression]
+    command = [arg.format(threads=threads) for arg in command]
+
+    with open(filename + suffix, 'wb') as raw_output:
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=raw_output)
+        except FileNotFoundError:
+            if compression != 'xz':
+                raise
+            # fall back to python's own (single threaded) xz
+            logging.warning(f"Warning: xz not found, compressing {filename} without threads")
+            with lzma.open(raw_output, 'wt', encoding='utf-8') as outfile:
+                yield outfile
+            return
+
+        outfile = io.TextIOWrapper(process.stdin, encoding='utf-8')
+        try:
+            yield outfile
+        finally:
+            outfile.close()
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, command)
+
+# Text output that is committed to its file a segment at a time: write()
+# sends text to the file as it comes, and flush() ends the segment, syncs
+# the file to disk, and returns its new length. The file is first cut
+# back to size bytes, which drops anything a failed run wrote after its
+# last commit, and close() does the same for a segment that never got
+# flushed. When compressed, each segment goes through a compressor of its
+# own and is a complete xz or zstd stream; a stream can't be picked up
+# again part way through, but xz and zstd read a file of several streams
+# back as if it were one.
+class SegmentOutput:
+    def __init__(self, filename, size=0, compression=None, threads=0):
+        if compression is not None:
+            filename = filename + compressors[compression][1]
+
+        self.filename = filename
+        self.compression = compression
+        self.threads = threads
+        self.file = open(filename, 'r+b' if path.exists(filename) else 'wb')
+        self.file.truncate(size)
+        self.file.seek(size)
+        self.size = size
+        # bytes of text in the current segment
+        self.pending = 0
+        self.process = None
+        self.compressor = None
+        # lines written by this run, for ShardIndex
+        self.lines = 0
+
+        # fall back to python's own (single threaded) xz
+        self.use_lzma = compression == 'xz' and shutil.which(compressors['xz'][0][0]) is None
+        if self.use_lzma:
+            logging.warning(f"Warning: xz not found, compressing {filename} without threads")
+
+    def start_segment(self):
+        if self.use_lzma:
+            self.compressor = lzma.LZMACompressor()
+        else:
+            command = [arg.format(threads=self.threads) for arg in compressors[self.compression][0]]
+            self.file.flush()
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.file)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.lines = self.lines + text.count('\n')
+        if self.compression is None:
+            self.file.write(data)
+        else:
+            if self.process is None and self.compressor is None:
+                self.start_segment()
+            if self.process is not None:
+                self.process.stdin.write(data)
+            else:
+                self.file.write(self.compressor.compress(data))
+        self.pending = self.pending + len(data)
+        return len(text)
+
+    # zero only if nothing has been written, by this run or the one it resumes
+    def tell(self):
+        return self.size + self.pending
+
+    def flush(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise subprocess.CalledProcessError(self.process.returncode, self.process.args)
+            self.process = None
+            # the compressor wrote behind our back
+            self.file.seek(0, io.SEEK_END)
+        elif self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+
+        if self.pending > 0:
+            self.file.flush()
+            fsync(self.file.fileno())
+            self.size = self.file.tell()
+            self.pending = 0
+        return self.size
+
+    # anything not flushed is dropped
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process = None
+        self.compressor = None
+        self.file.truncate(self.size)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Records the units of work, (project, title, date), that a job has
+# finished, along with the length each of its SegmentOutputs had at that
+# point. Units and output are committed together, so if the job dies,
+# running it again with resume=True cuts its files back to the last
+# commit and lets it skip every unit that made it in. A job that got to
+# finish() isn't resumed; the next run starts it over.
+class RunJournal:
+    def __init__(self, db_path, job, resume=False):
+        self.job = job
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS journal_jobs (
+                               job TEXT PRIMARY KEY,
+                               settings TEXT NOT NULL,
+                               started TEXT NOT NULL,
+                               finished TEXT);""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS journal_units (
+                               job TEXT NOT NULL,
+                               project TEXT NOT NULL,
+                               title TEXT NOT NULL,
+                               date TEXT NOT NULL,
+                               PRIMARY KEY (job, project, title, date));""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS journal_outputs (
+                               job TEXT NOT NULL,
+                               filename TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               PRIMARY KEY (job, filename));""")
+        self.conn.commit()
+
+        row = self.conn.execute("SELECT settings, finished FROM journal_jobs WHERE job = ?;", (job,)).fetchone()
+        self.resuming = resume and row is not None and row[1] is None
+
+        if self.resuming:
+            self.settings = json.loads(row[0])
+            self.completed = set(self.conn.execute("SELECT project, title, date FROM journal_units WHERE job = ?;", (job,)))
+            self.sizes = dict(self.conn.execute("SELECT filename, size FROM journal_outputs WHERE job = ?;", (job,)))
+            logging.info(f"resuming {job} with {len(self.completed)} units already done")
+        else:
+            self.settings = {}
+            self.completed = set()
+            self.sizes = {}
+            with self.conn:
+                for table in ('journal_jobs', 'journal_units', 'journal_outputs'):
+                    self.conn.execute(f"DELETE FROM {table} WHERE job = ?;", (job,))
+                self.conn.execute("INSERT INTO journal_jobs (job, settings, started) VALUES (?, ?, ?);",
+                                  (job, '{}', str(datetime.now())))
+
+    # returns the value the setting had when the job started, so that a
+    # resumed job writes to the same files even if, say, "yesterday" has
+    # moved on since
+    def setting(self, name, value):
+        with self.lock:
+            if name not in self.settings:
+                self.settings[name] = value
+                with self.conn:
+                    self.conn.execute("UPDATE journal_jobs SET settings = ? WHERE job = ?;",
+                                      (json.dumps(self.settings), self.job))
+            return self.settings[name]
+
+    def done(self, project, title, date=''):
+        return (project, title, date) in self.completed
+
+    def open_output(self, filename, compression=None, threads=0):
+        if compression is not None:
+            size = self.sizes.get(filename + compressors[compression][1], 0)
+        else:
+            size = self.sizes.get(filename, 0)
+        return SegmentOutput(filename, size, compression, threads)
+
+    # writes out what is pending in outputs, then marks units as done
+    def commit(self, units, outputs):
+        sizes = [(self.job, output.filename, output.flush()) for output in outputs]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO journal_units (job, project, title, date) VALUES (?, ?, ?, ?);",
+                                      [(self.job, project, title, date) for project, title, date in units])
+                self.conn.executemany("INSERT OR REPLACE INTO journal_outputs (job, filename, size) VALUES (?, ?, ?);",
+                                      sizes)
+            self.completed.update(units)
+
+    def finish(self):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE journal_jobs SET finished = ? WHERE job = ?;", (str(datetime.now()), self.job))
+
+    def close(self):
+        self.conn.close()
+
+# For a sharded run, records how many lines each unit of work wrote to
+# each output, in an .index file next to the output (without any
+# compression suffix). Each line is "position<TAB>lines" for a unit that
+# wrote something, where position is where its page was in the whole,
+# unsharded list (see shard_pages). merge_shards.py uses these to put the
+# shards back together in the order a single run would have written.
+# A tsv header isn't part of any unit, even when it is written along with
+# the first row. The index files are journal outputs too, so a resumed
+# run keeps them in step with the outputs they describe.
+class ShardIndex:
+    def __init__(self, journal, outputs, positions):
+        self.positions = positions
+        self.indexes = []
+        for output in outputs:
+            filename = output.filename
+            if output.compression is not None:
+                filename = filename[:-len(compressors[output.compression][1])]
+            self.indexes.append((output, journal.open_output(filename + '.index')))
+        self.outputs = [index for _, index in self.indexes]
+        self.marks = []
+
+    def mark(self):
+        self.marks = [(output.lines, output.tell() == 0) for output, _ in self.indexes]
+
+    def record(self, title):
+        position = self.positions[title]
+        for (output, index), (lines, empty) in zip(self.indexes, self.marks):
+            lines = output.lines - lines
+            if empty and lines > 0 and output.filename.endswith('.tsv'):
+                lines = lines - 1
+            if lines > 0:
+                index.write(f"{position}\t{lines}\n")
+
+    def close(self):
+        for index in self.outputs:
+            index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Passes items through from (units, item) pairs, and commits outputs to
+# the journal every segment_size items, once the items before have been
+# written. after_commit, if given, is called after each commit. A
+# ShardIndex, if given, records what each item wrote and is committed
+# along with the outputs.
+def journal_segments(pairs, journal, outputs, segment_size=1000, after_commit=None, index=None):
+    if index is not None:
+        outputs = outputs + index.outputs
+
+    units = []
+    items = 0
+    for item_units, item in pairs:
+        if items >= segment_size:
+            journal.commit(units, outputs)
+            if after_commit is not None:
+                after_commit()
+            units = []
+            items = 0
+
+        if index is not None:
+            index.mark()
+        yield item
+        if index is not None:
+            index.record(item_units[0][1])
+        units.extend(item_units)
+        items = items + 1
+
+    journal.commit(units, outputs)
+    if after_commit is not None:
+        after_commit()
+
+# Column types for the columnar outputs. Titles and the other columns
+# that repeat a few values many times are dictionary encoded.
+view_columns = {'access' : 'dictionary',
+                'agent' : 'dictionary',
+                'article' : 'dictionary',
+                'granularity' : 'dictionary',
+                'project' : 'dictionary',
+                'timestamp' : 'hour',
+                'views' : 'int64'}
+
+revision_columns = {'title' : 'dictionary',
+                    'pageid' : 'int64',
+                    'namespace' : 'int32',
+                    'revid' : 'int64',
+                    'timestamp' : 'timestamp',
+                    'user' : 'dictionary',
+                    'userid' : 'int64',
+                    'size' : 'int64',
+                    'sha1' : 'string',
+                    'contentmodel' : 'dictionary',
+                    'anon' : 'bool',
+                    'minor' : 'bool',
+                    'url' : 'string',
+                    'export_timestamp' : 'dictionary',
+                    'export_commit' : 'dictionary'}
+
+# Converts the values we write to the tsv into the column's type. Missing
+# values, and the empty strings we write for hidden users, become nulls.
+def _columnar_value(kind, value):
+    if value is None or value == '':
+        return None
+    elif kind in ('int64', 'int32'):
+        return int(value)
+    elif kind == 'bool':
+        # True and False come back from the tsv as strings
+        return value is True or value == 'True'
+    elif kind == 'hour':
+        return datetime.strptime(value, "%Y%m%d%H")
+    elif kind == 'timestamp':
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+    else:
+        return str(value)
+
+# Writes rows to a parquet or feather file as they arrive, row_group_size
+# rows at a time, so memory stays bounded and readers can load a subset
+# of row groups or columns. columns maps each column name to one of the
+# kinds in _columnar_value. It has the same writerow() as a DictWriter, so
+# it can go anywhere a tsv writer does. pyarrow is only needed when one of
+# these is created.
+class ColumnarWriter:
+    def __init__(self, filename, columns, format='parquet', row_group_size=100000):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.columns = columns
+        self.format = format
+        self.row_group_size = row_group_size
+        self.values = {name : [] for name in columns}
+        self.rows = 0
+
+        types = {'int64' : pa.int64(),
+                 'int32' : pa.int32(),
+                 'bool' : pa.bool_(),
+                 'hour' : pa.timestamp('s', tz='UTC'),
+                 'timestamp' : pa.timestamp('s', tz='UTC'),
+                 'string' : pa.string(),
+                 # feather files can't change dictionaries from one batch
+                 # to the next, so there we store plain strings
+                 'dictionary' : pa.dictionary(pa.int32(), pa.string()) if format == 'parquet' else pa.string()}
+
+        self.schema = pa.schema([(name, types[kind]) for name, kind in columns.items()])
+
+        if format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(filename, self.schema, compression='zstd')
+        elif format == 'feather':
+            self.writer = pa.ipc.new_file(filename, self.schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+        else:
+            raise ValueError(f"unknown columnar format: {format}")
+
+    def writerow(self, row):
+        for name, kind in self.columns.items():
+            self.values[name].append(_columnar_value(kind, row.get(name, None)))
+
+        self.rows = self.rows + 1
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if self.rows == 0:
+            return
+
+        arrays = []
+        for field in self.schema:
+            if self.pa.types.is_dictionary(field.type):
+                arrays.append(self.pa.array(self.values[field.name], self.pa.string()).dictionary_encode())
+            else:
+                arrays.append(self.pa.array(self.values[field.name], field.type))
+
+        batch = self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.format == 'parquet':
+            self.writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+        self.values = {name : [] for name in self.columns}
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Writes a columnar file with the rows of a tsv file. Columnar files can't
+# be added to, so a resumed job builds them from its tsv at the end.
+def tsv_to_columnar(tsv_filename, columnar_filename, columns, format='parquet'):
+    with open(tsv_filename, 'r', newline='') as tsv_file, \
+         ColumnarWriter(columnar_filename, columns, format=format) as writer:
+        for row in DictReader(tsv_file, delimiter='\t'):
+            writer.writerow(row)
+
+# Sends each row to every writer that isn't None, e.g. to a tsv and a
+# columnar writer at once.
+class RowWriters:
+    def __init__(self, *writers):
+        self.writers = [writer for writer in writers if writer is not None]
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def writerows(self, rows):
+        for writer in self.writers:
+            writer.writerows(rows)
+
 def get_loglevel(arg_loglevel):
     loglevel_mapping = { 'debug' : logging.DEBUG,
                          'info' : logging.INFO,
@@ -95,74 +915,386 @@ def get_loglevel(arg_loglevel):
         return logging.INFO
 
 
-def get_revisions_for_page(title, api_session, logging, rv_props):
-  
+# Remembers the newest revision we have exported for each page, so that
+# later runs only need to ask for revisions after it. Marks are kept in
+# memory until commit() is called, which should happen only once the
+# revisions they cover have been written out.
+class RevisionState:
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS revision_state (
+                               project TEXT NOT NULL,
+                               pageid INTEGER NOT NULL,
+                               title TEXT NOT NULL,
+                               last_revid INTEGER NOT NULL,
+                               updated TEXT NOT NULL,
+                               PRIMARY KEY (project, pageid));""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS revision_state_title ON revision_state (project, title);")
+        self.conn.commit()
+
+    # looks the page up by pageid when we know it, which survives page moves
+    def last_revid(self, project, title, pageid=None):
+        if pageid is not None:
+            row = self.conn.execute("SELECT last_revid FROM revision_state WHERE project = ? AND pageid = ?;",
+                                    (project, pageid)).fetchone()
+        else:
+            row = self.conn.execute("SELECT MAX(last_revid) FROM revision_state WHERE project = ? AND title = ?;",
+                                    (project, title.replace('_', ' '))).fetchone()
+        return row[0] if row is not None else None
+
+    def update(self, project, pageid, title, revid):
+        self.conn.execute("""INSERT INTO revision_state (project, pageid, title, last_revid, updated)
+                             VALUES (?, ?, ?, ?, ?)
+                             ON CONFLICT (project, pageid) DO UPDATE
+                             SET title = excluded.title,
+                                 last_revid = MAX(last_revid, excluded.last_revid),
+                                 updated = excluded.updated;""",
+                          (project, pageid, title, revid, str(datetime.now())))
+
+    def update_from_batch(self, project, batch):
+        for page in batch.get('query',dict()).get('pages',dict()).values():
+            revids = [rev['revid'] for rev in page.get('revisions',[]) if 'revid' in rev]
+            if revids:
+                self.update(project, page['pageid'], page['title'], max(revids))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# mwapi adds the path to api.php to the host itself
+def get_api_session(project):
+    url = urlparse(api_url.format(project=project))
+    return api.Session(f"{url.scheme}://{url.netloc}",
+                       api_path=url.path,
+                       user_agent=user_agent,
+                       session=get_http_session()
+                       )
+
+# Pulls every revision of title, or only those newer than start_id.
+# rvstartid is inclusive and must be an existing revision, so we ask
+# for start_id itself and drop it from the results.
+def get_revisions_for_page(title, api_session, logging, rv_props, start_id=None):
+
+    params = {}
+    if start_id is not None:
+        logging.debug(f"pulling revisions after {start_id} for: {title}")
+        params['rvstartid'] = start_id
+
     result = api_session.get(action='query',
                              prop='revisions',
-                             rvprop=rv_props.values(),
+                             rvprop=list(rv_props.values()),
                              titles = {title},
                              rvdir='newer',
                              rvslots='*',
-                             continuation=True)
-    return result
+                             continuation=True,
+                             **params)
+
+    if start_id is None:
+        return result
+    else:
+        return drop_old_revisions(result, start_id)
+
+def drop_old_revisions(batches, start_id):
+    for batch in batches:
+        for page in batch.get('query',dict()).get('pages',dict()).values():
+            if 'revisions' in page:
+                page['revisions'] = [rev for rev in page['revisions'] if rev['revid'] > start_id]
+        yield batch
+
+# Looks up titles batch_size at a time (50 per query, or 500 with
+# apihighlimits) and yields a (title, page) pair for each one, where page
+# has the pageid and lastrevid from prop=info, or is None if the title
+# could not be found. MediaWiki only returns whole histories for one page
+# at a time, but this lets us skip the pages that don't need a history
+# query at all.
+def get_pages_info(titles, api_session, batch_size=50):
+    titles = iter(titles)
+    batch = list(itertools.islice(titles, batch_size))
+    while len(batch) > 0:
+        normalized = {}
+        pages = {}
+        for result in api_session.get(action='query',
+                                      prop='info',
+                                      titles=batch,
+                                      continuation=True):
+            query = result.get('query',dict())
+            for norm in query.get('normalized',[]):
+                normalized[norm['from']] = norm['to']
+            for page in query.get('pages',dict()).values():
+                pages[page['title']] = page
+
+        for title in batch:
+            page = pages.get(normalized.get(title, title), None)
+            if page is None or 'missing' in page or 'invalid' in page:
+                yield (title, None)
+            else:
+                yield (title, page)
 
-def get_pages_revisions(titles, project, logging, rv_props):
+        batch = list(itertools.islice(titles, batch_size))
+
+# Pulls the revisions of each title, yielding a (title, batches) pair for
+# each one. If a RevisionState is given, pages we have seen before only
+# get revisions after the last one we exported, and pages with no new
+# revisions since then have no batches. Without one every history is
+# pulled whole, so there is nothing to gain from looking the pages up
+# first.
+def get_pages_revisions(titles, project, logging, rv_props, state=None, batch_size=50):
     logging.info(f"pulling revisions for: {project}")
 
-    api_session = api.Session(f"https://{project}.org/w/api.php",
-                              user_agent=user_agent
-                              )
+    api_session = get_api_session(project)
+
+    def get_revisions(title, page):
+        if page is None:
+            logging.warning(f"no page found for: {title}")
+            return []
+
+        start_id = state.last_revid(project, title, pageid=page['pageid']) if state is not None else None
+        if start_id is not None and page.get('lastrevid', 0) <= start_id:
+            logging.debug(f"no new revisions for: {title}")
+            return []
+
+        return get_revisions_for_page(page['title'], api_session = api_session, logging = logging, rv_props = rv_props, start_id = start_id)
     
-    return itertools.chain(* map(partial(get_revisions_for_page, api_session = api_session, logging = logging, rv_props = rv_props), titles))
+    if state is None:
+        for title in titles:
+            yield (title, get_revisions_for_page(title, api_session = api_session, logging = logging, rv_props = rv_props))
+        return
+
+    for title, page in get_pages_info(titles, api_session, batch_size):
+        yield (title, get_revisions(title, page))
+
+# Pulls the given revisions, batch_size at a time, for example to fill
+# in content for revisions that were first fetched without it.
+def get_revisions_by_id(revids, project, logging, rv_props, batch_size=50):
+    logging.info(f"pulling revisions by id for: {project}")
+
+    api_session = get_api_session(project)
+
+    revids = iter(revids)
+    batch = list(itertools.islice(revids, batch_size))
+    while len(batch) > 0:
+        yield from api_session.get(action='query',
+                                   prop='revisions',
+                                   rvprop=list(rv_props.values()),
+                                   revids=batch,
+                                   rvslots='*',
+                                   continuation=True)
+        batch = list(itertools.islice(revids, batch_size))
+
+# Follows normalization and redirects for titles, batch_size at a time,
+# and yields a (title, canonical) pair for each one, where canonical is
+# the title of the page the title ends up at, or None if there is no such
+# page.
+def query_canonical_titles(titles, api_session, batch_size=50):
+    titles = iter(titles)
+    batch = list(itertools.islice(titles, batch_size))
+    while len(batch) > 0:
+        moves = {}
+        found = set()
+        for result in api_session.get(action='query',
+                                      titles=batch,
+                                      redirects=True,
+                                      continuation=True):
+            query = result.get('query',dict())
+            for key in ('normalized', 'converted', 'redirects'):
+                for move in query.get(key,[]):
+                    moves[move['from']] = move['to']
+            for page in query.get('pages',dict()).values():
+                if 'missing' not in page and 'invalid' not in page:
+                    found.add(page['title'])
+
+        for title in batch:
+            # a title can be normalized and then redirected, so follow
+            # the chain, stopping if a redirect loops back on itself
+            canonical = title
+            seen = set()
+            while canonical in moves and canonical not in seen:
+                seen.add(canonical)
+                canonical = moves[canonical]
+            yield (title, canonical if canonical in found else None)
+
+        batch = list(itertools.islice(titles, batch_size))
+
+# Remembers where titles resolve to, so that the redirects and moved pages
+# in our page lists cost one batched query every ttl instead of a wasted
+# views or revisions call on every run. Safe to share between threads.
+class TitleResolver:
+    def __init__(self, db_path=None, ttl=timedelta(days=7)):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path if db_path is not None else ':memory:', check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS title_cache (
+                               project TEXT NOT NULL,
+                               title TEXT NOT NULL,
+                               canonical TEXT,
+                               updated TEXT NOT NULL,
+                               PRIMARY KEY (project, title));""")
+        self.conn.commit()
+
+    def cached(self, project, titles):
+        cutoff = (datetime.now(timezone.utc) - self.ttl).isoformat()
+        resolved = {}
+        with self.lock:
+            for title in titles:
+                row = self.conn.execute("SELECT canonical FROM title_cache WHERE project = ? AND title = ? AND updated >= ?;",
+                                        (project, title, cutoff)).fetchone()
+                if row is not None:
+                    resolved[title] = row[0]
+        return resolved
+
+    def store(self, project, resolved):
+        updated = datetime.now(timezone.utc).isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany("""INSERT OR REPLACE INTO title_cache (project, title, canonical, updated)
+                                     VALUES (?, ?, ?, ?);""",
+                                  [(project, title, canonical, updated) for title, canonical in resolved.items()])
+
+    # returns a (title, canonical) pair for each title, only asking the
+    # API about titles that aren't cached or have expired
+    def resolve(self, project, titles, api_session=None, batch_size=50):
+        titles = list(titles)
+        resolved = self.cached(project, titles)
+        stale = [title for title in dict.fromkeys(titles) if title not in resolved]
+        if len(stale) > 0:
+            if api_session is None:
+                api_session = get_api_session(project)
+            fetched = {}
+            try:
+                for title, canonical in query_canonical_titles(stale, api_session, batch_size):
+                    fetched[title] = canonical
+            finally:
+                # keep what we got, even if a later batch failed
+                self.store(project, fetched)
+            resolved.update(fetched)
+        return [(title, resolved[title]) for title in titles]
+
+    # the titles to actually fetch: canonical titles, each only once, in
+    # the order they first show up, and without pages that don't exist
+    def canonical_pages(self, project, titles, logging, api_session=None, batch_size=50):
+        titles = list(titles)
+        try:
+            resolved = self.resolve(project, titles, api_session, batch_size)
+        except (requests.exceptions.RequestException, api.errors.APIError, ValueError):
+            logging.exception(f"Warning: could not resolve titles on {project}, using them as they are")
+            resolved = [(title, title) for title in titles]
+
+        pages = []
+        seen = set()
+        for title, canonical in resolved:
+            if canonical is None:
+                logging.warning(f"no page found for: {title}")
+                continue
+            if canonical != title:
+                logging.debug(f"{title} resolves to {canonical}")
+            if canonical not in seen:
+                seen.add(canonical)
+                pages.append(canonical)
+
+        logging.info(f"resolved {len(titles)} titles to {len(pages)} pages on {project}")
+        return pages
+
+    def close(self):
+        self.conn.close()
+
+# the rvprops that the computed tsv fields are derived from
+derived_tsv_props = {'anon' : ['user'],
+                     'minor' : ['flags'],
+                     'url' : ['ids']}
+
+# Works out which rvprops are needed to write outputs. The json output
+# keeps everything, but a tsv-only run has no use for content (by far the
+# largest part of every response) or any other field dropped from the tsv.
+def required_rv_props(rv_props, tsv_fields, outputs):
+    if 'json' in outputs:
+        return dict(rv_props)
+
+    needed = set()
+    for field in tsv_fields:
+        if field in rv_props:
+            needed.add(rv_props[field])
+        needed.update(derived_tsv_props.get(field, []))
+
+    return {field : prop for field, prop in rv_props.items() if prop in needed}
 
 def rev_batch_to_json(rev, export_info, json_output = None):
     rev['exported'] = export_info
     if json_output is None:
         return json.dumps(rev)
     else:
-        json.dump(rev, json_output)
-
-def rev_batch_to_tsv(batch, tsv_fields, export_info, project, tsv_writer=None):
-    batch = batch.get('query',dict())
-    pages = batch.get('pages',dict())
-    for pageid, page in pages.items():
-        pageid = page.get('pageid',None)
-        ns = page.get('ns',None)
+        print(json.dumps(rev), file=json_output)
+
+# number of revisions in a batch of query results
+def batch_revision_count(batch):
+    return sum(len(page.get('revisions',[])) for page in batch.get('query',dict()).get('pages',dict()).values())
+
+# The export metadata for a run, which only needs working out once: the
+# fields added to each tsv row and the "exported" field of the json.
+def export_metadata(export_time):
+    tsv_export_info = {'export_timestamp' : export_time,
+                       'export_commit' : git_hash(short=True)}
+    json_export_info = {'git_commit' : git_hash(),
+                        'timestamp' : export_time}
+    return (tsv_export_info, json_export_info)
+
+# Turns revisions from the API into the rows of the tsv and columnar
+# outputs. Everything that is the same for every row (the export
+# timestamp and commit, the start of the URL) is worked out once here
+# rather than for each revision, and URLs are filled in from a template
+# instead of by preparing a request for every one.
+class RevisionRows:
+    def __init__(self, project, tsv_fields, export_info):
+        self.tsv_fields = tsv_fields
+        self.export_info = {'export_timestamp' : export_info['export_timestamp'],
+                            'export_commit' : export_info['export_commit']}
+        self.url_prefix = f"https://{project}.org/w/index.php?title="
+        self.url_title = None
+        self.url_start = None
+
+    # the same URL that requests would build from title and oldid params.
+    # Revisions come a page at a time, so the quoted title is kept until
+    # the title changes.
+    def url(self, title, revid):
+        if title != self.url_title:
+            self.url_title = title
+            self.url_start = self.url_prefix + quote_plus(title.replace(" ", "_")) + "&oldid="
+        return self.url_start + str(revid)
+
+    # page is the page the revision belongs to, with its title, pageid and ns
+    def row(self, rev, page):
         title = page.get('title','')
-        logging.info(f"pulling revisions for: {title}")
-        revs = page.get('revisions',[])
-        for rev in revs:
+        values = dict(self.export_info)
+        values['title'] = title
+        values['pageid'] = page.get('pageid',None)
+        values['namespace'] = page.get('ns',None)
 
-            # handle missing data
-            if "sha1" not in rev:
-                rev["sha1"] = ""
+        # handle missing data
+        values['sha1'] = rev.get('sha1','')
+        if 'userhidden' in rev:
+            values['user'] = ''
+            values['userid'] = ''
 
-            if "userhidden" in rev:
-                rev["user"] = ""
-                rev["userid"] = ""
+        # recode anon and minor so they're true or false instead of
+        # present/missing
+        values['anon'] = 'anon' in rev
+        values['minor'] = 'minor' in rev
 
-            # recode anon so it's true or false instead of present/missing
-            if "anon" in rev:
-                rev["anon"] = True
-            else:
-                rev["anon"] = False
+        if 'slots' in rev:
+            values['contentmodel'] = rev['slots']['main']['contentmodel']
 
-            # let's recode "minor" in the same way
-            if "minor" in rev:
-                rev["minor"] = True
-            else:
-                rev["minor"] = False
-
-            # add page title information
-            rev['title'] = title
-            rev['pageid'] = pageid
-            rev['namespace'] = ns
-            rev['contentmodel'] = rev['slots']['main']['contentmodel']
-            # construct a URL
-            rev['url'] = Request('GET', f'https://{project}.org/w/index.php',
-                                 params={'title' : rev['title'].replace(" ", "_"),
-                                         'oldid' : rev['revid']}).prepare().url
-
-            rev['export_timestamp'] = export_info['export_timestamp']
-            rev['export_commit'] = export_info['export_commit']
-            tsv_writer.writerow({k: rev[k] for k in tsv_fields})
+        values['url'] = self.url(title, rev['revid'])
+
+        return {field : values[field] if field in values else rev.get(field, None) for field in self.tsv_fields}
+
+    # rows for each revision in a batch of query results
+    def batch_rows(self, batch):
+        rows = []
+        for page in batch.get('query',dict()).get('pages',dict()).values():
+            logging.info(f"pulling revisions for: {page.get('title','')}")
+            for rev in page.get('revisions',[]):
+                rows.append(self.row(rev, page))
+        return rows
+
+    def write_batch(self, batch, writer):
+        writer.writerows(self.batch_rows(batch))
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 import argparse
-import sqlite3
-import requests
 from datetime import datetime, timedelta
 import logging
 import digobs
+from digobs_common import http_cache
+import pagelist
 from os import path, mkdir
-from functools import partial
-from itertools import chain
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 if __name__ == "__main__":
 
@@ -16,70 +16,177 @@ if __name__ == "__main__":
     parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel)
     parser.add_argument('-W', '--logging_destination', help='Logging destination file. (default: standard error)', type=argparse.FileType('a'))
     parser.add_argument('-d', '--query_date', help='Date if not yesterday, in YYYYMMDD format.', type=lambda s: datetime.strptime(s, "%Y%m%d"))
-
-    parser.add_argument('-i', '--input_file', help="Input a file of page names from the English Wikiproject.", type=argparse.FileType('r'), default='./wikipedia/resources/enwp_wikiproject_covid19_articles.txt')
-
-    parser.add_argument('-b', '--input_db', help="Input a path to a sqlite3 database from the real-time-covid-tracker project", type = sqlite3.connect, default='real-time-wiki-covid-tracker/AllWikidataItems.sqlite')
+    parser.add_argument('--start', help='First date of a range to fetch with one request per page, in YYYYMMDD format. Writes one set of files per day.', type=lambda s: datetime.strptime(s, "%Y%m%d"))
+    parser.add_argument('--end', help='Last date of the range started by --start, in YYYYMMDD format. Default: yesterday.', type=lambda s: datetime.strptime(s, "%Y%m%d"))
+
+    parser.add_argument('-i', '--input_file', help="Input a file of page names from the English Wikiproject.", type=str, default='./wikipedia/resources/enwp_wikiproject_covid19_articles.txt')
+
+    parser.add_argument('-b', '--input_db', help="Input a path to a sqlite3 database from the real-time-covid-tracker project", type=str, default='real-time-wiki-covid-tracker/AllWikidataItems.sqlite')
+    parser.add_argument('--pagelist_cache', help="Where to cache the deduplicated page list between runs.", type=str, default='wikipedia/data/pagelist_cache.sqlite')
+    parser.add_argument('--title_cache', help="Where to cache where titles redirect to between runs.", type=str, default='wikipedia/data/title_cache.sqlite')
+    parser.add_argument('--title_cache_days', help="Days before a cached title is looked up again. Default: 7.", type=float, default=7)
+
+    parser.add_argument('-z', '--compression', help='Compress the json output as it is written, with xz or zstd. Default: no compression.', choices=['xz', 'zstd'], default=None)
+    parser.add_argument('--compression_threads', help='Threads for the compressor to use. Default: 0, one per core.', type=int, default=0)
+    parser.add_argument('--columnar', help='Also write the tsv columns to a parquet or feather file with typed columns. Needs pyarrow.', choices=['parquet', 'feather'], default=None)
+    parser.add_argument('-c', '--concurrency', help='Number of API requests to keep open at once for each project. Default: 10.', default=10, type=int)
+    parser.add_argument('-P', '--parallel_projects', help='Number of projects to fetch at the same time. Default: 4.', default=4, type=int)
+    parser.add_argument('--max_connections', help='Cap on API requests open at once across all projects. Default: 50.', default=50, type=int)
+    parser.add_argument('--host_connections', help='Cap on API requests open at once to any one host. Default: 50.', default=50, type=int)
+    parser.add_argument('--shard', help='Only fetch the pages in shard i of N (e.g. 0/4), so a crawl can be split across machines. Combine the shards with merge_shards.py.', type=digobs.parse_shard, default=None)
+    parser.add_argument('--journal', help="Path to a sqlite3 database recording the pages each run has finished, for --resume.", type=str, default='wikipedia/data/fetch_daily_views_journal.sqlite')
+    parser.add_argument('--resume', help="If the last run failed, keep its output and carry on with the pages it didn't finish.", action='store_true')
+    parser.add_argument('--segment_size', help="Number of pages to write out and record as finished at a time. Default: 1000.", type=int, default=1000)
+    parser.add_argument('--http_cache', help="Folder of the on-disk HTTP response cache shared by the Wikipedia scripts, or '' for none. Default: wikipedia/data/http_cache.", type=str, default=digobs.http_cache_folder)
+    parser.add_argument('--http_cache_size', help="Size in MB the HTTP response cache is kept under, by dropping the least recently used responses. Default: 2048.", type=float, default=2048)
+    parser.add_argument('--metrics_file', help="Where to write request and stage metrics for the run, as JSON, or as a Prometheus textfile if it ends in .prom. Default: wikipedia/logs/<script>-<date>.metrics.json.", type=str, default=None)
 
     args = parser.parse_args()
-    conn = args.input_db
-    conn.row_factory = sqlite3.Row
 
     #handle -d
+    yesterday = datetime.today() - timedelta(days=1)
     if args.query_date:
         query_date = args.query_date.strftime("%Y%m%d")
     else:
-        yesterday = datetime.today() - timedelta(days=1)
         query_date = yesterday.strftime("%Y%m%d")
 
+    #handle --start and --end, a single date is a range of one day
+    if args.start:
+        query_dates = digobs.date_range(args.start.strftime("%Y%m%d"), (args.end or yesterday).strftime("%Y%m%d"))
+    else:
+        query_dates = [query_date]
+
     digobs.init_logging(args)
+    http_cache.configure(args.http_cache or None, int(args.http_cache_size * 1024 ** 2))
 
     logging.info(f"Destructively outputting results to {args.output_folder}")
 
-    #1 Load up the list of article names
+    job = "fetch_daily_views" if args.shard is None else f"fetch_daily_views shard {args.shard[0]}/{args.shard[1]}"
+    journal = digobs.RunJournal(args.journal, job, resume=args.resume)
 
-    logging.info("loading info from database")
-    projects = [row['project'] for row in conn.execute("SELECT DISTINCT project from pagesPerProjectTable;").fetchall()]
+    # the metrics are written even if the run fails part way
+    digobs.metrics.write_at_exit(args.metrics_file or digobs.metrics_filename(job, datetime.today().strftime("%Y%m%d")), job)
 
-    successes = 0
-    failures = 0
+    # a resumed run carries on with the dates of the run it resumes
+    query_dates = journal.setting('query_dates', query_dates)
 
-    for project in projects:
-        project_folder = path.join(args.output_folder, project)
-        if not path.exists(project.folder):
-            mkdir(project_folder)
+    # every project shares one rate limiter, so cap how much of it they
+    # can hold at once
+    digobs.rate_limiter.set_connection_limits(max_connections=args.max_connections, host_connections=args.host_connections)
 
-        dump_folder = path.join(projct.folder, export_date)
-        if not path.exists(dump_folder):
-            mkdir(dump_folder)
+    #1 Load up the list of article names
 
-        logging.info(f"Getting page views for {project}")
-        rows = conn.execute(f"SELECT DISTINCT page from pagesPerProjectTable WHERE project='{project}';").fetchall()
-        pages = (row['page'] for row in rows)
+    logging.info("loading info from database")
+    with digobs.metrics.stage("load_pages"):
+        page_list = pagelist.PageList(args.input_db, args.input_file, cache_path=args.pagelist_cache)
+        projects = page_list.projects()
 
-        # special case for english, we have a wikiproject input file
-        if project == "en.wikipedia":
-            pages = chain(pages, map(str.strip,args.input_file))
+        # read every project's pages up front, rather than from the threads
+        project_pages = {project : page_list.pages(project) for project in projects}
+        page_list.close()
 
-        call_view_api = partial(digobs.call_view_api, project=project, query_date = query_date)
+    # redirects and moved pages are fetched once, under the title of the
+    # page they point to
+    resolver = digobs.TitleResolver(args.title_cache, ttl=timedelta(days=args.title_cache_days))
 
-        responses = map(call_view_api, pages)
-        
-        j_outfilename = path.join(j_output_folder, f"digobs_covid19_{project}_dailyviews-{query_date}.json")
-        t_outfilename = path.join(t_output_folder, f"digobs_covid19_{project}_dailyviews-{query_date}.tsv")
+    def fetch_project(project):
+        project_folder = path.join(args.output_folder, project)
+        if not path.exists(project_folder):
+            mkdir(project_folder)
 
-        with open(j_outfilename, 'w') as j_outfile, \
-             open(t_outfilename, 'w') as t_outfile:
+        logging.info(f"Getting page views for {project}")
+        with digobs.metrics.stage("resolve_titles", project):
+            pages = resolver.canonical_pages(project, project_pages[project], logging)
+        pages, positions = digobs.shard_pages(project, pages, args.shard)
+        pages = [page for page in pages if not all(journal.done(project, page, query_date) for query_date in query_dates)]
+
+        outputs = []
+        columnar_outfilenames = {}
+
+        def outfiles(query_date, stack):
+            dump_folder = path.join(project_folder, query_date)
+            if not path.exists(dump_folder):
+                mkdir(dump_folder)
+
+            output_name = f"digobs_covid19_{project}_dailyviews-{query_date}{digobs.shard_suffix(args.shard)}"
+            j_outfilename = path.join(dump_folder, f"{output_name}.json")
+            t_outfilename = path.join(dump_folder, f"{output_name}.tsv")
+            c_writer = None
+            if args.columnar:
+                c_outfilename = path.join(dump_folder, f"{output_name}.{args.columnar}")
+                # a columnar file can't be added to, so a resumed run
+                # builds it from the tsv once it is done
+                if journal.resuming:
+                    columnar_outfilenames[t_outfilename] = c_outfilename
+                else:
+                    c_writer = stack.enter_context(digobs.ColumnarWriter(c_outfilename, digobs.view_columns, format=args.columnar))
+
+            j_outfile = stack.enter_context(journal.open_output(j_outfilename, args.compression, args.compression_threads))
+            t_outfile = stack.enter_context(journal.open_output(t_outfilename))
+            outputs.extend([j_outfile, t_outfile])
+            return (j_outfile, t_outfile, c_writer)
+
+        with ExitStack() as stack:
+            stack.enter_context(digobs.metrics.stage("fetch_views", project))
+            if len(query_dates) == 1:
+                responses = digobs.fetch_views(pages, project, query_dates[0], concurrency=args.concurrency)
+                j_outfile, t_outfile, c_writer = outfiles(query_dates[0], stack)
+            else:
+                responses = digobs.fetch_view_range(pages, project, query_dates[0], query_dates[-1], concurrency=args.concurrency)
+                date_outfiles = {query_date : outfiles(query_date, stack) for query_date in query_dates}
+
+            # a shard records where its output goes in the merged files
+            index = stack.enter_context(digobs.ShardIndex(journal, outputs, positions)) if args.shard else None
+
+            # output only counts once the journal commits it
+            responses = digobs.journal_segments((([(project, page, query_date) for query_date in query_dates], response)
+                                                 for page, response in zip(pages, responses)),
+                                                journal, outputs, args.segment_size, index=index)
+
+            if len(query_dates) == 1:
+                proj_successes, proj_failures = digobs.process_view_responses(responses, j_outfile, t_outfile, logging, c_writer)
+            else:
+                counts = digobs.process_view_range_responses(responses, date_outfiles, logging)
+                proj_successes = sum(date_successes for date_successes, _ in counts.values())
+                proj_failures = sum(date_failures for _, date_failures in counts.values())
+
+        digobs.metrics.add_rows("fetch_views", proj_successes, project)
+
+        for t_outfilename, c_outfilename in columnar_outfilenames.items():
+            with digobs.metrics.stage("rebuild_columnar", project):
+                digobs.tsv_to_columnar(t_outfilename, c_outfilename, digobs.view_columns, format=args.columnar)
 
-            proj_successes, proj_failures = digobs.process_view_responses(responses, j_outfile, t_outfile, logging)
         logging.info(f"(Processed {proj_successes} successes and {proj_failures} for {project}")
-        successes = proj_successes + successes
-        failures = proj_failures + failures
+        return (proj_successes, proj_failures)
+
+    successes = 0
+    failures = 0
+    failed_projects = []
+
+    # run several projects at once, so one slow wiki doesn't hold up the rest
+    with ThreadPoolExecutor(max_workers=args.parallel_projects) as executor:
+        futures = {executor.submit(fetch_project, project) : project for project in projects}
+        for future in as_completed(futures):
+            try:
+                proj_successes, proj_failures = future.result()
+            except Exception:
+                logging.exception(f"Error: giving up on {futures[future]}")
+                failed_projects.append(futures[future])
+                continue
+            successes = proj_successes + successes
+            failures = proj_failures + failures
+
+    resolver.close()
+
+    # a failed project leaves the journal open, for --resume
+    if not failed_projects:
+        journal.finish()
+        digobs.metrics.finish()
+    journal.close()
 
-    conn.close()
-    # f_Out = outputPath + "dailyviews" + query_date + ".feather"
-    # read the json back in and make a feather file? 
     logging.debug(f"Run complete at {datetime.now()}")
     logging.info(f"Processed {successes} successful URLs and {failures} failures.")
+    if failed_projects:
+        logging.error(f"Failed to fetch {len(failed_projects)} projects: {', '.join(sorted(failed_projects))}")
 
         
@@ -10,24 +10,37 @@
 ###############################################################################
 
 import sys
-import requests
 import argparse
-import json
-import time
 import os.path
 import datetime
 import logging
-from csv import DictWriter
+from contextlib import ExitStack
 import digobs
-#import feather #TBD
+from digobs_common import http_cache
+import pagelist
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Call the views API to collect Wikipedia view data.')
     parser.add_argument('-o', '--output_folder', help='Where to save output', default="wikipedia/data", type=str)
     parser.add_argument('-i', '--article_file', help='File listing article names', default="wikipedia/resources/enwp_wikiproject_covid19_articles.txt", type=str)
     parser.add_argument('-d', '--query_date', help='Date if not yesterday, in YYYYMMDD format.', type=str)
+    parser.add_argument('--start', help='First date of a range to fetch with one request per article, in YYYYMMDD format. Writes one file per day.', type=str)
+    parser.add_argument('--end', help='Last date of the range started by --start, in YYYYMMDD format. Default: yesterday.', type=str)
     parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel), 
     parser.add_argument('-W', '--logging_destination', help='Logging destination file. (default: standard error)', type=str), 
+    parser.add_argument('-z', '--compression', help='Compress the json output as it is written, with xz or zstd. Default: no compression.', choices=['xz', 'zstd'], default=None)
+    parser.add_argument('--compression_threads', help='Threads for the compressor to use. Default: 0, one per core.', type=int, default=0)
+    parser.add_argument('--columnar', help='Also write the tsv columns to a parquet or feather file with typed columns. Needs pyarrow.', choices=['parquet', 'feather'], default=None)
+    parser.add_argument('-c', '--concurrency', help='Number of API requests to keep open at once. Default: 10.', default=10, type=int)
+    parser.add_argument('--title_cache', help="Where to cache where titles redirect to between runs.", type=str, default='wikipedia/data/title_cache.sqlite')
+    parser.add_argument('--title_cache_days', help="Days before a cached title is looked up again. Default: 7.", type=float, default=7)
+    parser.add_argument('--journal', help="Path to a sqlite3 database recording the articles each run has finished, for --resume.", type=str, default='wikipedia/data/fetch_enwiki_daily_views_journal.sqlite')
+    parser.add_argument('--resume', help="If the last run failed, keep its output and carry on with the articles it didn't finish.", action='store_true')
+    parser.add_argument('--shard', help='Only fetch the articles in shard i of N (e.g. 0/4), so a crawl can be split across machines. Combine the shards with merge_shards.py.', type=digobs.parse_shard, default=None)
+    parser.add_argument('--segment_size', help="Number of articles to write out and record as finished at a time. Default: 1000.", type=int, default=1000)
+    parser.add_argument('--http_cache', help="Folder of the on-disk HTTP response cache shared by the Wikipedia scripts, or '' for none. Default: wikipedia/data/http_cache.", type=str, default=digobs.http_cache_folder)
+    parser.add_argument('--http_cache_size', help="Size in MB the HTTP response cache is kept under, by dropping the least recently used responses. Default: 2048.", type=float, default=2048)
+    parser.add_argument('--metrics_file', help="Where to write request and stage metrics for the run, as JSON, or as a Prometheus textfile if it ends in .prom. Default: wikipedia/logs/<script>-<date>.metrics.json.", type=str, default=None)
     args = parser.parse_args()
     return(args)
 
@@ -39,85 +52,132 @@ def main():
     articleFile = args.article_file
 
     #handle -d
+    yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
     if args.query_date:
         query_date = args.query_date
     else:
-        yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
         query_date = yesterday.strftime("%Y%m%d")
 
+    #handle --start and --end, a single date is a range of one day
+    if args.start:
+        query_dates = digobs.date_range(args.start, args.end or yesterday.strftime("%Y%m%d"))
+    else:
+        query_dates = [query_date]
+
     #handle -W
     if args.logging_destination:
         logging.basicConfig(filename=args.logging_destination, filemode='a', level=args.logging_level)
     else:
         logging.basicConfig(level=args.logging_level)
 
+    http_cache.configure(args.http_cache or None, int(args.http_cache_size * 1024 ** 2))
+
     export_time = str(datetime.datetime.now())
     export_date = datetime.datetime.today().strftime("%Y%m%d")
 
     logging.info(f"Starting run at {export_time}")
     logging.info(f"Last commit: {digobs.git_hash()}")
 
+    job = "fetch_enwiki_daily_views" if args.shard is None else f"fetch_enwiki_daily_views shard {args.shard[0]}/{args.shard[1]}"
+    journal = digobs.RunJournal(args.journal, job, resume=args.resume)
+
+    # the metrics are written even if the run fails part way
+    digobs.metrics.write_at_exit(args.metrics_file or digobs.metrics_filename(job, export_date), job)
+
+    # a resumed run carries on with the dates of the run it resumes
+    query_dates = journal.setting('query_dates', query_dates)
+
     #1 Load up the list of article names
-    j_outfilename = os.path.join(outputPath, f"digobs_covid19-wikipedia-enwiki_dailyviews-{query_date}.json")
-    t_outfilename = os.path.join(outputPath, f"digobs_covid19-wikipedia-enwiki_dailyviews-{query_date}.tsv")
-
-    with open(articleFile, 'r') as infile:
-        articleList = list(map(str.strip, infile))
-
-    success = 0 #for logging how many work/fail
-    failure = 0 
-
-    #3 Save results as a JSON and TSV
-    with open(j_outfilename, 'w') as j_outfile, \
-         open(t_outfilename, 'w') as t_outfile:
-
-        #2 Repeatedly call the API with that list of names
-        for a in articleList:
-            url= f"https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/en.wikipedia/all-access/all-agents/{a}/daily/{query_date}00/{query_date}00"
-           
-            # try to grab the code 10 times, sleeping for one minute each time
-            tries = 0
-            while True:
-                try:
-                    response = requests.get(url)
-                    logging.debug(f"Successfully requested data from: {url}")
-                    break
-                except:
-                    if tries > 10:
-                        logging.critical(f"Error: giving up after 10 tries to get {url}")
-                        raise
-                    else:
-                        logging.warning(f"Warning: socket.timeout from {url}")
-                        logging.warning(f"Warning: sleeping 60 seconds before retrying")
-                        tries = tries + 1
-                        time.sleep(60)
-                        continue
-            
-            if response.ok:
-                jd = response.json()["items"][0]
-                success = success + 1
-            else:
-                failure = failure + 1
-                logging.warning(f"Failure: {response.status_code} from {url}")
-                continue
-
-            # start writing the CSV File if it doesn't exist yet
-            try:
-                dw
-            except NameError:
-                dw = DictWriter(t_outfile, sorted(jd.keys()), delimiter='\t')
-                dw.writeheader()
-
-            logging.debug(f"printing data: {jd}")
-
-            # write out the line of the json file
-            print(json.dumps(jd), file=j_outfile)
-
-            # write out of the csv file
-            dw.writerow(jd)
-
-    # f_Out = outputPath + "dailyviews" + query_date + ".feather"
-    # read the json back in and make a feather file? 
+    def outfilenames(query_date):
+        j_outfilename = os.path.join(outputPath, f"digobs_covid19-wikipedia-enwiki_dailyviews-{query_date}{digobs.shard_suffix(args.shard)}.json")
+        t_outfilename = os.path.join(outputPath, f"digobs_covid19-wikipedia-enwiki_dailyviews-{query_date}{digobs.shard_suffix(args.shard)}.tsv")
+        return (j_outfilename, t_outfilename)
+
+    def columnar_outfilename(query_date):
+        return os.path.join(outputPath, f"digobs_covid19-wikipedia-enwiki_dailyviews-{query_date}{digobs.shard_suffix(args.shard)}.{args.columnar}")
+
+    # the columnar file is optional, so we open it through the same
+    # ExitStack. It can't be added to, so a resumed run builds it from the
+    # tsv once it is done instead.
+    def open_columnar(query_date, stack):
+        if args.columnar is None or journal.resuming:
+            return None
+        return stack.enter_context(digobs.ColumnarWriter(columnar_outfilename(query_date), digobs.view_columns, format=args.columnar))
+
+    # output only counts once the journal commits it
+    outputs = []
+    def open_outfiles(query_date, stack):
+        j_outfilename, t_outfilename = outfilenames(query_date)
+        j_outfile = stack.enter_context(journal.open_output(j_outfilename, args.compression, args.compression_threads))
+        t_outfile = stack.enter_context(journal.open_output(t_outfilename))
+        outputs.extend([j_outfile, t_outfile])
+        return (j_outfile, t_outfile, open_columnar(query_date, stack))
+
+    # normalized titles, without duplicates
+    with digobs.metrics.stage("load_pages"):
+        article_pages = pagelist.PageList(wikiproject_file=articleFile)
+        articleList = article_pages.pages("en.wikipedia")
+        article_pages.close()
+
+    # fetch redirects and moved pages under the title they point to
+    with digobs.metrics.stage("resolve_titles", "en.wikipedia"):
+        resolver = digobs.TitleResolver(args.title_cache, ttl=datetime.timedelta(days=args.title_cache_days))
+        articleList = resolver.canonical_pages("en.wikipedia", articleList, logging)
+        resolver.close()
+
+    articleList, positions = digobs.shard_pages("en.wikipedia", articleList, args.shard)
+
+    # skip the articles a failed run already got
+    articleList = [article for article in articleList if not all(journal.done("en.wikipedia", article, query_date) for query_date in query_dates)]
+
+    # a shard also records where its output goes in the merged files
+    def journal_responses(responses, stack):
+        index = stack.enter_context(digobs.ShardIndex(journal, outputs, positions)) if args.shard else None
+        return digobs.journal_segments((([("en.wikipedia", article, query_date) for query_date in query_dates], response)
+                                        for article, response in zip(articleList, responses)),
+                                       journal, outputs, args.segment_size, index=index)
+
+    if len(query_dates) == 1:
+        query_date = query_dates[0]
+
+        #2 Call the API with that list of names, several requests at a time
+        responses = digobs.fetch_views(articleList, "en.wikipedia", query_date, concurrency=args.concurrency)
+
+        #3 Save results as a JSON and TSV
+        with ExitStack() as stack:
+            stack.enter_context(digobs.metrics.stage("fetch_views", "en.wikipedia"))
+            j_outfile, t_outfile, c_writer = open_outfiles(query_date, stack)
+
+            success, failure = digobs.process_view_responses(journal_responses(responses, stack), j_outfile, t_outfile, logging, c_writer)
+
+    else:
+        #2 Call the API once per article for the whole range of dates
+        logging.info(f"Fetching views from {query_dates[0]} to {query_dates[-1]}")
+        responses = digobs.fetch_view_range(articleList, "en.wikipedia", query_dates[0], query_dates[-1], concurrency=args.concurrency)
+
+        #3 Save results as a JSON and TSV for each day
+        with ExitStack() as stack:
+            stack.enter_context(digobs.metrics.stage("fetch_views", "en.wikipedia"))
+            outfiles = {query_date : open_outfiles(query_date, stack) for query_date in query_dates}
+
+            counts = digobs.process_view_range_responses(journal_responses(responses, stack), outfiles, logging)
+
+        for query_date, (date_success, date_failure) in counts.items():
+            logging.info(f"Processed {date_success} successful URLs and {date_failure} failures for {query_date}.")
+        success = sum(date_success for date_success, _ in counts.values())
+        failure = sum(date_failure for _, date_failure in counts.values())
+
+    digobs.metrics.add_rows("fetch_views", success, "en.wikipedia")
+
+    if args.columnar and journal.resuming:
+        with digobs.metrics.stage("rebuild_columnar", "en.wikipedia"):
+            for query_date in query_dates:
+                digobs.tsv_to_columnar(outfilenames(query_date)[1], columnar_outfilename(query_date), digobs.view_columns, format=args.columnar)
+
+    journal.finish()
+    digobs.metrics.finish()
+    journal.close()
+
     logging.debug(f"Run complete at {datetime.datetime.now()}")
     logging.info(f"Processed {success} successful URLs and {failure} failures.")
 
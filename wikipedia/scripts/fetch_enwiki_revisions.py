@@ -14,12 +14,13 @@ import logging
 import os.path
 import json
 import datetime
-import time
 
-from requests import Request
 from csv import DictWriter
+from contextlib import ExitStack
 from mw import api
 import digobs
+from digobs_common import http_cache
+import pagelist
 
 
 def parse_args():
@@ -29,7 +30,25 @@ def parse_args():
     parser.add_argument('-i', '--article_file', help='File listing article names', default="wikipedia/resources/enwp_wikiproject_covid19_articles.txt", type=str)
     parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel), 
     parser.add_argument('-W', '--logging_destination', help='Logging destination file. (default: standard error)', type=str), 
+    parser.add_argument('-s', '--state_db', help="Path to a sqlite3 database recording the last revision exported for each page. It is updated on every run, and read with --incremental. Default: wikipedia/data/revision_state.sqlite.", type=str, default='wikipedia/data/revision_state.sqlite')
+    parser.add_argument('--incremental', help="Only fetch revisions newer than the last ones exported, according to --state_db. The output is then a delta, and goes in files named revisions_delta instead of revisions, so it can't be mistaken for the full history. Default: fetch every page's complete history.", action='store_true')
+    parser.add_argument('-z', '--compression', help='Compress the json output as it is written, with xz or zstd. Default: no compression.', choices=['xz', 'zstd'], default=None)
+    parser.add_argument('--compression_threads', help='Threads for the compressor to use. Default: 0, one per core.', type=int, default=0)
+    parser.add_argument('--columnar', help='Also write the tsv columns to a parquet or feather file with typed columns. Needs pyarrow.', choices=['parquet', 'feather'], default=None)
+    parser.add_argument('--outputs', help="Which outputs to write. Only the revision properties they need are fetched, so a tsv-only run never downloads page content. Default: json tsv.", nargs='+', choices=['json', 'tsv'], default=['json', 'tsv'])
+    parser.add_argument('--content_revids', help="Instead of page histories, fetch every property (including content) for the revision ids listed in this file, one per line.", type=str)
+    parser.add_argument('--title_cache', help="Where to cache where titles redirect to between runs.", type=str, default='wikipedia/data/title_cache.sqlite')
+    parser.add_argument('--title_cache_days', help="Days before a cached title is looked up again. Default: 7.", type=float, default=7)
+    parser.add_argument('--journal', help="Path to a sqlite3 database recording the articles each run has finished, for --resume.", type=str, default='wikipedia/data/fetch_enwiki_revisions_journal.sqlite')
+    parser.add_argument('--resume', help="If the last run failed, keep its output and carry on with the articles it didn't finish.", action='store_true')
+    parser.add_argument('--shard', help='Only fetch the articles in shard i of N (e.g. 0/4), so a crawl can be split across machines. Combine the shards with merge_shards.py, and keep N the same from run to run so each shard\'s --state_db stays complete.', type=digobs.parse_shard, default=None)
+    parser.add_argument('--segment_size', help="Number of articles to write out and record as finished at a time. Default: 1000.", type=int, default=1000)
+    parser.add_argument('--http_cache', help="Folder of the on-disk HTTP response cache shared by the Wikipedia scripts, or '' for none. Default: wikipedia/data/http_cache.", type=str, default=digobs.http_cache_folder)
+    parser.add_argument('--http_cache_size', help="Size in MB the HTTP response cache is kept under, by dropping the least recently used responses. Default: 2048.", type=float, default=2048)
+    parser.add_argument('--metrics_file', help="Where to write request and stage metrics for the run, as JSON, or as a Prometheus textfile if it ends in .prom. Default: wikipedia/logs/<script>-<date>.metrics.json.", type=str, default=None)
     args = parser.parse_args()
+    if args.resume and args.columnar and 'tsv' not in args.outputs:
+        parser.error("--resume rebuilds the columnar output from the tsv, so it needs --outputs tsv")
     return(args)
 
 def main():
@@ -43,17 +62,36 @@ def main():
         logging.basicConfig(filename=args.logging_destination, filemode='a', level=args.logging_level)
     else:
         logging.basicConfig(level=args.logging_level)
+    http_cache.configure(args.http_cache or None, int(args.http_cache_size * 1024 ** 2))
 
-    export_time = str(datetime.datetime.now())
-    export_date = datetime.datetime.today().strftime("%Y%m%d")
+    job = "fetch_enwiki_revisions_content" if args.content_revids else "fetch_enwiki_revisions"
+    if args.shard is not None:
+        job = f"{job} shard {args.shard[0]}/{args.shard[1]}"
+    journal = digobs.RunJournal(args.journal, job, resume=args.resume)
+
+    # a resumed run carries on with the files of the run it resumes
+    export_time = journal.setting('export_time', str(datetime.datetime.now()))
+    export_date = journal.setting('export_date', datetime.datetime.today().strftime("%Y%m%d"))
+
+    # the metrics are written even if the run fails part way
+    digobs.metrics.write_at_exit(args.metrics_file or digobs.metrics_filename(job, export_date), job)
 
     logging.info(f"Starting run at {export_time}")
     logging.info(f"Last commit: {digobs.git_hash()}")
 
-    json_output_filename = os.path.join(output_path, f"digobs_covid19-wikipedia-enwiki_revisions-{export_date}.json")
-    tsv_output_filename =  os.path.join(output_path, f"digobs_covid19-wikipedia-enwiki_revisions-{export_date}.tsv")
+    if args.content_revids:
+        output_name = f"digobs_covid19-wikipedia-enwiki_revisions_content-{export_date}{digobs.shard_suffix(args.shard)}"
+    else:
+        output_name = f"digobs_covid19-wikipedia-enwiki_{'revisions_delta' if args.incremental else 'revisions'}-{export_date}{digobs.shard_suffix(args.shard)}"
+
+    json_output_filename = os.path.join(output_path, f"{output_name}.json")
+    tsv_output_filename =  os.path.join(output_path, f"{output_name}.tsv")
     
-    api_session = api.Session("https://en.wikipedia.org/w/api.php")
+    api_session = api.Session(digobs.api_url.format(project="en.wikipedia"))
+
+    # send requests through the shared rate limiter, which also retries
+    # transient failures with backoff
+    api_session.session = digobs.get_http_session()
 
     # list of properties from the API we want to gather (basically all of
     # them supported by mediawik-utilities)
@@ -73,13 +111,10 @@ def main():
     exclude_from_tsv = ['tags', 'comment', 'content', 'flags']
 
     # load the list of articles
-    with open(article_filename, 'r') as infile:
-        article_list= list(map(str.strip, infile))
-
-    def get_revisions_for_page(title):
-        return api_session.revisions.query(properties=rv_props.values(),
-                                           titles={title},
-                                           direction="newer")
+    with digobs.metrics.stage("load_pages"):
+        article_pages = pagelist.PageList(wikiproject_file=article_filename)
+        article_list = article_pages.pages("en.wikipedia")
+        article_pages.close()
 
     tsv_fields = ['title', 'pageid', 'namespace']
     tsv_fields = tsv_fields + list(rv_props.keys())
@@ -90,82 +125,130 @@ def main():
     # add special export fields
     tsv_fields = tsv_fields + ['anon', 'minor', 'url', 'export_timestamp', 'export_commit']
 
-    export_info = { 'git_commit' : digobs.git_hash(),
-                    'timestamp' : export_time }
-
-    with open(json_output_filename, 'w') as json_output, \
-         open(tsv_output_filename, 'w') as tsv_output:
-
-        tsv_writer = DictWriter(tsv_output, fieldnames=tsv_fields, delimiter="\t")
-        tsv_writer.writeheader()
-
-        for article in article_list:
-            logging.info(f"pulling revisions for: {article}")
-           
-            # try to grab the code 10 times, sleeping for one minute each time
-            tries = 0
-            while True:
-                try:
-                    rev_rows = []
-                    for rev in get_revisions_for_page(article):
-                        logging.debug(f"processing raw revision: {rev}")
-
-                        # add export metadata
-                        rev['exported'] = export_info
-
-                        # save the json version of the code
-                        print(json.dumps(rev), file=json_output)
-
-                        # handle missing data
-                        if "sha1" not in rev:
-                            rev["sha1"] = ""
-
-                        if "userhidden" in rev:
-                            rev["user"] = ""
-                            rev["userid"] = ""
-
-                        # recode anon so it's true or false instead of present/missing
-                        if "anon" in rev:
-                            rev["anon"] = True
-                        else:
-                            rev["anon"] = False
-                            
-                        # let's recode "minor" in the same way
-                        if "minor" in rev:
-                            rev["minor"] = True
-                        else:
-                            rev["minor"] = False
-
-                        # add page title information
-                        rev['title'] = rev['page']['title']
-                        rev['pageid'] = rev['page']['pageid']
-                        rev['namespace'] = rev['page']['ns']
-
-                        # construct a URL
-                        rev['url'] = Request('GET', 'https://en.wikipedia.org/w/index.php',
-                                             params={'title' : rev['title'].replace(" ", "_"),
-                                                    'oldid' : rev['revid']}).prepare().url
-
-                        rev['export_timestamp'] = export_time
-                        rev['export_commit'] = digobs.git_hash(short=True)
-
-                        rev_rows.append(rev)
-                    logging.debug(f"successfully received revisions for: {article}")
-                    break
-                except:
-                    if tries > 10:
-                        logging.critical(f"giving up after 10 tries to get {article}")
-                        raise
-                    else:
-                        logging.warning(f"socket.timeout from {article}")
-                        logging.warning(f"sleeping 60 seconds before retrying")
-                        tries = tries + 1
-                        time.sleep(60)
-                        continue
-
-                # print out each of the revisions once we know we have it all 
-                for rev in rev_rows: 
-                    tsv_writer.writerow({k: rev[k] for k in tsv_fields})
+    # only ask the API for what we are going to write out
+    history_rv_props = digobs.required_rv_props(rv_props, tsv_fields, args.outputs)
+    logging.info(f"fetching revision properties: {', '.join(history_rv_props.values())}")
+
+    state = digobs.RevisionState(args.state_db)
+
+    # pull every revision of a page, or only the ones after the last
+    # revision we exported. start_id is inclusive, so we drop that one.
+    def get_revisions_for_page(title):
+        start_id = state.last_revid("en.wikipedia", title) if args.incremental else None
+        if start_id is None:
+            return api_session.revisions.query(properties=history_rv_props.values(),
+                                               titles={title},
+                                               direction="newer")
+        else:
+            logging.debug(f"pulling revisions after {start_id} for: {title}")
+            revs = api_session.revisions.query(properties=history_rv_props.values(),
+                                               titles={title},
+                                               direction="newer",
+                                               start_id=start_id)
+            return (rev for rev in revs if rev['revid'] > start_id)
+
+    # pull every property, including content, for 50 revisions at a time
+    def get_revisions_by_id(revids):
+        return api_session.revisions.query(properties=rv_props.values(),
+                                           revids=revids)
+
+    # each group of revisions is written out together once we have all of it
+    if args.content_revids:
+        with open(args.content_revids, 'r') as infile:
+            revid_list = [int(line) for line in map(str.strip, infile) if line]
+        revid_batches = {f"revisions {batch[0]} to {batch[-1]}" : batch
+                         for batch in (revid_list[i:i + 50] for i in range(0, len(revid_list), 50))}
+        labels, positions = digobs.shard_pages("en.wikipedia", list(revid_batches), args.shard)
+        rev_groups = ((label, get_revisions_by_id(revid_batches[label]))
+                      for label in labels
+                      if not journal.done("en.wikipedia", label, export_date))
+    else:
+        # fetch redirects and moved pages under the title they point to
+        with digobs.metrics.stage("resolve_titles", "en.wikipedia"):
+            resolver = digobs.TitleResolver(args.title_cache, ttl=datetime.timedelta(days=args.title_cache_days))
+            article_list = resolver.canonical_pages("en.wikipedia", article_list, logging)
+            resolver.close()
+        article_list, positions = digobs.shard_pages("en.wikipedia", article_list, args.shard)
+        rev_groups = ((article, get_revisions_for_page(article)) for article in article_list
+                      if not journal.done("en.wikipedia", article, export_date))
+
+    tsv_export_info, export_info = digobs.export_metadata(export_time)
+    revision_rows = digobs.RevisionRows("en.wikipedia", tsv_fields, tsv_export_info)
+
+    columnar_output_filename = os.path.join(output_path, f"{output_name}.{args.columnar}")
+
+    with ExitStack() as stack:
+        stack.enter_context(digobs.metrics.stage("fetch_revisions", "en.wikipedia"))
+
+        # output only counts once the journal commits it
+        outputs = []
+        if 'json' in args.outputs:
+            json_output = stack.enter_context(journal.open_output(json_output_filename, args.compression, args.compression_threads))
+            outputs.append(json_output)
+
+        if 'tsv' in args.outputs:
+            tsv_output = stack.enter_context(journal.open_output(tsv_output_filename))
+            outputs.append(tsv_output)
+            # rows only ever have the tsv fields, so skip checking for others
+            tsv_writer = DictWriter(tsv_output, fieldnames=tsv_fields, delimiter="\t", extrasaction='ignore')
+            if tsv_output.tell() == 0:
+                tsv_writer.writeheader()
+        else:
+            tsv_writer = None
+
+        # a columnar file can't be added to, so a resumed run builds it
+        # from the tsv once it is done
+        if args.columnar and not journal.resuming:
+            columnar_writer = stack.enter_context(digobs.ColumnarWriter(columnar_output_filename, digobs.revision_columns, format=args.columnar))
+        else:
+            columnar_writer = None
+
+        row_writer = digobs.RowWriters(tsv_writer, columnar_writer)
+
+        # a shard records where its output goes in the merged files
+        index = stack.enter_context(digobs.ShardIndex(journal, outputs, positions)) if args.shard else None
+
+        # the revision marks only move forward once the journal has the
+        # articles they belong to
+        rev_groups = digobs.journal_segments((([("en.wikipedia", label, export_date)], (label, revs)) for label, revs in rev_groups),
+                                             journal, outputs, args.segment_size, after_commit=state.commit, index=index)
+
+        for label, revs in rev_groups:
+            logging.info(f"pulling revisions for: {label}")
+
+            # revisions are written out as they arrive, so memory stays
+            # flat, but they only count once the journal commits the whole
+            # article, so a failed article leaves nothing behind
+            last_row = None
+            rows = 0
+            for rev in revs:
+                logging.debug(f"processing raw revision: {rev}")
+
+                # add export metadata
+                rev['exported'] = export_info
+
+                # save the json version of the code
+                if 'json' in args.outputs:
+                    print(json.dumps(rev), file=json_output)
+
+                last_row = revision_rows.row(rev, rev['page'])
+                row_writer.writerow(last_row)
+                rows = rows + 1
+            logging.debug(f"successfully received revisions for: {label}")
+            digobs.metrics.add_rows("fetch_revisions", rows, "en.wikipedia")
+
+            # revisions come oldest first, so the last one is the newest
+            if last_row is not None and not args.content_revids:
+                state.update("en.wikipedia", last_row['pageid'], last_row['title'], last_row['revid'])
+
+    if args.columnar and journal.resuming:
+        with digobs.metrics.stage("rebuild_columnar", "en.wikipedia"):
+            digobs.tsv_to_columnar(tsv_output_filename, columnar_output_filename, digobs.revision_columns, format=args.columnar)
+
+    journal.finish()
+    digobs.metrics.finish()
+    journal.close()
+    state.close()
 
 if __name__ == "__main__":
     main()
@@ -14,29 +14,60 @@ import logging
 from os import path, mkdir
 import json
 import datetime
-import sqlite3
 from functools import partial
-from itertools import chain
 from csv import DictWriter
+from contextlib import ExitStack
 import digobs
+from digobs_common import http_cache
+import pagelist
 
 def main():
 
     parser = argparse.ArgumentParser(description='Call the views API to collect Wikipedia revision data.')
     parser.add_argument('-o', '--output_folder', help='Where to save output', default="wikipedia/data", type=str)
-    parser.add_argument('-i', '--input_file', help="Input a file of page names from the English Wikiproject.", type=argparse.FileType('r'), default='./wikipedia/resources/enwp_wikiproject_covid19_articles.txt')
-    parser.add_argument('-d', '--input_db', help="Input a path to a sqlite3 database from the real-time-covid-tracker project", type = sqlite3.connect, default='real-time-wiki-covid-tracker/AllWikidataItems.sqlite')
+    parser.add_argument('-i', '--input_file', help="Input a file of page names from the English Wikiproject.", type=str, default='./wikipedia/resources/enwp_wikiproject_covid19_articles.txt')
+    parser.add_argument('-d', '--input_db', help="Input a path to a sqlite3 database from the real-time-covid-tracker project", type=str, default='real-time-wiki-covid-tracker/AllWikidataItems.sqlite')
+    parser.add_argument('--pagelist_cache', help="Where to cache the deduplicated page list between runs.", type=str, default='wikipedia/data/pagelist_cache.sqlite')
+    parser.add_argument('--title_cache', help="Where to cache where titles redirect to between runs.", type=str, default='wikipedia/data/title_cache.sqlite')
+    parser.add_argument('--title_cache_days', help="Days before a cached title is looked up again. Default: 7.", type=float, default=7)
     parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel), 
     parser.add_argument('-W', '--logging_destination', help='Logging destination file. (default: standard error)', type=argparse.FileType('a'))
+    parser.add_argument('-s', '--state_db', help="Path to a sqlite3 database recording the last revision exported for each page. It is updated on every run, and read with --incremental. Default: wikipedia/data/revision_state.sqlite.", type=str, default='wikipedia/data/revision_state.sqlite')
+    parser.add_argument('-n', '--batch_size', help="Number of titles to look up per API call. 50, or 500 for accounts with apihighlimits.", type=int, default=50)
+    parser.add_argument('--incremental', help="Only fetch revisions newer than the last ones exported, according to --state_db. The output is then a delta, and goes in files named revisions_delta instead of revisions, so it can't be mistaken for the full history. Default: fetch every page's complete history.", action='store_true')
+    parser.add_argument('-z', '--compression', help='Compress the json output as it is written, with xz or zstd. Default: no compression.', choices=['xz', 'zstd'], default=None)
+    parser.add_argument('--compression_threads', help='Threads for the compressor to use. Default: 0, one per core.', type=int, default=0)
+    parser.add_argument('--columnar', help='Also write the tsv columns to a parquet or feather file with typed columns. Needs pyarrow.', choices=['parquet', 'feather'], default=None)
+    parser.add_argument('--outputs', help="Which outputs to write. Only the revision properties they need are fetched, so a tsv-only run never downloads page content. Default: json tsv.", nargs='+', choices=['json', 'tsv'], default=['json', 'tsv'])
+    parser.add_argument('--content_revids', help="Instead of page histories, fetch every property (including content) for the revision ids listed in this file, one per line.", type=argparse.FileType('r'))
+    parser.add_argument('--project', help="Project of the revisions given to --content_revids. Default: en.wikipedia.", type=str, default='en.wikipedia')
+    parser.add_argument('--journal', help="Path to a sqlite3 database recording the pages each run has finished, for --resume.", type=str, default='wikipedia/data/fetch_revisions_journal.sqlite')
+    parser.add_argument('--resume', help="If the last run failed, keep its output and carry on with the pages it didn't finish.", action='store_true')
+    parser.add_argument('--shard', help='Only fetch the pages in shard i of N (e.g. 0/4), so a crawl can be split across machines. Combine the shards with merge_shards.py, and keep N the same from run to run so each shard\'s --state_db stays complete.', type=digobs.parse_shard, default=None)
+    parser.add_argument('--segment_size', help="Number of pages to write out and record as finished at a time. Default: 1000.", type=int, default=1000)
+    parser.add_argument('--http_cache', help="Folder of the on-disk HTTP response cache shared by the Wikipedia scripts, or '' for none. Default: wikipedia/data/http_cache.", type=str, default=digobs.http_cache_folder)
+    parser.add_argument('--http_cache_size', help="Size in MB the HTTP response cache is kept under, by dropping the least recently used responses. Default: 2048.", type=float, default=2048)
+    parser.add_argument('--metrics_file', help="Where to write request and stage metrics for the run, as JSON, or as a Prometheus textfile if it ends in .prom. Default: wikipedia/logs/<script>-<date>.metrics.json.", type=str, default=None)
 
     args = parser.parse_args()
+    if args.resume and args.columnar and 'tsv' not in args.outputs:
+        parser.error("--resume rebuilds the columnar output from the tsv, so it needs --outputs tsv")
 
     logging = digobs.init_logging(args)
+    http_cache.configure(args.http_cache or None, int(args.http_cache_size * 1024 ** 2))
 
-    conn = args.input_db
-    conn.row_factory = sqlite3.Row
+    state = digobs.RevisionState(args.state_db)
 
-    projects = (row['project'] for row in conn.execute("SELECT DISTINCT project from pagesPerProjectTable;").fetchall())
+    if args.content_revids:
+        projects = [args.project]
+    else:
+        with digobs.metrics.stage("load_pages"):
+            page_list = pagelist.PageList(args.input_db, args.input_file, cache_path=args.pagelist_cache)
+            projects = page_list.projects()
+
+        # redirects and moved pages are fetched once, under the title of
+        # the page they point to
+        resolver = digobs.TitleResolver(args.title_cache, ttl=datetime.timedelta(days=args.title_cache_days))
 
     tsv_fields = ['title', 'pageid', 'namespace']
 
@@ -54,15 +85,7 @@ def main():
                  'flags' : 'flags',
                  'comment' : 'comment',
                  'content' : 'content' }
-    
-    def get_project_pages(project):
-        return (row['page'] for row in conn.execute(f"SELECT DISTINCT page FROM pagesPerProjectTable WHERE project == '{project}';").fetchall())
 
-    def get_project_revisions(project):
-        pages = get_project_pages(project)
-        if project=="en.wikipedia":
-            pages = chain(pages, map(str.strip,args.input_file))
-        return digobs.get_pages_revisions(pages, project=project, logging=logging, rv_props=rv_props)
 
     tsv_fields = tsv_fields + list(rv_props.keys())
 
@@ -73,18 +96,51 @@ def main():
 
     # add special export fields
     tsv_fields = tsv_fields + ['anon', 'minor', 'url', 'export_timestamp', 'export_commit']
-    
-    export_time = str(datetime.datetime.now())
-
-    rev_batch_to_tsv = partial(digobs.rev_batch_to_tsv,
-                         tsv_fields = tsv_fields,
-                         export_info={'export_timestamp':export_time,
-                                      'export_commit':digobs.git_hash(short=True)})    
 
-    export_info = { 'git_commit' : digobs.git_hash(),
-                    'timestamp' : export_time }
-
-    export_date = datetime.datetime.today().strftime("%Y%m%d")
+    # only ask the API for what we are going to write out
+    history_rv_props = digobs.required_rv_props(rv_props, tsv_fields, args.outputs)
+    logging.info(f"fetching revision properties: {', '.join(history_rv_props.values())}")
+
+    job = "fetch_revisions_content" if args.content_revids else "fetch_revisions"
+    if args.shard is not None:
+        job = f"{job} shard {args.shard[0]}/{args.shard[1]}"
+    journal = digobs.RunJournal(args.journal, job, resume=args.resume)
+
+    # a resumed run carries on with the files of the run it resumes
+    export_date = journal.setting('export_date', datetime.datetime.today().strftime("%Y%m%d"))
+    export_time = journal.setting('export_time', str(datetime.datetime.now()))
+
+    # the metrics are written even if the run fails part way
+    digobs.metrics.write_at_exit(args.metrics_file or digobs.metrics_filename(job, export_date), job)
+
+    if args.content_revids:
+        revids = [line.strip() for line in args.content_revids if line.strip()]
+        revid_batches = {f"revisions {batch[0]} to {batch[-1]}" : batch
+                         for batch in (revids[i:i + args.batch_size] for i in range(0, len(revids), args.batch_size))}
+
+    # the pages, or batches of revision ids, of project that this shard
+    # fetches, and where each one is in the whole list
+    def get_project_work(project):
+        if args.content_revids:
+            labels = list(revid_batches)
+        else:
+            with digobs.metrics.stage("resolve_titles", project):
+                labels = resolver.canonical_pages(project, page_list.pages(project), logging, batch_size=args.batch_size)
+        return digobs.shard_pages(project, labels, args.shard)
+
+    # yields a (title, batches) pair for each page, or batch of revision
+    # ids, that the journal doesn't have yet
+    def get_project_revisions(project, labels):
+        labels = [label for label in labels if not journal.done(project, label, export_date)]
+        if args.content_revids:
+            for label in labels:
+                yield (label, digobs.get_revisions_by_id(revid_batches[label], project=project, logging=logging, rv_props=rv_props, batch_size=args.batch_size))
+            return
+
+        yield from digobs.get_pages_revisions(labels, project=project, logging=logging, rv_props=history_rv_props,
+                                              state=state if args.incremental else None, batch_size=args.batch_size)
+
+    tsv_export_info, export_info = digobs.export_metadata(export_time)
 
     rev_batch_to_json = partial(digobs.rev_batch_to_json,
                                 export_info = export_info)
@@ -98,23 +154,79 @@ def main():
         if not path.exists(dump_folder):
             mkdir(dump_folder)
 
-        project_revs = get_project_revisions(project)
-        
-        json_output_filename = path.join(dump_folder, f"digobs_covid19_{project}_revisions-{export_date}.json")
-        tsv_output_filename =  path.join(dump_folder, f"digobs_covid19_{project}_revisions-{export_date}.tsv")
+        if args.content_revids:
+            output_name = f"digobs_covid19_{project}_revisions_content-{export_date}{digobs.shard_suffix(args.shard)}"
+        else:
+            output_name = f"digobs_covid19_{project}_{'revisions_delta' if args.incremental else 'revisions'}-{export_date}{digobs.shard_suffix(args.shard)}"
 
-        with open(json_output_filename, 'w') as json_output, \
-             open(tsv_output_filename, 'w') as tsv_output:
-            tsv_writer = DictWriter(tsv_output, fieldnames=tsv_fields, delimiter="\t")
-            tsv_writer.writeheader()
+        labels, positions = get_project_work(project)
+        
+        json_output_filename = path.join(dump_folder, f"{output_name}.json")
+        tsv_output_filename =  path.join(dump_folder, f"{output_name}.tsv")
+
+        columnar_output_filename = path.join(dump_folder, f"{output_name}.{args.columnar}")
+
+        with ExitStack() as stack:
+            stack.enter_context(digobs.metrics.stage("fetch_revisions", project))
+
+            # output only counts once the journal commits it
+            outputs = []
+            if 'json' in args.outputs:
+                json_output = stack.enter_context(journal.open_output(json_output_filename, args.compression, args.compression_threads))
+                outputs.append(json_output)
+
+            if 'tsv' in args.outputs:
+                tsv_output = stack.enter_context(journal.open_output(tsv_output_filename))
+                outputs.append(tsv_output)
+                # rows only ever have the tsv fields, so skip checking for others
+                tsv_writer = DictWriter(tsv_output, fieldnames=tsv_fields, delimiter="\t", extrasaction='ignore')
+                if tsv_output.tell() == 0:
+                    tsv_writer.writeheader()
+            else:
+                tsv_writer = None
+
+            # a columnar file can't be added to, so a resumed run builds
+            # it from the tsv once it is done
+            if args.columnar and not journal.resuming:
+                columnar_writer = stack.enter_context(digobs.ColumnarWriter(columnar_output_filename, digobs.revision_columns, format=args.columnar))
+            else:
+                columnar_writer = None
+
+            row_writer = digobs.RowWriters(tsv_writer, columnar_writer)
+            revision_rows = digobs.RevisionRows(project, tsv_fields, tsv_export_info)
   
-            for rev_batch in project_revs:
-                logging.debug(f"processing raw revision: {rev_batch}")
-                rev_batch_to_json(rev_batch, json_output=json_output)
-                rev_batch_to_tsv(rev_batch, project=project, tsv_writer=tsv_writer)
+            # a shard records where its output goes in the merged files
+            index = stack.enter_context(digobs.ShardIndex(journal, outputs, positions)) if args.shard else None
+
+            # the revision marks only move forward once the journal has
+            # the pages they belong to
+            project_revs = (([(project, title, export_date)], batches) for title, batches in get_project_revisions(project, labels))
+            for batches in digobs.journal_segments(project_revs, journal, outputs, args.segment_size, after_commit=state.commit, index=index):
+                for rev_batch in batches:
+                    logging.debug(f"processing raw revision: {rev_batch}")
+                    if 'json' in args.outputs:
+                        rev_batch_to_json(rev_batch, json_output=json_output)
+                    if row_writer.writers:
+                        revision_rows.write_batch(rev_batch, row_writer)
+                    if not args.content_revids:
+                        state.update_from_batch(project, rev_batch)
+                    digobs.metrics.add_rows("fetch_revisions", digobs.batch_revision_count(rev_batch), project)
+
+        if args.columnar and journal.resuming:
+            with digobs.metrics.stage("rebuild_columnar", project):
+                digobs.tsv_to_columnar(tsv_output_filename, columnar_output_filename, digobs.revision_columns, format=args.columnar)
 
     for project in projects:
         write_project_pages(project)
 
+    if not args.content_revids:
+        page_list.close()
+        resolver.close()
+
+    journal.finish()
+    digobs.metrics.finish()
+    journal.close()
+    state.close()
+
 if __name__ == "__main__":
     main()
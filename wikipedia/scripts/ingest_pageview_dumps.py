@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# This script builds the daily view files from Wikimedia's hourly pageview
+# dumps (https://dumps.wikimedia.org/other/pageviews/) instead of the API.
+#
+# It (1) reads the list of tracked pages for every project, (2) streams
+# each local pageviews-YYYYMMDD-HHMMSS.gz file, in parallel, keeping only
+# lines for tracked pages, and (3) sums the hours into daily counts written
+# to the same JSON and TSV layout as fetch_daily_views.py.
+#
+# The dumps only count user traffic, so rows have agent "user" where the
+# API gives "all-agents", and desktop and mobile are added together as
+# "all-access".
+#
+###############################################################################
+
+import argparse
+import gzip
+import re
+import logging
+from os import path, makedirs, cpu_count
+from datetime import datetime
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from urllib.parse import unquote_to_bytes
+import digobs
+import pagelist
+
+# dump domain code suffixes for each kind of project. Mobile views have an
+# extra ".m" after the language code.
+project_suffixes = {'wikipedia' : '',
+                    'wikibooks' : '.b',
+                    'wiktionary' : '.d',
+                    'wikinews' : '.n',
+                    'wikiquote' : '.q',
+                    'wikisource' : '.s',
+                    'wikiversity' : '.v',
+                    'wikivoyage' : '.voy'}
+
+dump_filename_re = re.compile(r'pageviews-(\d{8})-\d{2}')
+
+def project_domain_codes(project):
+    lang, site = project.split('.', 1)
+    suffix = project_suffixes[site]
+    return [f"{lang}{suffix}", f"{lang}.m{suffix}"]
+
+# Keeps the projects the dumps have views for. Projects like www.wikidata
+# have no dump domain code, so we warn and leave them out instead of
+# writing empty files for them.
+def dump_projects(project_pages):
+    covered = {}
+    for project, pages in project_pages.items():
+        try:
+            project_domain_codes(project)
+        except (KeyError, ValueError):
+            logging.warning(f"Warning: no pageview dump domain code for {project}, skipping it")
+            continue
+        covered[project] = pages
+    return covered
+
+# Builds the lookup used to filter the dumps: domain code -> title -> key,
+# all in bytes, so we never have to decode lines for pages we don't track.
+def build_lookup(project_pages):
+    lookup = defaultdict(dict)
+    for project, pages in project_pages.items():
+        domain_codes = project_domain_codes(project)
+        for page in pages:
+            title = page.replace(' ', '_')
+            for domain_code in domain_codes:
+                lookup[domain_code.encode()][title.encode()] = (project, title)
+
+    return dict(lookup)
+
+_lookup = None
+
+def _init_worker(lookup):
+    global _lookup
+    _lookup = lookup
+
+# Sums the views of the tracked pages in one hourly dump file. Dump lines
+# look like "en.m COVID-19_pandemic 1234 0".
+def count_hour(dump_filename):
+    counts = Counter()
+    with gzip.open(dump_filename, 'rb') as dump:
+        for line in dump:
+            fields = line.split(b' ', 3)
+            if len(fields) < 3:
+                continue
+
+            titles = _lookup.get(fields[0], None)
+            if titles is None:
+                continue
+
+            key = titles.get(fields[1], None)
+            if key is None and b'%' in fields[1]:
+                key = titles.get(unquote_to_bytes(fields[1]), None)
+            if key is None:
+                continue
+
+            try:
+                counts[key] = counts[key] + int(fields[2])
+            except ValueError:
+                logging.warning(f"Warning: bad view count in {dump_filename}: {line}")
+
+    return counts
+
+def dump_date(dump_filename):
+    match = dump_filename_re.search(path.basename(dump_filename))
+    if match is None:
+        raise ValueError(f"not a pageview dump file name: {dump_filename}")
+    return match.group(1)
+
+# Counts the views in every dump file, using processes processes, and
+# returns the daily totals: date -> (project, title) -> views.
+def count_days(dump_filenames, lookup, processes=None):
+    daily_counts = defaultdict(Counter)
+    dates = [dump_date(dump_filename) for dump_filename in dump_filenames]
+
+    with Pool(processes, initializer=_init_worker, initargs=(lookup,)) as pool:
+        for date, dump_filename, counts in zip(dates, dump_filenames, pool.imap(count_hour, dump_filenames)):
+            logging.info(f"counted {len(counts)} tracked pages in {dump_filename}")
+            daily_counts[date].update(counts)
+
+    return daily_counts
+
+# Turns the daily totals into the items the API would have returned, in
+# the order of the page list. Pages without views are None, like a failed
+# API call.
+def view_items(project, pages, date, counts):
+    for page in pages:
+        title = page.replace(' ', '_')
+        views = counts.get((project, title), 0)
+        if views == 0:
+            yield None
+        else:
+            yield {'project' : project,
+                   'article' : title,
+                   'granularity' : 'daily',
+                   'timestamp' : f"{date}00",
+                   'access' : 'all-access',
+                   'agent' : 'user',
+                   'views' : views}
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Build daily view files for the tracked pages from local hourly pageview dump files.")
+    parser.add_argument('dumps', help='pageviews-YYYYMMDD-HHMMSS.gz files to read', nargs='+', type=str)
+    parser.add_argument('-o', '--output_folder', help='Where to save output', default="wikipedia/data", type=str)
+    parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel)
+    parser.add_argument('-W', '--logging_destination', help='Logging destination file. (default: standard error)', type=argparse.FileType('a'))
+    parser.add_argument('-i', '--input_file', help="Input a file of page names from the English Wikiproject.", type=str, default='./wikipedia/resources/enwp_wikiproject_covid19_articles.txt')
+    parser.add_argument('-b', '--input_db', help="Input a path to a sqlite3 database from the real-time-covid-tracker project", type=str, default='real-time-wiki-covid-tracker/AllWikidataItems.sqlite')
+    parser.add_argument('--pagelist_cache', help="Where to cache the deduplicated page list between runs.", type=str, default='wikipedia/data/pagelist_cache.sqlite')
+    parser.add_argument('-p', '--processes', help='Number of dump files to read at once. Default: one per core.', type=int, default=cpu_count())
+    parser.add_argument('-z', '--compression', help='Compress the json output as it is written, with xz or zstd. Default: no compression.', choices=['xz', 'zstd'], default=None)
+    parser.add_argument('--compression_threads', help='Threads for the compressor to use. Default: 0, one per core.', type=int, default=0)
+    parser.add_argument('--columnar', help='Also write the tsv columns to a parquet or feather file with typed columns. Needs pyarrow.', choices=['parquet', 'feather'], default=None)
+
+    args = parser.parse_args()
+
+    digobs.init_logging(args)
+
+    logging.info(f"Destructively outputting results to {args.output_folder}")
+
+    #1 Load up the list of tracked pages for every project
+    logging.info("loading info from database")
+    page_list = pagelist.PageList(args.input_db, args.input_file, cache_path=args.pagelist_cache)
+    project_pages = {project : page_list.pages(project) for project in page_list.projects()}
+    page_list.close()
+
+    #2 Count the views in each hour, several files at a time
+    project_pages = dump_projects(project_pages)
+    lookup = build_lookup(project_pages)
+    daily_counts = count_days(args.dumps, lookup, processes=args.processes)
+
+    #3 Write a JSON and TSV file for each project and day
+    successes = 0
+    failures = 0
+
+    for date, counts in sorted(daily_counts.items()):
+        for project, pages in project_pages.items():
+            dump_folder = path.join(args.output_folder, project, date)
+            if not path.exists(dump_folder):
+                makedirs(dump_folder)
+
+            j_outfilename = path.join(dump_folder, f"digobs_covid19_{project}_dailyviews-{date}.json")
+            t_outfilename = path.join(dump_folder, f"digobs_covid19_{project}_dailyviews-{date}.tsv")
+
+            with digobs.open_output(j_outfilename, args.compression, args.compression_threads) as j_outfile, \
+                 open(t_outfilename, 'w') as t_outfile:
+
+                if args.columnar:
+                    c_outfilename = path.join(dump_folder, f"digobs_covid19_{project}_dailyviews-{date}.{args.columnar}")
+                    with digobs.ColumnarWriter(c_outfilename, digobs.view_columns, format=args.columnar) as c_writer:
+                        proj_successes, proj_failures = digobs.process_view_responses(view_items(project, pages, date, counts), j_outfile, t_outfile, logging, c_writer)
+                else:
+                    proj_successes, proj_failures = digobs.process_view_responses(view_items(project, pages, date, counts), j_outfile, t_outfile, logging)
+
+            logging.info(f"Processed {proj_successes} pages with views and {proj_failures} without for {project} on {date}")
+            successes = proj_successes + successes
+            failures = proj_failures + failures
+
+    logging.debug(f"Run complete at {datetime.now()}")
+    logging.info(f"Processed {successes} pages with views and {failures} without.")
+
+if __name__ == "__main__":
+    main()
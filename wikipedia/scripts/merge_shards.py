@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# Merges the output of a crawl that was split across machines with
+# --shard i/N back into the files one unsharded run would have written,
+# ready for the cron scripts to publish.
+#
+# It (1) finds the shard files (named like
+# digobs_covid19-wikipedia-enwiki_dailyviews-20200401.shard0of4.tsv) in
+# the folders it is given, (2) checks that every shard of each file is
+# there and that the tsv headers agree, and (3) interleaves the shards'
+# lines in the order of the whole page list, using the .index file each
+# shard wrote, so the merged file has the same header and order as a
+# single run's.
+#
+###############################################################################
+
+import argparse
+import heapq
+import logging
+import lzma
+import os
+import re
+import subprocess
+from os import path, makedirs
+from contextlib import contextmanager, ExitStack
+import digobs
+
+shard_pattern = re.compile(r'^(?P<base>.*)\.shard(?P<index>\d+)of(?P<count>\d+)(?P<ext>\.json|\.tsv)(?P<suffix>\.xz|\.zst)?$')
+
+# Finds the shard files under each folder. Returns a dictionary from the
+# merged file's name (relative to the folder it was found in) to its
+# shard count, compression suffix and the path of each shard.
+def find_shard_files(folders):
+    merged = {}
+    for folder in folders:
+        for root, subfolders, filenames in os.walk(folder):
+            for filename in filenames:
+                match = shard_pattern.match(filename)
+                if match is None:
+                    continue
+                name = path.normpath(path.join(path.relpath(root, folder), match.group('base') + match.group('ext')))
+                count = int(match.group('count'))
+                suffix = match.group('suffix') or ''
+                entry = merged.setdefault(name, {'count' : count, 'suffix' : suffix, 'shards' : {}})
+
+                if entry['count'] != count or entry['suffix'] != suffix:
+                    raise ValueError(f"the shards of {name} don't agree on the number of shards or compression")
+                index = int(match.group('index'))
+                if index in entry['shards']:
+                    raise ValueError(f"shard {index} of {name} is in both {entry['shards'][index]} and {path.join(root, filename)}")
+                entry['shards'][index] = path.join(root, filename)
+    return merged
+
+# Opens a shard file, compressed or not, to read its lines as bytes.
+@contextmanager
+def open_lines(filename):
+    if filename.endswith('.xz'):
+        with lzma.open(filename, 'rb') as infile:
+            yield infile
+    elif filename.endswith('.zst'):
+        process = subprocess.Popen(['zstd', '--decompress', '--stdout', '--quiet', filename], stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+    else:
+        with open(filename, 'rb') as infile:
+            yield infile
+
+# The (position, lines) entries of a shard's index, in file order
+def read_index(shard_filename, suffix):
+    index_filename = shard_filename[:len(shard_filename) - len(suffix)] + '.index'
+    entries = []
+    with open(index_filename, 'r') as infile:
+        for line in infile:
+            position, lines = line.split('\t')
+            entries.append((int(position), int(lines)))
+    if entries != sorted(entries):
+        raise ValueError(f"{index_filename} is out of order")
+    return entries
+
+def merge_file(name, entry, output_folder, threads=0):
+    compression = {'' : None, '.xz' : 'xz', '.zst' : 'zstd'}[entry['suffix']]
+    output_filename = path.join(output_folder, name)
+    makedirs(path.dirname(output_filename) or '.', exist_ok=True)
+
+    with ExitStack() as stack:
+        shards = []
+        for index in range(entry['count']):
+            infile = stack.enter_context(open_lines(entry['shards'][index]))
+            shards.append((infile, read_index(entry['shards'][index], entry['suffix'])))
+
+        outfile = stack.enter_context(digobs.open_output(output_filename, compression, threads))
+
+        # every shard that wrote anything to a tsv starts it with the header
+        if name.endswith('.tsv'):
+            headers = set(infile.readline() for infile, _ in shards) - {b''}
+            if len(headers) > 1:
+                raise ValueError(f"the shards of {name} have different headers")
+            for header in headers:
+                outfile.write(header.decode('utf-8'))
+
+        # each unit's lines, in the order of the whole page list
+        units = heapq.merge(*[[(position, lines, shard) for position, lines in entries]
+                              for shard, (infile, entries) in enumerate(shards)])
+        for position, lines, shard in units:
+            infile = shards[shard][0]
+            for i in range(lines):
+                line = infile.readline()
+                if not line:
+                    raise ValueError(f"{entry['shards'][shard]} is shorter than its index")
+                outfile.write(line.decode('utf-8'))
+
+        for shard, (infile, entries) in enumerate(shards):
+            if infile.readline():
+                raise ValueError(f"{entry['shards'][shard]} has lines its index doesn't account for")
+
+    return output_filename + entry['suffix']
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the output of fetchers run with --shard i/N into the files a single run would have written.')
+    parser.add_argument('shard_folders', help='Folders holding the shard files, e.g. the output folder of each machine. They are searched recursively, and the folder structure is kept.', nargs='+')
+    parser.add_argument('-o', '--output_folder', help='Where to save the merged files. Default: wikipedia/data.', default="wikipedia/data", type=str)
+    parser.add_argument('--columnar', help='Also build a parquet or feather file from each merged tsv. Needs pyarrow.', choices=['parquet', 'feather'], default=None)
+    parser.add_argument('--compression_threads', help='Threads for the compressor to use. Default: 0, one per core.', type=int, default=0)
+    parser.add_argument('--partial', help="Merge the shards that are there even if some are missing, instead of stopping.", action='store_true')
+    parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.logging_level)
+
+    merged = find_shard_files(args.shard_folders)
+    if not merged:
+        logging.error(f"no shard files found in {', '.join(args.shard_folders)}")
+
+    for name, entry in sorted(merged.items()):
+        missing = sorted(set(range(entry['count'])) - set(entry['shards']))
+        if missing and not args.partial:
+            parser.error(f"{name} is missing shards {', '.join(map(str, missing))} of {entry['count']}")
+        elif missing:
+            logging.warning(f"Warning: merging {name} without shards {', '.join(map(str, missing))}")
+            entry = dict(entry, count=len(entry['shards']), shards=dict(enumerate(entry['shards'][index] for index in sorted(entry['shards']))))
+
+        output_filename = merge_file(name, entry, args.output_folder, args.compression_threads)
+        logging.info(f"merged {len(entry['shards'])} shards into {output_filename}")
+
+        if args.columnar and name.endswith('.tsv'):
+            columns = digobs.view_columns if 'dailyviews' in name else digobs.revision_columns
+            columnar_filename = output_filename[:-len('.tsv')] + '.' + args.columnar
+            digobs.tsv_to_columnar(output_filename, columnar_filename, columns, format=args.columnar)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# A local stand-in for the MediaWiki action API (api.php) and the pageview
+# REST API, so the fetchers can be run and timed without touching
+# Wikimedia's servers.
+#
+# Requests are answered (1) from a file of recorded responses, if one is
+# given and has the exact request, or else (2) with made up but consistent
+# data: every title is a page with a fixed number of revisions and some
+# daily views, except titles starting with "Missing", which don't exist.
+# Responses can be delayed, and a share of them can fail with 503s or be
+# throttled with 429s.
+#
+# With --record, requests are passed on to the real APIs and the answers
+# are added to the recording file, to be replayed later.
+#
+# The APIs live at http://host:port/{project}/w/api.php and
+# http://host:port/api/rest_v1/metrics/pageviews/per-article/...
+#
+###############################################################################
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote, urlencode
+import requests
+import digobs
+
+pageview_prefix = "/api/rest_v1/metrics/pageviews/per-article/"
+
+# revision ids are pageid * revid_stride + the revision's number, so any
+# revision id leads back to its page
+revid_stride = 100000
+
+def recording_key(path, params):
+    return path + "?" + urlencode(sorted(params.items()))
+
+def load_recordings(filename):
+    recordings = {}
+    with open(filename, 'r') as infile:
+        for line in infile:
+            if line.strip():
+                recording = json.loads(line)
+                recordings[recording_key(recording['path'], recording['params'])] = (recording['status'], recording['body'])
+    logging.info(f"loaded {len(recordings)} recorded responses from {filename}")
+    return recordings
+
+def normalize_title(title):
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+def page_id(title):
+    return zlib.crc32(title.encode()) % 10000000 + 1
+
+# Made up, but always the same, answers to the requests the fetchers send.
+class MockWiki:
+    def __init__(self, revisions_per_page=50, content_size=2000, category_size=1000):
+        self.revisions_per_page = min(revisions_per_page, revid_stride)
+        self.content_size = content_size
+        self.category_size = category_size
+
+    def exists(self, title):
+        return not title.startswith("Missing")
+
+    def revision(self, pageid, number, rvprop, slots):
+        revid = pageid * revid_stride + number
+        rev = {}
+        if 'ids' in rvprop:
+            rev['revid'] = revid
+            rev['parentid'] = revid - 1 if number > 0 else 0
+        if 'timestamp' in rvprop:
+            rev['timestamp'] = (datetime(2020, 1, 1) + timedelta(hours=number)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if 'user' in rvprop or 'userid' in rvprop:
+            if number % 13 == 5:
+                rev['anon'] = ''
+                rev['user'] = f"192.0.2.{number % 250}"
+                rev['userid'] = 0
+            else:
+                rev['user'] = f"Editor {revid % 97}"
+                rev['userid'] = revid % 97 + 1
+        if 'size' in rvprop:
+            rev['size'] = 1000 + (revid * 7) % 50000
+        if 'sha1' in rvprop:
+            rev['sha1'] = hashlib.sha1(str(revid).encode()).hexdigest()
+        if 'flags' in rvprop and number % 3 == 0:
+            rev['minor'] = ''
+        if 'comment' in rvprop:
+            rev['comment'] = f"edit {number}"
+        if 'tags' in rvprop:
+            rev['tags'] = []
+
+        content = {}
+        if 'contentmodel' in rvprop:
+            content['contentmodel'] = 'wikitext'
+        if 'content' in rvprop:
+            content['contentformat'] = 'text/x-wiki'
+            content['*'] = (f"Revision {revid}. " * self.content_size)[:self.content_size]
+
+        if slots:
+            rev['slots'] = {'main' : content}
+        else:
+            rev.update(content)
+        return rev
+
+    def page(self, title, prop):
+        if not self.exists(title):
+            return {'ns' : 0, 'title' : title, 'missing' : ''}
+        pageid = page_id(title)
+        page = {'pageid' : pageid, 'ns' : 0, 'title' : title}
+        if 'info' in prop:
+            page['lastrevid'] = pageid * revid_stride + self.revisions_per_page - 1
+            page['length'] = 5000
+            page['contentmodel'] = 'wikitext'
+        return page
+
+    def query(self, params):
+        result = {'batchcomplete' : ''}
+        query = {}
+        prop = params.get('prop', '').split('|')
+        rvprop = params.get('rvprop', '').split('|')
+        slots = 'rvslots' in params
+
+        if params.get('list', None) == 'categorymembers':
+            offset = int(params.get('cmcontinue', 'mock|0').split('|')[1])
+            limit = int(params.get('cmlimit', 10))
+            members = range(offset, min(offset + limit, self.category_size))
+            query['categorymembers'] = [{'pageid' : page_id(f"Mock article {n}"), 'ns' : 1, 'title' : f"Talk:Mock article {n}"}
+                                        for n in members]
+            if offset + limit < self.category_size:
+                result['continue'] = {'cmcontinue' : f"mock|{offset + limit}", 'continue' : '-||'}
+
+        pages = {}
+        if 'titles' in params:
+            normalized = []
+            for title in params['titles'].split('|'):
+                normal_title = normalize_title(title)
+                if normal_title != title:
+                    normalized.append({'from' : title, 'to' : normal_title})
+                page = self.page(normal_title, prop)
+                pages[str(page.get('pageid', -1 - len(pages)))] = page
+            if normalized:
+                query['normalized'] = normalized
+
+            # one page at a time, like the real API
+            if 'revisions' in prop and len(pages) == 1:
+                page = next(iter(pages.values()))
+                if 'missing' not in page:
+                    if 'content' in rvprop:
+                        default_limit = 50
+                    else:
+                        default_limit = 500
+                    limit = int(params['rvlimit']) if params.get('rvlimit', 'max') != 'max' else default_limit
+                    start = int(params.get('rvcontinue', params.get('rvstartid', page['pageid'] * revid_stride)))
+                    first = start - page['pageid'] * revid_stride
+                    last = min(first + limit, self.revisions_per_page)
+                    page['revisions'] = [self.revision(page['pageid'], number, rvprop, slots) for number in range(first, last)]
+                    if last < self.revisions_per_page:
+                        result['continue'] = {'rvcontinue' : str(page['pageid'] * revid_stride + last), 'continue' : '||'}
+
+        if 'revids' in params:
+            for revid in params['revids'].split('|'):
+                pageid, number = divmod(int(revid), revid_stride)
+                page = pages.setdefault(str(pageid), {'pageid' : pageid, 'ns' : 0, 'title' : f"Page {pageid}", 'revisions' : []})
+                page['revisions'].append(self.revision(pageid, number, rvprop, slots))
+
+        if pages:
+            query['pages'] = pages
+        result['query'] = query
+        return (200, json.dumps(result))
+
+    def views(self, path):
+        try:
+            project, access, agent, article, granularity, start, end = path[len(pageview_prefix):].split('/')
+        except ValueError:
+            return (400, json.dumps({'title' : 'Bad request', 'detail' : path}))
+
+        article = unquote(article)
+        if not self.exists(article):
+            return (404, json.dumps({'type' : 'https://mediawiki.org/wiki/HyperSwitch/errors/not_found',
+                                     'title' : 'Not found.',
+                                     'detail' : 'The date(s) you used are valid, but we either do not have data for those date(s), or the project you asked for is not loaded yet.'}))
+
+        items = []
+        for date in digobs.date_range(start[:8], end[:8]):
+            items.append({'project' : project,
+                          'article' : article,
+                          'granularity' : granularity,
+                          'timestamp' : f"{date}00",
+                          'access' : access,
+                          'agent' : agent,
+                          'views' : zlib.crc32(f"{article}{date}".encode()) % 1000 + 1})
+        return (200, json.dumps({'items' : items}))
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def params(self):
+        params = dict(parse_qsl(urlsplit(self.path).query, keep_blank_values=True))
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            params.update(parse_qsl(self.rfile.read(length).decode(), keep_blank_values=True))
+        return params
+
+    def send(self, status, body, headers={}):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        # counted before the client can see the response, so stats() is up
+        # to date as soon as the client has it
+        self.server.count(self.endpoint, status, len(data))
+        self.wfile.write(data)
+
+    def handle_request(self):
+        server = self.server
+        path = urlsplit(self.path).path
+        params = self.params()
+
+        if path.startswith(pageview_prefix):
+            self.endpoint = 'pageviews'
+        elif path.endswith('/w/api.php'):
+            self.endpoint = 'api'
+        else:
+            self.endpoint = 'other'
+            self.send(404, json.dumps({'error' : f"nothing at {path}"}))
+            return
+
+        if server.latency > 0:
+            time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+
+        chance = random.random()
+        if chance < server.error_rate:
+            self.send(503, json.dumps({'error' : 'mock server error'}))
+            return
+        if chance < server.error_rate + server.throttle_rate:
+            self.send(429, json.dumps({'error' : 'mock rate limit'}), {'Retry-After' : str(server.retry_after)})
+            return
+
+        key = recording_key(path, params)
+        if key in server.recordings:
+            status, body = server.recordings[key]
+        elif server.record_file is not None:
+            status, body = server.record(path, params)
+        elif self.endpoint == 'pageviews':
+            status, body = server.wiki.views(path)
+        elif params.get('action', None) == 'query':
+            status, body = server.wiki.query(params)
+        else:
+            status, body = (200, json.dumps({'error' : {'code' : 'badvalue', 'info' : 'the mock server only answers action=query'}}))
+
+        self.send(status, body)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, wiki, recordings={}, record_file=None, latency=0, jitter=0,
+                 error_rate=0, throttle_rate=0, retry_after=1):
+        super().__init__(address, MockHandler)
+        self.wiki = wiki
+        self.recordings = recordings
+        self.record_file = record_file
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, endpoint, status, size):
+        with self.lock:
+            self.requests[endpoint] = self.requests[endpoint] + 1
+            self.statuses[status] = self.statuses[status] + 1
+            self.bytes_sent = self.bytes_sent + size
+
+    def stats(self):
+        with self.lock:
+            return {'requests' : dict(self.requests),
+                    'statuses' : dict(self.statuses),
+                    'bytes_sent' : self.bytes_sent}
+
+    # asks the real API and keeps the answer
+    def record(self, path, params):
+        if path.startswith(pageview_prefix):
+            url = "https://wikimedia.org" + path
+        else:
+            url = f"https://{path.split('/')[1]}.org/w/api.php"
+        response = requests.get(url, params=params, headers={'User-Agent' : digobs.user_agent})
+        with self.lock:
+            print(json.dumps({'path' : path, 'params' : params, 'status' : response.status_code, 'body' : response.text}),
+                  file=self.record_file, flush=True)
+            self.recordings[recording_key(path, params)] = (response.status_code, response.text)
+        return (response.status_code, response.text)
+
+def add_server_args(parser):
+    parser.add_argument('--recordings', help='File of recorded responses to replay, one JSON object per line.', type=str, default=None)
+    parser.add_argument('--latency', help='Mean delay before each response, in seconds. Default: 0.', type=float, default=0)
+    parser.add_argument('--jitter', help='Standard deviation of the delay, in seconds. Default: 0.', type=float, default=0)
+    parser.add_argument('--error_rate', help='Share of requests that fail with a 503. Default: 0.', type=float, default=0)
+    parser.add_argument('--throttle_rate', help='Share of requests that get a 429. Default: 0.', type=float, default=0)
+    parser.add_argument('--retry_after', help='Retry-After sent with 429s, in seconds. Default: 1.', type=int, default=1)
+    parser.add_argument('--revisions_per_page', help='Revisions each made up page has. Default: 50.', type=int, default=50)
+    parser.add_argument('--content_size', help='Characters of content in each made up revision. Default: 2000.', type=int, default=2000)
+    parser.add_argument('--category_size', help='Articles in the made up WikiProject category. Default: 1000.', type=int, default=1000)
+
+def make_server(args, host='127.0.0.1', port=0, record_file=None):
+    recordings = load_recordings(args.recordings) if args.recordings and os.path.exists(args.recordings) else {}
+    wiki = MockWiki(revisions_per_page=args.revisions_per_page, content_size=args.content_size, category_size=args.category_size)
+    return MockServer((host, port), wiki, recordings=recordings, record_file=record_file,
+                      latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a stand-in for the MediaWiki and pageview APIs.')
+    parser.add_argument('--host', help='Address to listen on. Default: 127.0.0.1.', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to listen on. Default: 8080.', type=int, default=8080)
+    parser.add_argument('--record', help='Pass requests on to the real APIs and add the responses to --recordings.', action='store_true')
+    parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel)
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.logging_level)
+
+    if args.record and args.recordings is None:
+        parser.error("--record needs a --recordings file to add to")
+
+    record_file = open(args.recordings, 'a') if args.record else None
+    server = make_server(args, args.host, args.port, record_file=record_file)
+    logging.info(f"serving at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if record_file is not None:
+            record_file.close()
+
+if __name__ == "__main__":
+    main()
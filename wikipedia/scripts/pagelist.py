@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# The list of pages we track for each project, built from the
+# real-time-covid-tracker database and the English WikiProject article
+# file.
+#
+# Titles are normalized the way MediaWiki does it ("Foo_bar" and " foo bar"
+# are both "Foo bar") and deduplicated, keeping the order they were first
+# seen in. The result is kept in a small sqlite cache which is rebuilt
+# whenever one of the source files changes.
+#
+###############################################################################
+
+import sqlite3
+import logging
+import json
+import re
+from os import path, stat
+
+# projects where titles are case sensitive, so the first letter is kept as is
+case_sensitive_sites = {'wiktionary'}
+
+def normalize_title(title, project=None):
+    title = re.sub(r'[\s_]+', ' ', title).strip()
+    if title and (project is None or project.split('.')[-1] not in case_sensitive_sites):
+        first = title[0].upper()
+        # MediaWiki leaves letters like ß alone rather than turning them into two
+        if len(first) == 1:
+            title = first + title[1:]
+    return title
+
+def _source_key(source_paths):
+    key = []
+    for source_path in source_paths:
+        source_stat = stat(source_path)
+        key.append([path.abspath(source_path), source_stat.st_mtime_ns, source_stat.st_size])
+    return json.dumps(key)
+
+class PageList:
+    def __init__(self, db_path=None, wikiproject_file=None, cache_path=None, wikiproject_project="en.wikipedia"):
+        self.db_path = db_path
+        self.wikiproject_file = wikiproject_file
+        self.wikiproject_project = wikiproject_project
+
+        source_paths = [source_path for source_path in (db_path, wikiproject_file) if source_path is not None]
+        source_key = _source_key(source_paths)
+
+        self.conn = sqlite3.connect(cache_path if cache_path is not None else ':memory:', check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache_info (source_key TEXT NOT NULL);")
+        # pages come back in order straight from the primary key, and the
+        # title index answers membership checks without touching the table
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                               project TEXT NOT NULL,
+                               position INTEGER NOT NULL,
+                               title TEXT NOT NULL,
+                               PRIMARY KEY (project, position)) WITHOUT ROWID;""")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS pages_title ON pages (project, title);")
+
+        cached_key = self.conn.execute("SELECT source_key FROM cache_info;").fetchone()
+        if cached_key is not None and cached_key[0] == source_key:
+            logging.info(f"using cached page list from {cache_path}")
+        else:
+            self.rebuild(source_key)
+
+    def _read_sources(self):
+        if self.db_path is not None:
+            db = sqlite3.connect(self.db_path)
+            try:
+                # one pass over the table instead of one query per project
+                for project, page in db.execute("SELECT DISTINCT project, page FROM pagesPerProjectTable;"):
+                    yield (project, page)
+            finally:
+                db.close()
+
+        if self.wikiproject_file is not None:
+            with open(self.wikiproject_file, 'r') as infile:
+                for line in infile:
+                    yield (self.wikiproject_project, line)
+
+    def rebuild(self, source_key):
+        logging.info("building page list")
+        positions = {}
+        seen = set()
+        rows = []
+        for project, page in self._read_sources():
+            if page is None:
+                continue
+            title = normalize_title(page, project)
+            if not title or (project, title) in seen:
+                continue
+            seen.add((project, title))
+            position = positions.get(project, 0)
+            positions[project] = position + 1
+            rows.append((project, position, title))
+
+        with self.conn:
+            self.conn.execute("DELETE FROM pages;")
+            self.conn.execute("DELETE FROM cache_info;")
+            self.conn.executemany("INSERT INTO pages (project, position, title) VALUES (?, ?, ?);", rows)
+            self.conn.execute("INSERT INTO cache_info (source_key) VALUES (?);", (source_key,))
+
+        logging.info(f"page list has {len(rows)} pages in {len(positions)} projects")
+
+    def projects(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT project FROM pages ORDER BY project;")]
+
+    def pages(self, project):
+        return [row[0] for row in self.conn.execute("SELECT title FROM pages WHERE project = ? ORDER BY position;", (project,))]
+
+    def __contains__(self, project_title):
+        project, title = project_title
+        row = self.conn.execute("SELECT 1 FROM pages WHERE project = ? AND title = ?;",
+                                (project, normalize_title(title, project))).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM pages;").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+# A consolidated store of daily pageviews, so questions about a page's
+# views across months don't mean opening hundreds of dailyviews tsv files.
+#
+# "ingest" adds the days in the dailyviews tsv files written by
+# fetch_enwiki_daily_views.py, fetch_daily_views.py or
+# ingest_pageview_dumps.py, and "query" looks up one page over a range of
+# dates, or every page on one date.
+#
+# Each project (and agent, since the dumps count "user" where the API
+# counts "all-agents") has a folder holding:
+#   titles.txt  every title seen, one per line; a title's id is its line
+#   ids.u32     a column of title ids, one block per day, sorted by id
+#   views.u32   the matching column of view counts
+#   days.tsv    date, offset and length of each day's block
+# The columns are plain arrays of unsigned 32 bit integers, memory mapped
+# when queried, so a lookup is a binary search in each day's block and
+# reads only the pages it needs. Ingesting a day again replaces it, and
+# once the blocks of replaced days take up too much of the columns they
+# are compacted away.
+#
+###############################################################################
+
+import argparse
+import bisect
+import csv
+import logging
+import mmap
+import shutil
+import sys
+from array import array
+from collections import defaultdict
+from os import path, makedirs, fsync, listdir, replace
+import digobs
+import pagelist
+
+typecode = 'I'
+assert array(typecode).itemsize == 4
+
+# compact a project once the blocks of replaced days are this much of its
+# columns
+default_compact_ratio = 0.25
+
+# the files a compaction rewrites
+compacted_files = ['ids.u32', 'views.u32', 'days.tsv']
+
+class ProjectViews:
+    def __init__(self, folder):
+        self.folder = folder
+        makedirs(folder, exist_ok=True)
+        self.finish_compaction()
+
+        self.titles = []
+        self.title_ids = {}
+        titles_path = path.join(folder, 'titles.txt')
+        if path.exists(titles_path):
+            with open(titles_path, 'r', encoding='utf-8') as infile:
+                for line in infile:
+                    self.intern(line.rstrip('\n'))
+
+        # later lines for a date replace earlier ones
+        self.days = {}
+        days_path = path.join(folder, 'days.tsv')
+        if path.exists(days_path):
+            with open(days_path, 'r') as infile:
+                for line in infile:
+                    date, offset, length = line.split('\t')
+                    self.days[date] = (int(offset), int(length))
+
+        self.ids = None
+        self.views = None
+        self.maps = []
+
+    def intern(self, title):
+        title_id = self.title_ids.get(title, None)
+        if title_id is None:
+            title_id = len(self.titles)
+            self.titles.append(title)
+            self.title_ids[title] = title_id
+        return title_id
+
+    def column_path(self, name):
+        return path.join(self.folder, f"{name}.u32")
+
+    # Maps the columns into memory the first time they're queried.
+    def columns(self):
+        if self.ids is None:
+            self.ids = self.map_column('ids')
+            self.views = self.map_column('views')
+        return (self.ids, self.views)
+
+    def map_column(self, name):
+        column_path = self.column_path(name)
+        if not path.exists(column_path) or path.getsize(column_path) == 0:
+            return memoryview(b'').cast(typecode)
+        with open(column_path, 'rb') as infile:
+            column_map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(column_map)
+        return memoryview(column_map).cast(typecode)
+
+    def unmap(self):
+        for column in (self.ids, self.views):
+            if column is not None:
+                column.release()
+        self.ids = None
+        self.views = None
+        for column_map in self.maps:
+            column_map.close()
+        self.maps = []
+
+    # Adds a day, given as a dictionary of title -> views. New titles are
+    # written first and the day's entry in days.tsv last, so a failed
+    # ingest leaves the store as it was, plus some unused titles and
+    # column space.
+    def add_day(self, date, views):
+        self.unmap()
+        known = len(self.titles)
+        block = sorted((self.intern(title), count) for title, count in views.items())
+
+        with open(path.join(self.folder, 'titles.txt'), 'a', encoding='utf-8') as outfile:
+            for title in self.titles[known:]:
+                outfile.write(title + '\n')
+            outfile.flush()
+            fsync(outfile.fileno())
+
+        # anything past the end of the last block is left over from a
+        # failed ingest
+        end = max((offset + length for offset, length in self.days.values()), default=0)
+        for name, values in (('ids', [title_id for title_id, _ in block]),
+                             ('views', [count for _, count in block])):
+            column_path = self.column_path(name)
+            with open(column_path, 'r+b' if path.exists(column_path) else 'wb') as outfile:
+                outfile.truncate(end * 4)
+                outfile.seek(end * 4)
+                array(typecode, values).tofile(outfile)
+                outfile.flush()
+                fsync(outfile.fileno())
+
+        with open(path.join(self.folder, 'days.tsv'), 'a') as outfile:
+            outfile.write(f"{date}\t{end}\t{len(block)}\n")
+            outfile.flush()
+            fsync(outfile.fileno())
+        self.days[date] = (end, len(block))
+
+    # Rows in the columns that no day points to any more
+    def dead_rows(self):
+        ids_path = self.column_path('ids')
+        size = path.getsize(ids_path) // 4 if path.exists(ids_path) else 0
+        return size - sum(length for offset, length in self.days.values())
+
+    # Rewrites the columns with only the current block of each day, in date
+    # order. The new files are written to a compacting folder and marked
+    # complete before they replace the old ones, so a compaction that is
+    # interrupted is either finished or thrown away the next time the
+    # project is opened.
+    def compact(self):
+        dead = self.dead_rows()
+        if dead <= 0:
+            return 0
+        ids, views = self.columns()
+        compacting = path.join(self.folder, 'compacting')
+        if path.exists(compacting):
+            shutil.rmtree(compacting)
+        makedirs(compacting)
+
+        days = {}
+        end = 0
+        with open(path.join(compacting, 'ids.u32'), 'wb') as ids_file, open(path.join(compacting, 'views.u32'), 'wb') as views_file:
+            for date in sorted(self.days):
+                offset, length = self.days[date]
+                ids_file.write(ids[offset:offset + length])
+                views_file.write(views[offset:offset + length])
+                days[date] = (end, length)
+                end = end + length
+            for outfile in (ids_file, views_file):
+                outfile.flush()
+                fsync(outfile.fileno())
+
+        with open(path.join(compacting, 'days.tsv'), 'w') as outfile:
+            for date, (offset, length) in sorted(days.items()):
+                outfile.write(f"{date}\t{offset}\t{length}\n")
+            outfile.flush()
+            fsync(outfile.fileno())
+
+        with open(path.join(compacting, 'complete'), 'w') as outfile:
+            outfile.flush()
+            fsync(outfile.fileno())
+
+        self.unmap()
+        self.finish_compaction()
+        self.days = days
+        logging.info(f"compacted {dead} rows out of {self.folder}")
+        return dead
+
+    # Moves a complete compaction into place, or throws away one that
+    # didn't finish.
+    def finish_compaction(self):
+        compacting = path.join(self.folder, 'compacting')
+        if not path.exists(compacting):
+            return
+        if path.exists(path.join(compacting, 'complete')):
+            for name in compacted_files:
+                if path.exists(path.join(compacting, name)):
+                    replace(path.join(compacting, name), path.join(self.folder, name))
+        shutil.rmtree(compacting)
+
+    # Views of title on each date from start to end (inclusive, YYYYMMDD)
+    # that the store has, as a list of (date, views). A date the store has
+    # but the page isn't in has 0 views.
+    def page_views(self, title, start, end):
+        title_id = self.title_ids.get(title, None)
+        ids, views = self.columns()
+        series = []
+        for date in sorted(date for date in self.days if start <= date <= end):
+            offset, length = self.days[date]
+            count = 0
+            if title_id is not None:
+                i = bisect.bisect_left(ids, title_id, offset, offset + length)
+                if i < offset + length and ids[i] == title_id:
+                    count = views[i]
+            series.append((date, count))
+        return series
+
+    # Views of every page on date, as a list of (title, views), or None if
+    # the store doesn't have that date.
+    def day_views(self, date):
+        if date not in self.days:
+            return None
+        offset, length = self.days[date]
+        ids, views = self.columns()
+        return [(self.titles[ids[i]], views[i]) for i in range(offset, offset + length)]
+
+    def close(self):
+        self.unmap()
+
+# The views of every project in the store, under folder.
+class PageviewStore:
+    def __init__(self, folder="wikipedia/data/pageview_store", compact_ratio=default_compact_ratio):
+        self.folder = folder
+        self.compact_ratio = compact_ratio
+        self.projects = {}
+
+    def project(self, project, agent='all-agents'):
+        if (project, agent) not in self.projects:
+            self.projects[(project, agent)] = ProjectViews(path.join(self.folder, project, agent))
+        return self.projects[(project, agent)]
+
+    def add_day(self, project, date, views, agent='all-agents'):
+        self.project(project, agent).add_day(date, views)
+
+    def page_views(self, project, title, start, end, agent='all-agents'):
+        return self.project(project, agent).page_views(pagelist.normalize_title(title, project), start, end)
+
+    def day_views(self, project, date, agent='all-agents'):
+        return self.project(project, agent).day_views(date)
+
+    # Adds every day in the dailyviews tsv files. The days of one call are
+    # gathered from all of the files before any is added, so a day can
+    # be spread over several files.
+    def ingest(self, tsv_filenames):
+        days = defaultdict(dict)
+        for tsv_filename in tsv_filenames:
+            if not path.exists(tsv_filename):
+                logging.warning(f"Warning: {tsv_filename} doesn't exist, skipping it")
+                continue
+            with open(tsv_filename, 'r', newline='', encoding='utf-8') as infile:
+                for row in csv.DictReader(infile, delimiter='\t'):
+                    key = (row['project'], row['agent'], row['timestamp'][:8])
+                    days[key][pagelist.normalize_title(row['article'], row['project'])] = int(row['views'])
+
+        for (project, agent, date), views in sorted(days.items()):
+            logging.info(f"adding {len(views)} pages on {date} to {project} {agent}")
+            self.add_day(project, date, views, agent)
+
+        for project, agent in sorted(set((project, agent) for project, agent, date in days)):
+            project_views = self.project(project, agent)
+            if project_views.dead_rows() > self.compact_ratio * max(1, path.getsize(project_views.column_path('ids')) // 4):
+                project_views.compact()
+        return sorted(days)
+
+    # Compacts every project in the store, however little it would save.
+    def compact(self):
+        for project in sorted(listdir(self.folder)) if path.exists(self.folder) else []:
+            for agent in sorted(listdir(path.join(self.folder, project))):
+                self.project(project, agent).compact()
+
+    def close(self):
+        for project in self.projects.values():
+            project.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Add daily view files to the consolidated pageview store, or look views up in it.')
+    parser.add_argument('-s', '--store', help='Folder of the pageview store. Default: wikipedia/data/pageview_store.', default="wikipedia/data/pageview_store", type=str)
+    parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='Add the days in dailyviews tsv files to the store, replacing any it already has.')
+    ingest_parser.add_argument('tsv_files', help='dailyviews tsv files to add', nargs='+', type=str)
+    ingest_parser.add_argument('--compact_ratio', help='Compact a project once the blocks of replaced days are this fraction of its columns. Default: 0.25.', default=default_compact_ratio, type=float)
+
+    subparsers.add_parser('compact', help='Drop the blocks of replaced days from every project now.')
+
+    query_parser = subparsers.add_parser('query', help='Print the views of one page over a range of dates, or of every page on one date, as tsv.')
+    query_parser.add_argument('-p', '--project', help='Project to look in. Default: en.wikipedia.', default='en.wikipedia', type=str)
+    query_parser.add_argument('--agent', help='Agent the views were counted for: all-agents from the API, user from the dumps. Default: all-agents.', default='all-agents', type=str)
+    query_parser.add_argument('-t', '--title', help='Page to look up. Leave out for every page on --start.', type=str, default=None)
+    query_parser.add_argument('--start', help='First date, in YYYYMMDD format.', type=str, required=True)
+    query_parser.add_argument('--end', help='Last date, in YYYYMMDD format. Default: --start.', type=str, default=None)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.logging_level)
+
+    store = PageviewStore(args.store, getattr(args, 'compact_ratio', default_compact_ratio))
+    if args.command == 'ingest':
+        store.ingest(args.tsv_files)
+    elif args.command == 'compact':
+        store.compact()
+    elif args.title is not None:
+        writer = csv.writer(sys.stdout, delimiter='\t')
+        writer.writerow(['date', 'views'])
+        writer.writerows(store.page_views(args.project, args.title, args.start, args.end or args.start, args.agent))
+    else:
+        views = store.day_views(args.project, args.start, args.agent)
+        if views is None:
+            logging.error(f"the store has no views for {args.project} on {args.start}")
+        else:
+            writer = csv.writer(sys.stdout, delimiter='\t')
+            writer.writerow(['title', 'views'])
+            writer.writerows(views)
+    store.close()
+
+if __name__ == "__main__":
+    main()
@@ -19,13 +19,13 @@
 
 import argparse
 import subprocess
-import requests
 import datetime
 import logging
 import re
 import math
 from bs4 import BeautifulSoup
 import digobs
+from digobs_common import http_cache
 
 def parse_args():
 
@@ -33,6 +33,9 @@ def parse_args():
     parser.add_argument('-o', '--output_file', help='Where to save output', default="wikipedia/resources/enwp_wikiproject_covid19_articles.txt", type=str)
     parser.add_argument('-L', '--logging_level', help='Logging level. Options are debug, info, warning, error, critical. Default: info.', default='info', type=digobs.get_loglevel), 
     parser.add_argument('-W', '--logging_destination', help='Logging destination file. (default: standard error)', type=str), 
+    parser.add_argument('--http_cache', help="Folder of the on-disk HTTP response cache shared by the Wikipedia scripts, or '' for none. Default: wikipedia/data/http_cache.", type=str, default=digobs.http_cache_folder)
+    parser.add_argument('--http_cache_size', help="Size in MB the HTTP response cache is kept under, by dropping the least recently used responses. Default: 2048.", type=float, default=2048)
+    parser.add_argument('--metrics_file', help="Where to write request and stage metrics for the run, as JSON, or as a Prometheus textfile if it ends in .prom. Default: wikipedia/logs/<script>-<date>.metrics.json.", type=str, default=None)
     args = parser.parse_args()
 
     return(args)
@@ -47,6 +50,7 @@ def main():
         logging.basicConfig(filename=args.logging_destination, filemode='a', level=args.logging_level)
     else:
         logging.basicConfig(level=args.logging_level)
+    http_cache.configure(args.http_cache or None, int(args.http_cache_size * 1024 ** 2))
 
     export_git_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
     export_git_short_hash = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
@@ -55,6 +59,9 @@ def main():
     logging.info(f"Starting at {export_time} and destructively outputting article list to {outputFile}.")
     logging.info(f"Last commit: {export_git_hash}")
 
+    # the metrics are written even if the scrape fails part way
+    digobs.metrics.write_at_exit(args.metrics_file or digobs.metrics_filename("wikiproject_scraper", datetime.datetime.today().strftime("%Y%m%d")), "wikiproject_scraper")
+
     def trim_title(title):
         title = re.sub(r'^Talk:(.*)$', r'\1', title)
         title = re.sub(r'^(\w+) talk(:.*)$', r'\1\2', title) 
@@ -66,27 +73,34 @@ def main():
             article_names.append(trim_title(cat["title"]))
         return article_names
 
-    url = "https://en.wikipedia.org/w/api.php"
+    url = digobs.api_url.format(project="en.wikipedia")
     parameters = {'action' : 'query',
                  'format' : 'json',
                  'list' : 'categorymembers',
                  'cmtitle' : 'Category:WikiProject_COVID-19_articles',
                  'cmlimit' : 500}
 
-    articleNames = []
-    while True:
-        rv = requests.get(url, parameters)
-        res_json = rv.json()
-        articleNames.extend(get_titles_from_json(res_json))
+    # the shared session, so the scrape is rate limited, retried and
+    # counted in the metrics like the fetchers' requests
+    session = digobs.get_http_session()
 
-        if 'continue' in res_json:
-            parameters.update(res_json['continue'])
-        else:
-            break
+    articleNames = []
+    with digobs.metrics.stage("scrape", "en.wikipedia"):
+        while True:
+            rv = session.get(url, params=parameters)
+            res_json = rv.json()
+            articleNames.extend(get_titles_from_json(res_json))
+
+            if 'continue' in res_json:
+                parameters.update(res_json['continue'])
+            else:
+                break
+    digobs.metrics.add_rows("scrape", len(articleNames), "en.wikipedia")
 
     with open(outputFile, 'w') as f:
         f.write('\n'.join(articleNames)+'\n')
     logging.debug(f"Finished scrape and made a new article file at {datetime.datetime.now()}")
+    digobs.metrics.finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+# fixtures shared by the tests of the Wikipedia scripts
+import sys
+import threading
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'scripts'))
+import digobs
+import mock_wikimedia_server
+
+# mock_wikimedia_server.py running in a thread, with digobs pointed at it
+# through a rate limiter of its own that lets the tests go as fast as they
+# like, and no response cache. Set attributes like error_rate on the server
+# to make it misbehave.
+@pytest.fixture
+def mock_server(monkeypatch):
+    digobs.http_cache.configure(None)
+    wiki = mock_wikimedia_server.MockWiki(revisions_per_page=20, content_size=50, category_size=30)
+    server = mock_wikimedia_server.MockServer(('127.0.0.1', 0), wiki)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(digobs, 'view_api_url', server.base_url + mock_wikimedia_server.pageview_prefix.rstrip('/'))
+    monkeypatch.setattr(digobs, 'api_url', server.base_url + "/{project}/w/api.php")
+    monkeypatch.setattr(digobs, 'rate_limiter', digobs.RateLimiter({'127.0.0.1' : 1000}, max_tries=3, base_delay=0.01, metrics=digobs.metrics))
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,80 @@
+# tests of the parquet and feather outputs
+import io
+from csv import DictWriter
+from datetime import datetime, timezone
+
+import pytest
+
+import digobs
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.feather
+import pyarrow.parquet
+
+rows = [{'title' : "Pandemic", 'pageid' : 1, 'namespace' : 0, 'revid' : 10, 'timestamp' : "2020-04-01T12:00:00Z",
+         'user' : "Someone", 'userid' : 5, 'size' : 100, 'sha1' : "abc", 'contentmodel' : "wikitext",
+         'anon' : False, 'minor' : True, 'url' : "https://en.wikipedia.org/w/index.php?oldid=10",
+         'export_timestamp' : "2020-04-02", 'export_commit' : "abc123"},
+        # a hidden user, written to the tsv as empty strings
+        {'title' : "Pandemic", 'pageid' : 1, 'namespace' : 0, 'revid' : 11, 'timestamp' : "2020-04-01T13:00:00Z",
+         'user' : '', 'userid' : '', 'size' : 120, 'sha1' : "def", 'contentmodel' : "wikitext",
+         'anon' : '', 'minor' : False, 'url' : "https://en.wikipedia.org/w/index.php?oldid=11",
+         'export_timestamp' : "2020-04-02", 'export_commit' : "abc123"}]
+
+def read(filename, format):
+    if format == 'parquet':
+        return pyarrow.parquet.read_table(filename)
+    else:
+        return pyarrow.feather.read_table(filename)
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_columnar_writer(tmp_path, format):
+    filename = str(tmp_path / f"revisions.{format}")
+    with digobs.ColumnarWriter(filename, digobs.revision_columns, format=format, row_group_size=1) as writer:
+        writer.writerows(rows)
+
+    table = read(filename, format)
+    assert table.num_rows == 2
+    assert table.column('revid').to_pylist() == [10, 11]
+    assert table.column('user').to_pylist() == ["Someone", None]
+    assert table.column('anon').to_pylist() == [False, None]
+    assert table.column('timestamp').to_pylist()[0] == datetime(2020, 4, 1, 12, tzinfo=timezone.utc)
+    assert table.schema.field('namespace').type == pa.int32()
+    if format == 'parquet':
+        assert pa.types.is_dictionary(table.schema.field('title').type)
+        assert pyarrow.parquet.ParquetFile(filename).num_row_groups == 2
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        digobs.ColumnarWriter(str(tmp_path / "views.csv"), digobs.view_columns, format='csv')
+
+# a resumed job rebuilds its columnar file from the tsv, where everything
+# is a string
+def test_tsv_to_columnar(tmp_path):
+    tsv_filename = tmp_path / "revisions.tsv"
+    with open(tsv_filename, 'w', newline='') as tsv_file:
+        writer = DictWriter(tsv_file, list(digobs.revision_columns), delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    digobs.tsv_to_columnar(str(tsv_filename), str(tmp_path / "revisions.parquet"), digobs.revision_columns)
+    direct = tmp_path / "direct.parquet"
+    with digobs.ColumnarWriter(str(direct), digobs.revision_columns) as writer:
+        writer.writerows(rows)
+    assert read(str(tmp_path / "revisions.parquet"), 'parquet').equals(read(str(direct), 'parquet'))
+
+def test_row_writers():
+    first = io.StringIO()
+    writer = DictWriter(first, ['a'], delimiter='\t')
+    collected = []
+    class Collect:
+        def writerow(self, row):
+            collected.append(row)
+        def writerows(self, rows):
+            collected.extend(rows)
+
+    writers = digobs.RowWriters(writer, None, Collect())
+    writers.writerow({'a' : 1})
+    writers.writerows([{'a' : 2}, {'a' : 3}])
+    assert first.getvalue().split() == ["1", "2", "3"]
+    assert collected == [{'a' : 1}, {'a' : 2}, {'a' : 3}]
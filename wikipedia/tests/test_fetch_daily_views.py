@@ -0,0 +1,85 @@
+# tests of fetch_daily_views.py fetching several projects at once, against
+# mock_wikimedia_server.py
+import json
+import runpy
+import sqlite3
+import sys
+import zlib
+from os import path
+
+import digobs
+
+scripts = path.join(path.dirname(path.abspath(__file__)), '..', 'scripts')
+
+def expected_views(article, date):
+    return zlib.crc32(f"{article}{date}".encode()) % 1000 + 1
+
+def write_db(filename, project_pages):
+    db = sqlite3.connect(filename)
+    db.execute("CREATE TABLE pagesPerProjectTable (project TEXT, page TEXT);")
+    db.executemany("INSERT INTO pagesPerProjectTable (project, page) VALUES (?, ?);",
+                   [(project, page) for project, pages in project_pages.items() for page in pages])
+    db.commit()
+    db.close()
+    return str(filename)
+
+def run_fetch_daily_views(tmp_path, monkeypatch, *extra_args):
+    input_file = tmp_path / "articles.txt"
+    input_file.write_text("Mock article 1\nMock article 2\nMissing article\n")
+    input_db = write_db(tmp_path / "items.sqlite", {"de.wikipedia" : ["Mock article 3"],
+                                                    "fr.wikipedia" : ["Mock article 4", "Mock article 5"]})
+    (tmp_path / "data").mkdir()
+    # the metrics sidecar would otherwise be written when the tests exit
+    monkeypatch.setattr(digobs.metrics, 'write_at_exit', lambda filename, job=None: None)
+    monkeypatch.setattr(sys, 'argv', ['fetch_daily_views.py',
+                                      '-o', str(tmp_path / "data"),
+                                      '-i', str(input_file),
+                                      '-b', input_db,
+                                      '--pagelist_cache', str(tmp_path / "pagelist_cache.sqlite"),
+                                      '--title_cache', str(tmp_path / "title_cache.sqlite"),
+                                      '--journal', str(tmp_path / "journal.sqlite"),
+                                      '--http_cache', '',
+                                      '-d', '20200401',
+                                      *extra_args])
+    runpy.run_path(path.join(scripts, 'fetch_daily_views.py'), run_name='__main__')
+    return tmp_path / "data"
+
+def read_tsv_views(output_folder, project):
+    filename = output_folder / project / "20200401" / f"digobs_covid19_{project}_dailyviews-20200401.tsv"
+    lines = filename.read_text().splitlines()[1:]
+    return [(fields[2], int(fields[6])) for fields in (line.split('\t') for line in lines)]
+
+def test_projects_in_parallel(mock_server, tmp_path, monkeypatch):
+    output_folder = run_fetch_daily_views(tmp_path, monkeypatch, '-P', '3', '-c', '2')
+
+    assert read_tsv_views(output_folder, "en.wikipedia") == [(article, expected_views(article, "20200401"))
+                                                             for article in ("Mock_article_1", "Mock_article_2")]
+    assert read_tsv_views(output_folder, "de.wikipedia") == [("Mock_article_3", expected_views("Mock_article_3", "20200401"))]
+    assert [article for article, views in read_tsv_views(output_folder, "fr.wikipedia")] == ["Mock_article_4", "Mock_article_5"]
+
+    items = [json.loads(line) for line in open(output_folder / "fr.wikipedia" / "20200401" / "digobs_covid19_fr.wikipedia_dailyviews-20200401.json")]
+    assert [item['project'] for item in items] == ["fr.wikipedia", "fr.wikipedia"]
+
+    # one pageview request per page of every project, apart from the
+    # missing one the title resolver drops
+    assert mock_server.stats()['requests']['pageviews'] == 5
+
+# a project that fails doesn't stop the others, and leaves the journal
+# open for --resume
+def test_failed_project(mock_server, tmp_path, monkeypatch):
+    fetch_views = digobs.fetch_views
+    def failing_fetch_views(pages, project, *args, **kwargs):
+        if project == "de.wikipedia":
+            raise RuntimeError("de.wikipedia is down")
+        return fetch_views(pages, project, *args, **kwargs)
+    monkeypatch.setattr(digobs, 'fetch_views', failing_fetch_views)
+
+    output_folder = run_fetch_daily_views(tmp_path, monkeypatch)
+    assert len(read_tsv_views(output_folder, "en.wikipedia")) == 2
+    assert len(read_tsv_views(output_folder, "fr.wikipedia")) == 2
+
+    journal = digobs.RunJournal(str(tmp_path / "journal.sqlite"), "fetch_daily_views", resume=True)
+    assert journal.resuming
+    assert journal.done("fr.wikipedia", "Mock article 4", "20200401")
+    assert not journal.done("de.wikipedia", "Mock article 3", "20200401")
+    journal.close()
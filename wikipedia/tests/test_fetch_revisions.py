@@ -0,0 +1,77 @@
+# tests of fetch_revisions.py streaming histories into journaled segments,
+# against mock_wikimedia_server.py
+import gc
+import glob
+import json
+import sqlite3
+import sys
+
+import pytest
+
+import digobs
+import fetch_revisions
+
+def run_fetch_revisions(tmp_path, monkeypatch, *extra_args):
+    input_file = tmp_path / "articles.txt"
+    input_file.write_text("".join(f"Mock article {n}\n" for n in range(5)))
+    input_db = tmp_path / "items.sqlite"
+    if not input_db.exists():
+        db = sqlite3.connect(str(input_db))
+        db.execute("CREATE TABLE pagesPerProjectTable (project TEXT, page TEXT);")
+        db.commit()
+        db.close()
+    (tmp_path / "data").mkdir(exist_ok=True)
+
+    # the metrics sidecar would otherwise be written when the tests exit
+    monkeypatch.setattr(digobs.metrics, 'write_at_exit', lambda filename, job=None: None)
+    monkeypatch.setattr(sys, 'argv', ['fetch_revisions.py',
+                                      '-o', str(tmp_path / "data"),
+                                      '-i', str(input_file),
+                                      '-d', str(input_db),
+                                      '--pagelist_cache', str(tmp_path / "pagelist_cache.sqlite"),
+                                      '--title_cache', str(tmp_path / "title_cache.sqlite"),
+                                      '--state_db', str(tmp_path / "state.sqlite"),
+                                      '--journal', str(tmp_path / "journal.sqlite"),
+                                      '--http_cache', '',
+                                      *extra_args])
+    fetch_revisions.main()
+
+def read_outputs(tmp_path):
+    json_filename, = glob.glob(str(tmp_path / "data" / "en.wikipedia" / "*" / "*_revisions-*.json"))
+    tsv_filename, = glob.glob(str(tmp_path / "data" / "en.wikipedia" / "*" / "*_revisions-*.tsv"))
+    with open(json_filename) as infile:
+        batches = [json.loads(line) for line in infile]
+    with open(tsv_filename) as infile:
+        rows = [line.split('\t') for line in infile.read().splitlines()]
+    return (batches, rows)
+
+def batch_titles(batches):
+    return [page['title'] for batch in batches for page in batch['query']['pages'].values()]
+
+# a page that fails part way through its history leaves nothing behind, so
+# the resumed run writes each page exactly once
+def test_resume_after_failed_page(mock_server, tmp_path, monkeypatch):
+    get_revisions_for_page = digobs.get_revisions_for_page
+    def failing_history(title, *args, **kwargs):
+        batches = get_revisions_for_page(title, *args, **kwargs)
+        if title == "Mock article 3":
+            yield next(iter(batches))
+            raise RuntimeError("connection lost")
+        yield from batches
+    monkeypatch.setattr(digobs, 'get_revisions_for_page', failing_history)
+
+    with pytest.raises(RuntimeError):
+        run_fetch_revisions(tmp_path, monkeypatch, '--segment_size', '2')
+    # let go of the failed run's databases, as its process exiting would
+    gc.collect()
+    batches, rows = read_outputs(tmp_path)
+    assert batch_titles(batches) == ["Mock article 0", "Mock article 1"]
+    assert len(rows) == 1 + 2 * 20
+
+    monkeypatch.setattr(digobs, 'get_revisions_for_page', get_revisions_for_page)
+    run_fetch_revisions(tmp_path, monkeypatch, '--segment_size', '2', '--resume')
+    batches, rows = read_outputs(tmp_path)
+    assert batch_titles(batches) == [f"Mock article {n}" for n in range(5)]
+    assert rows[0][0] == "title"
+    assert [row[0] for row in rows[1:]] == [f"Mock article {n}" for n in range(5) for revision in range(20)]
+    assert len(set(row[3] for row in rows[1:])) == 5 * 20
@@ -0,0 +1,87 @@
+# tests of fetching pageviews concurrently, against mock_wikimedia_server.py
+import io
+import json
+import threading
+import time
+import zlib
+
+import digobs
+
+def expected_views(article, date):
+    return zlib.crc32(f"{article}{date}".encode()) % 1000 + 1
+
+def test_map_concurrent_keeps_order():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def slow_square(n):
+        with lock:
+            running[0] = running[0] + 1
+            running[1] = max(running[1], running[0])
+        # later items finish first
+        time.sleep(0.001 * (20 - n))
+        with lock:
+            running[0] = running[0] - 1
+        return n * n
+
+    assert list(digobs.map_concurrent(slow_square, range(20), concurrency=4)) == [n * n for n in range(20)]
+    assert 1 < running[1] <= 4
+    assert list(digobs.map_concurrent(slow_square, range(5), concurrency=1)) == [n * n for n in range(5)]
+
+def test_fetch_views(mock_server):
+    pages = ["Mock article 1", "Missing article", "Mock article 2"]
+    responses = list(digobs.fetch_views(pages, "en.wikipedia", "20200401", concurrency=4))
+
+    assert responses[1] is None
+    assert [response['article'] for response in (responses[0], responses[2])] == ["Mock_article_1", "Mock_article_2"]
+    assert responses[0]['views'] == expected_views("Mock_article_1", "20200401")
+    assert mock_server.stats()['requests'] == {'pageviews' : 3}
+
+def test_process_view_responses(mock_server):
+    pages = [f"Mock article {n}" for n in range(10)] + ["Missing article"]
+    j_outfile = io.StringIO()
+    t_outfile = io.StringIO()
+    successes, failures = digobs.process_view_responses(digobs.fetch_views(pages, "en.wikipedia", "20200401", concurrency=3),
+                                                        j_outfile, t_outfile)
+    assert (successes, failures) == (10, 1)
+
+    items = [json.loads(line) for line in j_outfile.getvalue().splitlines()]
+    assert [item['article'] for item in items] == [page.replace(' ', '_') for page in pages[:10]]
+
+    lines = t_outfile.getvalue().splitlines()
+    assert lines[0] == "access\tagent\tarticle\tgranularity\tproject\ttimestamp\tviews"
+    assert lines[1] == f"all-access\tall-agents\tMock_article_0\tdaily\ten.wikipedia\t2020040100\t{expected_views('Mock_article_0', '20200401')}"
+    assert len(lines) == 11
+
+def test_date_range():
+    assert digobs.date_range("20200228", "20200302") == ["20200228", "20200229", "20200301", "20200302"]
+    assert digobs.date_range("20200401", "20200401") == ["20200401"]
+
+def test_view_range_is_split_by_day(mock_server):
+    dates = ["20200401", "20200402", "20200403"]
+    pages = ["Mock article 1", "Missing article", "Mock article 2"]
+    outfiles = {date : (io.StringIO(), io.StringIO(), None) for date in dates}
+    counts = digobs.process_view_range_responses(digobs.fetch_view_range(pages, "en.wikipedia", dates[0], dates[-1]), outfiles)
+
+    # one request per page for the whole range
+    assert mock_server.stats()['requests'] == {'pageviews' : 3}
+    assert counts == {date : (2, 1) for date in dates}
+    for date, (j_outfile, t_outfile, _) in outfiles.items():
+        items = [json.loads(line) for line in j_outfile.getvalue().splitlines()]
+        assert [(item['article'], item['timestamp'], item['views']) for item in items] == \
+               [(article, f"{date}00", expected_views(article, date)) for article in ("Mock_article_1", "Mock_article_2")]
+        assert t_outfile.getvalue().splitlines()[0] == "access\tagent\tarticle\tgranularity\tproject\ttimestamp\tviews"
+
+# a day the API has no item for counts as a failure for that day only, like
+# a single day request for it would have
+def test_view_range_with_missing_days():
+    def item(article, date):
+        return {'project' : 'en.wikipedia', 'article' : article, 'granularity' : 'daily', 'timestamp' : f"{date}00",
+                'access' : 'all-access', 'agent' : 'all-agents', 'views' : 1}
+
+    responses = [[item("A", "20200401"), item("A", "20200402")], [item("B", "20200402")], None]
+    outfiles = {date : (io.StringIO(), io.StringIO(), None) for date in ("20200401", "20200402")}
+    counts = digobs.process_view_range_responses(responses, outfiles)
+    assert counts == {"20200401" : (1, 2), "20200402" : (2, 1)}
+    assert len(outfiles["20200401"][1].getvalue().splitlines()) == 2
+    assert len(outfiles["20200402"][1].getvalue().splitlines()) == 3
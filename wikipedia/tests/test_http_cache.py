@@ -0,0 +1,163 @@
+# tests of the on-disk HTTP response cache
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from os import path
+
+import pytest
+import requests
+
+from digobs_common import http_cache
+
+url = "https://example.org/w/api.php"
+
+def make_response(status=200, body=b'{"ok": true}', headers={}):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers)
+    response._content = body
+    return response
+
+# a send() for ResponseCache.request that answers with each of responses in
+# turn, and keeps the headers of each request
+def sends(*responses):
+    responses = list(responses)
+    requests_seen = []
+    def send(**kwargs):
+        requests_seen.append(kwargs.get('headers', None) or {})
+        return responses[len(requests_seen) - 1]
+    return (send, requests_seen)
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = http_cache.ResponseCache(str(tmp_path / "http_cache"), ttls=[(r'action=query', 60)])
+    yield cache
+    cache.close()
+
+# pretend the entries were stored seconds ago
+def age(cache, seconds):
+    with cache.conn:
+        cache.conn.execute("UPDATE responses SET stored = stored - ?;", (seconds,))
+
+def test_hits_and_misses(cache):
+    send, seen = sends(make_response(body=b'first'), make_response(body=b'second'))
+    assert cache.request(send, 'GET', url, params={'action' : 'query'}).content == b'first'
+    response = cache.request(send, 'GET', url, params={'action' : 'query'})
+    assert response.content == b'first' and response.from_cache
+    assert len(seen) == 1
+
+    # different parameters, a different entry
+    assert cache.request(send, 'GET', url, params={'action' : 'query', 'titles' : 'A'}).content == b'second'
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+def test_what_is_not_cached(cache):
+    send, seen = sends(*[make_response() for i in range(5)])
+    # no TTL for this endpoint
+    cache.request(send, 'GET', url, params={'action' : 'parse'})
+    cache.request(send, 'GET', url, params={'action' : 'parse'})
+    # not a GET
+    cache.request(send, 'POST', url, params={'action' : 'query'}, data={'titles' : 'A'})
+    assert len(seen) == 3
+
+    send, seen = sends(make_response(status=503), make_response(headers={'Cache-Control' : 'no-store'}), make_response())
+    for i in range(3):
+        cache.request(send, 'GET', url, params={'action' : 'query'})
+    assert len(seen) == 3
+    assert cache.stats()['stored'] == 1
+
+def test_stale_entries_are_revalidated(cache):
+    send, seen = sends(make_response(body=b'cached', headers={'ETag' : '"v1"', 'Last-Modified' : 'Wed, 01 Apr 2020 00:00:00 GMT'}),
+                       make_response(status=304, headers={'ETag' : '"v1"'}),
+                       make_response(body=b'changed', headers={'ETag' : '"v2"'}))
+    cache.request(send, 'GET', url, params={'action' : 'query'})
+
+    age(cache, 120)
+    response = cache.request(send, 'GET', url, params={'action' : 'query'})
+    assert response.status_code == 200 and response.content == b'cached'
+    assert seen[1] == {'If-None-Match' : '"v1"', 'If-Modified-Since' : 'Wed, 01 Apr 2020 00:00:00 GMT'}
+    assert cache.stats()['revalidated'] == 1
+
+    # the 304 made it fresh again
+    cache.request(send, 'GET', url, params={'action' : 'query'})
+    assert len(seen) == 2
+
+    age(cache, 120)
+    assert cache.request(send, 'GET', url, params={'action' : 'query'}).content == b'changed'
+    assert cache.request(send, 'GET', url, params={'action' : 'query'}).content == b'changed'
+    assert len(seen) == 3
+
+def test_stale_entries_without_validators_are_fetched_again(cache):
+    send, seen = sends(make_response(body=b'old'), make_response(body=b'new'))
+    cache.request(send, 'GET', url, params={'action' : 'query'})
+    age(cache, 120)
+    assert cache.request(send, 'GET', url, params={'action' : 'query'}).content == b'new'
+    assert seen[1] == {}
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = http_cache.ResponseCache(str(tmp_path / "http_cache"), ttls=[(r'action=query', 60)])
+    send, seen = sends(*[make_response(body=bytes(range(256)) * 40 + bytes([n])) for n in range(4)])
+    for n in range(3):
+        cache.request(send, 'GET', url, params={'action' : 'query', 'n' : n})
+        time.sleep(0.01)
+    # use the first, so the second is now the least recently used
+    cache.request(send, 'GET', url, params={'action' : 'query', 'n' : 0})
+
+    entry_size = cache.size // 3
+    cache.max_size = int(entry_size * 3.5)
+    cache.request(send, 'GET', url, params={'action' : 'query', 'n' : 3})
+    assert cache.stats()['evicted'] == 1
+    assert cache.size <= 0.9 * cache.max_size
+
+    cached = [cached_url for cached_url, in cache.conn.execute("SELECT url FROM responses;")]
+    assert sorted(re.search(r'n=(\d)', cached_url).group(1) for cached_url in cached) == ['0', '2', '3']
+    cache.close()
+
+# the cache outlives the process that filled it
+def test_reopened_cache(tmp_path):
+    folder = str(tmp_path / "http_cache")
+    cache = http_cache.ResponseCache(folder, ttls=[(r'action=query', 60)])
+    send, seen = sends(make_response(body=b'kept'))
+    cache.request(send, 'GET', url, params={'action' : 'query'})
+    cache.close()
+
+    cache = http_cache.ResponseCache(folder, ttls=[(r'action=query', 60)])
+    assert cache.size > 0
+    assert cache.request(send, 'GET', url, params={'action' : 'query'}).content == b'kept'
+    assert len(seen) == 1
+    cache.close()
+
+def test_default_ttls(tmp_path):
+    cache = http_cache.ResponseCache(str(tmp_path / "http_cache"))
+    old = "https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/en.wikipedia/all-access/all-agents/Pandemic/daily/2020040100/2020040500"
+    assert cache.ttl(old) == 30 * http_cache.day
+    yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y%m%d")
+    assert cache.ttl(old[:-10] + yesterday + "00") == http_cache.hour
+    assert cache.ttl("https://en.wikipedia.org/w/api.php?action=query&list=categorymembers&cmtitle=X") == 12 * http_cache.hour
+    assert cache.ttl("https://meta.wikimedia.org/w/api.php?action=parse&page=X&format=json") == http_cache.day
+    # revisions are never cached
+    assert cache.ttl("https://en.wikipedia.org/w/api.php?action=query&prop=revisions&titles=X") == 0
+    cache.close()
+
+def test_configure(tmp_path):
+    http_cache.configure(None)
+    assert http_cache.shared_cache() is None
+    assert http_cache.CachedSession().cache is None
+
+    http_cache.configure(str(tmp_path / "http_cache"), 1024)
+    try:
+        cache = http_cache.shared_cache()
+        assert cache.max_size == 1024
+        assert http_cache.shared_cache() is cache
+    finally:
+        http_cache.configure(None)
+    assert http_cache.shared_cache() is None
+
+# only a script's main() turns the cache on, not importing its modules
+def test_importing_leaves_the_cache_off():
+    scripts = path.join(path.dirname(path.abspath(__file__)), '..', 'scripts')
+    keywords = path.join(path.dirname(path.abspath(__file__)), '..', '..', 'keywords', 'src')
+    check = "import {module}; from digobs_common import http_cache; assert http_cache.settings['folder'] is None"
+    for folder, module in [(scripts, 'digobs'), (keywords, 'wikidata_api_calls')]:
+        subprocess.run([sys.executable, '-c', check.format(module=module)], cwd=folder, check=True)
@@ -0,0 +1,74 @@
+# tests of building daily view files from hourly pageview dumps, on small
+# dump files written out by the tests
+import gzip
+import json
+import logging
+import sqlite3
+import sys
+from os import path, listdir
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'scripts'))
+import ingest_pageview_dumps
+
+def write_dump(filename, lines):
+    with gzip.open(filename, 'wt') as dump:
+        for line in lines:
+            dump.write(line + "\n")
+    return str(filename)
+
+def write_db(filename, project_pages):
+    db = sqlite3.connect(filename)
+    db.execute("CREATE TABLE pagesPerProjectTable (project TEXT, page TEXT);")
+    db.executemany("INSERT INTO pagesPerProjectTable (project, page) VALUES (?, ?);",
+                   [(project, page) for project, pages in project_pages.items() for page in pages])
+    db.commit()
+    db.close()
+    return str(filename)
+
+def run_ingest(tmp_path, monkeypatch, dumps):
+    wikiproject_file = tmp_path / "articles.txt"
+    wikiproject_file.write_text("Coronavirus disease 2019\nPandemic\n")
+    input_db = write_db(tmp_path / "items.sqlite", {"de.wikipedia" : ["COVID-19-Pandemie"],
+                                                    "www.wikidata" : ["Q84263196"]})
+    output_folder = tmp_path / "data"
+    monkeypatch.setattr(sys, 'argv', ['ingest_pageview_dumps.py', *dumps,
+                                      '-o', str(output_folder),
+                                      '-i', str(wikiproject_file),
+                                      '-b', input_db,
+                                      '--pagelist_cache', str(tmp_path / "pagelist_cache.sqlite"),
+                                      '-p', '1'])
+    ingest_pageview_dumps.main()
+    return output_folder
+
+def read_json(filename):
+    with open(filename) as infile:
+        return [json.loads(line) for line in infile]
+
+def test_daily_views_from_dumps(tmp_path, monkeypatch):
+    dumps = [write_dump(tmp_path / "pageviews-20200401-000000.gz",
+                        ["en Coronavirus_disease_2019 10 0",
+                         "en.m Coronavirus_disease_2019 5 0",
+                         "en Not_tracked 100 0",
+                         "de COVID-19-Pandemie 7 0",
+                         "wikidata Q84263196 3 0"]),
+             write_dump(tmp_path / "pageviews-20200401-010000.gz",
+                        ["en Coronavirus_disease_%32019 2 0",
+                         "en Pandemic 4 0"])]
+    output_folder = run_ingest(tmp_path, monkeypatch, dumps)
+
+    items = read_json(output_folder / "en.wikipedia" / "20200401" / "digobs_covid19_en.wikipedia_dailyviews-20200401.json")
+    assert [(item['article'], item['views']) for item in items] == [("Coronavirus_disease_2019", 17), ("Pandemic", 4)]
+    assert items[0]['timestamp'] == "2020040100"
+    assert items[0]['agent'] == "user"
+
+    items = read_json(output_folder / "de.wikipedia" / "20200401" / "digobs_covid19_de.wikipedia_dailyviews-20200401.json")
+    assert [(item['article'], item['views']) for item in items] == [("COVID-19-Pandemie", 7)]
+
+def test_projects_without_domain_code_are_skipped(tmp_path, monkeypatch, caplog):
+    dumps = [write_dump(tmp_path / "pageviews-20200401-000000.gz",
+                        ["en Pandemic 4 0"])]
+    with caplog.at_level(logging.WARNING):
+        output_folder = run_ingest(tmp_path, monkeypatch, dumps)
+
+    assert sorted(listdir(output_folder)) == ["de.wikipedia", "en.wikipedia"]
+    assert "no pageview dump domain code for www.wikidata" in caplog.text
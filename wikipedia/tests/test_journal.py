@@ -0,0 +1,79 @@
+# tests of RunJournal and journal_segments, which let a failed fetch pick
+# up where it left off with --resume
+import lzma
+
+import pytest
+
+import digobs
+
+def run(journal_path, pages, fail_at=None, resume=False, segment_size=2, compression=None, filename=None):
+    journal = digobs.RunJournal(journal_path, "test job", resume=resume)
+    commits = []
+    with journal.open_output(filename, compression) as output:
+        pairs = (([("en.wikipedia", page, "20200401")], page) for page in pages if not journal.done("en.wikipedia", page, "20200401"))
+        for page in digobs.journal_segments(pairs, journal, [output], segment_size, after_commit=lambda: commits.append(output.size)):
+            if page == fail_at:
+                raise RuntimeError(f"failed on {page}")
+            output.write(f"{page}\n")
+    journal.finish()
+    journal.close()
+    return commits
+
+def test_resume_after_failure(tmp_path):
+    journal_path = str(tmp_path / "journal.sqlite")
+    filename = str(tmp_path / "out.tsv")
+    pages = [f"Page {n}" for n in range(7)]
+
+    with pytest.raises(RuntimeError):
+        run(journal_path, pages, fail_at="Page 5", filename=filename)
+    # the pages of the segment that failed were written, but not committed
+    assert open(filename).read() == "".join(f"Page {n}\n" for n in range(4))
+
+    journal = digobs.RunJournal(journal_path, "test job", resume=True)
+    assert journal.resuming
+    assert journal.done("en.wikipedia", "Page 3", "20200401")
+    assert not journal.done("en.wikipedia", "Page 4", "20200401")
+    journal.close()
+
+    commits = run(journal_path, pages, resume=True, filename=filename)
+    assert open(filename).read() == "".join(f"{page}\n" for page in pages)
+    assert len(commits) == 2
+
+    # a finished job starts over, even with resume
+    run(journal_path, pages[:1], resume=True, filename=filename)
+    assert open(filename).read() == "Page 0\n"
+
+def test_without_resume_the_job_starts_over(tmp_path):
+    journal_path = str(tmp_path / "journal.sqlite")
+    filename = str(tmp_path / "out.tsv")
+    with pytest.raises(RuntimeError):
+        run(journal_path, ["a", "b", "c"], fail_at="c", filename=filename)
+    run(journal_path, ["d"], filename=filename)
+    assert open(filename).read() == "d\n"
+
+def test_resume_compressed(tmp_path):
+    journal_path = str(tmp_path / "journal.sqlite")
+    filename = str(tmp_path / "out.json")
+    pages = [f"Page {n}" for n in range(5)]
+    with pytest.raises(RuntimeError):
+        run(journal_path, pages, fail_at="Page 3", compression='xz', filename=filename)
+    run(journal_path, pages, resume=True, compression='xz', filename=filename)
+    with lzma.open(filename + ".xz", 'rt') as infile:
+        assert infile.read() == "".join(f"{page}\n" for page in pages)
+
+# settings are kept from the run that started the job
+def test_settings(tmp_path):
+    journal_path = str(tmp_path / "journal.sqlite")
+    journal = digobs.RunJournal(journal_path, "test job")
+    assert journal.setting('query_dates', ["20200401"]) == ["20200401"]
+    journal.close()
+
+    journal = digobs.RunJournal(journal_path, "test job", resume=True)
+    assert journal.setting('query_dates', ["20200402"]) == ["20200401"]
+    journal.close()
+
+    # other jobs in the same database are separate
+    journal = digobs.RunJournal(journal_path, "other job", resume=True)
+    assert not journal.resuming
+    assert journal.setting('query_dates', ["20200402"]) == ["20200402"]
+    journal.close()
@@ -0,0 +1,76 @@
+# tests of the request and stage metrics written next to each run
+import json
+
+import digobs
+
+def test_endpoint_name():
+    assert digobs.endpoint_name("https://en.wikipedia.org/w/api.php?action=query") == "en.wikipedia.org/w/api.php"
+    assert digobs.endpoint_name("https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/de.wikipedia/all-access/all-agents/Pandemie/daily/2020040100/2020040100") == \
+        "wikimedia.org/api/rest_v1/metrics/pageviews/per-article/de.wikipedia"
+
+def test_requests_and_stages(monkeypatch):
+    monkeypatch.setattr(digobs.http_cache, 'shared', None)
+    metrics = digobs.Metrics()
+    url = "https://en.wikipedia.org/w/api.php"
+    metrics.record_request(url, 0.01, 200, size=100)
+    metrics.record_request(url, 0.3, 503)
+    metrics.record_retry(url)
+    metrics.record_request(url, 100, 'ConnectionError')
+    metrics.record_give_up(url)
+    for segment in range(2):
+        with metrics.stage("fetch_revisions", "en.wikipedia"):
+            metrics.add_rows("fetch_revisions", 10, "en.wikipedia")
+    metrics.add_rows("load_pages", 5)
+
+    summary = metrics.summary("test job")
+    assert (summary['job'], summary['complete']) == ("test job", False)
+    assert (summary['requests'], summary['bytes'], summary['retries']) == (3, 100, 1)
+    endpoint = summary['endpoints']["en.wikipedia.org/w/api.php"]
+    assert endpoint['statuses'] == {'200' : 1, '503' : 1, 'ConnectionError' : 1}
+    assert endpoint['given_up'] == 1
+    # cumulative, like a Prometheus histogram
+    assert endpoint['latency_buckets']['0.05'] == 1
+    assert endpoint['latency_buckets']['0.5'] == 2
+    assert endpoint['latency_buckets']['60'] == 2
+    assert endpoint['latency_buckets']['+Inf'] == 3
+
+    stages = {(stage['stage'], stage['project']) : stage for stage in summary['stages']}
+    assert stages[("fetch_revisions", "en.wikipedia")]['runs'] == 2
+    assert stages[("fetch_revisions", "en.wikipedia")]['rows'] == 20
+    assert stages[("load_pages", None)]['runs'] == 0
+
+    metrics.finish()
+    assert metrics.summary()['complete']
+
+def test_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(digobs.http_cache, 'shared', None)
+    metrics = digobs.Metrics()
+    metrics.record_request("https://en.wikipedia.org/w/api.php", 0.01, 200, size=100)
+    with metrics.stage("fetch_views", 'say "hi"'):
+        pass
+
+    filename = str(tmp_path / "logs" / "run.metrics.json")
+    metrics.write(filename, "test job")
+    with open(filename) as infile:
+        assert json.load(infile)['requests'] == 1
+
+    filename = str(tmp_path / "run.prom")
+    metrics.write(filename, "test job")
+    lines = open(filename).read().splitlines()
+    assert 'digobs_run_complete{job="test job"} 0' in lines
+    assert 'digobs_requests_total{job="test job",endpoint="en.wikipedia.org/w/api.php",status="200"} 1' in lines
+    assert 'digobs_request_duration_seconds_count{job="test job",endpoint="en.wikipedia.org/w/api.php"} 1' in lines
+    assert any(line.startswith('digobs_stage_seconds{job="test job",stage="fetch_views",project="say \\"hi\\""}') for line in lines)
+
+def test_metrics_filename():
+    assert digobs.metrics_filename("fetch_daily_views shard 0/4", "20200401") == "wikipedia/logs/fetch_daily_views_shard_0-4-20200401.metrics.json"
+
+# the limiter records every attempt of the requests it makes
+def test_requests_are_recorded(mock_server):
+    before = digobs.metrics.summary()['endpoints']
+    list(digobs.fetch_views(["Mock article 1", "Missing article"], "en.wikipedia", "20200401"))
+    after = digobs.metrics.summary()['endpoints']
+
+    name = digobs.endpoint_name(digobs.view_api_url + "/en.wikipedia/all-access")
+    requests = after[name]['requests'] - (before[name]['requests'] if name in before else 0)
+    assert requests == 2
@@ -0,0 +1,69 @@
+# tests of the normalized, deduplicated page list
+import os
+import sqlite3
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'scripts'))
+import pagelist
+
+def write_db(filename, rows):
+    db = sqlite3.connect(filename)
+    db.execute("CREATE TABLE pagesPerProjectTable (project TEXT, page TEXT);")
+    db.executemany("INSERT INTO pagesPerProjectTable (project, page) VALUES (?, ?);", rows)
+    db.commit()
+    db.close()
+    return str(filename)
+
+@pytest.mark.parametrize('title, project, expected', [("Foo_bar", None, "Foo bar"),
+                                                      ("  foo \t bar_ ", "en.wikipedia", "Foo bar"),
+                                                      ("ßeta", "de.wikipedia", "ßeta"),
+                                                      ("word", "en.wiktionary", "word"),
+                                                      ("___", None, "")])
+def test_normalize_title(title, project, expected):
+    assert pagelist.normalize_title(title, project) == expected
+
+@pytest.fixture
+def sources(tmp_path):
+    input_db = write_db(tmp_path / "items.sqlite", [("de.wikipedia", "COVID-19-Pandemie"),
+                                                    ("de.wikipedia", "COVID-19_Pandemie"),
+                                                    ("de.wikipedia", None),
+                                                    ("en.wikipedia", "pandemic")])
+    wikiproject_file = tmp_path / "articles.txt"
+    wikiproject_file.write_text("Coronavirus disease 2019\nPandemic\n\nCoronavirus_disease_2019\nVaccine\n")
+    return (input_db, str(wikiproject_file))
+
+def test_page_list(sources):
+    page_list = pagelist.PageList(*sources)
+    assert page_list.projects() == ["de.wikipedia", "en.wikipedia"]
+    assert page_list.pages("de.wikipedia") == ["COVID-19-Pandemie", "COVID-19 Pandemie"]
+    # first seen order, with the database before the WikiProject file
+    assert page_list.pages("en.wikipedia") == ["Pandemic", "Coronavirus disease 2019", "Vaccine"]
+    assert len(page_list) == 5
+    assert ("en.wikipedia", "coronavirus_disease_2019") in page_list
+    assert ("de.wikipedia", "Vaccine") not in page_list
+    page_list.close()
+
+def test_cache_is_rebuilt_when_sources_change(sources, tmp_path):
+    input_db, wikiproject_file = sources
+    cache_path = str(tmp_path / "pagelist_cache.sqlite")
+    pagelist.PageList(input_db, wikiproject_file, cache_path=cache_path).close()
+
+    # the cache is used as long as the sources stay the same
+    db = sqlite3.connect(cache_path)
+    db.execute("DELETE FROM pages WHERE title = 'Vaccine';")
+    db.commit()
+    db.close()
+    page_list = pagelist.PageList(input_db, wikiproject_file, cache_path=cache_path)
+    assert "Vaccine" not in page_list.pages("en.wikipedia")
+    page_list.close()
+
+    with open(wikiproject_file, 'a') as outfile:
+        outfile.write("Quarantine\n")
+    stat = os.stat(wikiproject_file)
+    os.utime(wikiproject_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    page_list = pagelist.PageList(input_db, wikiproject_file, cache_path=cache_path)
+    assert page_list.pages("en.wikipedia") == ["Pandemic", "Coronavirus disease 2019", "Vaccine", "Quarantine"]
+    page_list.close()
@@ -0,0 +1,69 @@
+# tests of the consolidated pageview store, on small dailyviews files
+# written out by the tests
+import os
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'scripts'))
+import pageview_store
+
+def write_views(filename, date, views):
+    with open(filename, 'w') as outfile:
+        outfile.write("access\tagent\tarticle\tgranularity\tproject\ttimestamp\tviews\n")
+        for title, count in views.items():
+            outfile.write(f"all-access\tall-agents\t{title}\tdaily\ten.wikipedia\t{date}00\t{count}\n")
+    return str(filename)
+
+def column_rows(store_folder):
+    return path.getsize(path.join(store_folder, 'en.wikipedia', 'all-agents', 'ids.u32')) // 4
+
+def test_ingest_and_query(tmp_path):
+    store = pageview_store.PageviewStore(str(tmp_path / "store"))
+    store.ingest([write_views(tmp_path / "1.tsv", "20200401", {"Coronavirus_disease_2019" : 10, "Pandemic" : 3}),
+                  write_views(tmp_path / "2.tsv", "20200402", {"Coronavirus_disease_2019" : 12})])
+    assert store.page_views("en.wikipedia", "Coronavirus disease 2019", "20200401", "20200430") == [("20200401", 10), ("20200402", 12)]
+    assert store.page_views("en.wikipedia", "pandemic", "20200401", "20200402") == [("20200401", 3), ("20200402", 0)]
+    assert sorted(store.day_views("en.wikipedia", "20200401")) == [("Coronavirus disease 2019", 10), ("Pandemic", 3)]
+    assert store.day_views("en.wikipedia", "20200403") is None
+    store.close()
+
+def test_reingesting_is_compacted(tmp_path):
+    folder = str(tmp_path / "store")
+    views = {f"Page {n}" : n for n in range(100)}
+    store = pageview_store.PageviewStore(folder)
+    store.ingest([write_views(tmp_path / "1.tsv", "20200401", views),
+                  write_views(tmp_path / "2.tsv", "20200402", views)])
+    for count in range(10):
+        views["Page 1"] = count
+        store.ingest([write_views(tmp_path / "2.tsv", "20200402", views)])
+        assert column_rows(folder) <= 200 * 1.25
+        assert store.page_views("en.wikipedia", "Page 1", "20200401", "20200402") == [("20200401", 1), ("20200402", count)]
+    store.close()
+
+    # and the compacted store reads back the same
+    store = pageview_store.PageviewStore(folder)
+    assert store.page_views("en.wikipedia", "Page 1", "20200401", "20200402") == [("20200401", 1), ("20200402", 9)]
+    store.compact()
+    assert column_rows(folder) == 200
+    store.close()
+
+def test_interrupted_compaction(tmp_path):
+    folder = str(tmp_path / "store")
+    store = pageview_store.PageviewStore(folder, compact_ratio=10)
+    store.ingest([write_views(tmp_path / "1.tsv", "20200401", {"A" : 1})])
+    store.ingest([write_views(tmp_path / "1.tsv", "20200401", {"A" : 2})])
+    store.close()
+
+    # a compaction that didn't finish is thrown away
+    project_folder = path.join(folder, 'en.wikipedia', 'all-agents')
+    os.makedirs(path.join(project_folder, 'compacting'))
+    with open(path.join(project_folder, 'compacting', 'ids.u32'), 'wb') as outfile:
+        outfile.write(b'junk')
+    store = pageview_store.PageviewStore(folder)
+    assert store.page_views("en.wikipedia", "A", "20200401", "20200401") == [("20200401", 2)]
+    assert not path.exists(path.join(project_folder, 'compacting'))
+    assert column_rows(folder) == 2
+    store.compact()
+    assert column_rows(folder) == 1
+    assert store.page_views("en.wikipedia", "A", "20200401", "20200401") == [("20200401", 2)]
+    store.close()
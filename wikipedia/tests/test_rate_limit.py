@@ -0,0 +1,175 @@
+# tests of the rate limiter and retries the fetchers share
+import threading
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from digobs_common.rate_limit import TokenBucket, RetryBudget, RateLimiter, LimitedSession
+
+def make_response(status, headers={}):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers)
+    response._content = b'{}'
+    return response
+
+# a send() for RateLimiter.request that returns (or raises) each of
+# outcomes in turn
+def sends(outcomes):
+    outcomes = list(outcomes)
+    calls = []
+    def send():
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return make_response(outcome)
+    return (send, calls)
+
+def test_token_bucket_paces_requests():
+    bucket = TokenBucket(50, burst=1)
+    start = time.monotonic()
+    for i in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+
+def test_token_bucket_throttles_and_recovers():
+    bucket = TokenBucket(8, min_rate=1)
+    bucket.throttle()
+    assert bucket.rate == 4
+    for i in range(3):
+        bucket.throttle()
+    assert bucket.rate == 1
+    for i in range(100):
+        bucket.recover()
+    assert bucket.rate == 8
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, minimum=1)
+    assert budget.spend()
+    assert not budget.spend()
+    for i in range(4):
+        budget.record_request()
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+
+@pytest.mark.parametrize('error', [requests.ConnectionError("reset"),
+                                   requests.Timeout("slow"),
+                                   requests.exceptions.ChunkedEncodingError("truncated"),
+                                   requests.exceptions.ContentDecodingError("bad gzip")])
+def test_request_errors_are_retried(error):
+    limiter = RateLimiter(default_rate=1000, base_delay=0.001)
+    send, calls = sends([error, 503, 200])
+    assert limiter.request(send, 'GET', "https://example.org/").status_code == 200
+    assert len(calls) == 3
+
+def test_giving_up():
+    limiter = RateLimiter(default_rate=1000, max_tries=3, base_delay=0.001)
+    send, calls = sends([503, 503, 503, 200])
+    assert limiter.request(send, 'GET', "https://example.org/").status_code == 503
+    assert len(calls) == 3
+
+    error = requests.exceptions.ChunkedEncodingError("truncated")
+    send, calls = sends([error, error, error])
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        limiter.request(send, 'GET', "https://example.org/")
+    assert len(calls) == 3
+
+def test_retry_statuses():
+    limiter = RateLimiter(default_rate=1000, base_delay=0.001, retry_statuses={503})
+    send, calls = sends([500, 200])
+    assert limiter.request(send, 'GET', "https://example.org/").status_code == 500
+    assert len(calls) == 1
+
+    send, calls = sends([503, 200])
+    assert limiter.request(send, 'GET', "https://example.org/").status_code == 200
+    assert len(calls) == 2
+
+def test_bad_requests_are_not_retried():
+    limiter = RateLimiter(default_rate=1000, base_delay=0.001)
+    send, calls = sends([requests.exceptions.InvalidURL("no host"), 200])
+    with pytest.raises(requests.exceptions.InvalidURL):
+        limiter.request(send, 'GET', "https://example.org/")
+    assert len(calls) == 1
+
+def test_retry_after_is_capped():
+    limiter = RateLimiter(max_delay=30)
+    assert limiter.backoff(0, make_response(429, {'Retry-After' : '5'})) == 5
+    assert limiter.backoff(0, make_response(429, {'Retry-After' : '86400'})) == 30
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(hours=1), usegmt=True)
+    assert limiter.backoff(0, make_response(429, {'Retry-After' : later})) == 30
+    assert 0 <= limiter.backoff(20) <= 30
+
+def test_throttled_host_slows_down():
+    limiter = RateLimiter(default_rate=1000, base_delay=0.001, max_delay=0.01)
+    send, calls = sends([429, 200])
+    limiter.request(send, 'GET', "https://example.org/")
+    # halved by the 429, then recovering a little with the 200
+    assert limiter.bucket('example.org').rate == pytest.approx(500, rel=0.01)
+    assert limiter.bucket('example.net').rate == 1000
+
+def test_connection_limits():
+    limiter = RateLimiter(default_rate=1000)
+    limiter.set_connection_limits(max_connections=3, host_connections=2)
+    lock = threading.Lock()
+    running = {}
+    most = {}
+
+    def request(host):
+        def send():
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                most[host] = max(most.get(host, 0), running[host])
+                most['all'] = max(most.get('all', 0), sum(running.values()))
+            time.sleep(0.02)
+            with lock:
+                running[host] = running[host] - 1
+            return make_response(200)
+        limiter.request(send, 'GET', f"https://{host}/")
+
+    threads = [threading.Thread(target=request, args=(host,)) for host in ['a.org', 'b.org'] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most['a.org'] <= 2 and most['b.org'] <= 2 and most['all'] <= 3
+
+# the first response for each path is cut off part way through the body
+class TruncatingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    seen = set()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path not in self.seen:
+            self.seen.add(self.path)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body[:4])
+            self.close_connection = True
+        else:
+            self.end_headers()
+            self.wfile.write(body)
+
+def test_limited_session_retries_truncated_responses():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TruncatingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        limiter = RateLimiter(default_rate=1000, base_delay=0.001)
+        session = LimitedSession(limiter, timeout=5)
+        # straight to the server, not through a response cache
+        session.cache = None
+        response = session.get(f"http://127.0.0.1:{server.server_address[1]}/truncated")
+        assert response.json() == {'ok' : True}
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,98 @@
+# tests of pulling revision histories, against mock_wikimedia_server.py
+import logging
+
+import requests
+
+import digobs
+import mock_wikimedia_server
+
+rv_props = {'revid' : 'ids', 'timestamp' : 'timestamp'}
+
+def pulled(revisions):
+    return {title : [rev['revid'] for batch in batches
+                     for page in batch.get('query',dict()).get('pages',dict()).values()
+                     for rev in page.get('revisions',[])]
+            for title, batches in revisions}
+
+# a full history has nothing to skip, so it goes straight to prop=revisions
+def test_full_histories_skip_page_info(mock_server):
+    titles = ["Mock article 1", "Mock article 2", "Missing article"]
+    revisions = pulled(digobs.get_pages_revisions(titles, "en.wikipedia", logging, rv_props))
+
+    assert [len(revisions[title]) for title in titles] == [20, 20, 0]
+    assert mock_server.stats()['requests'] == {'api' : 3}
+
+# with a RevisionState, one prop=info query covers every title, and only
+# pages with new revisions get a history query
+def test_incremental_histories(mock_server, tmp_path):
+    state = digobs.RevisionState(str(tmp_path / "state.sqlite"))
+    history = pulled(digobs.get_pages_revisions(["Mock article 1"], "en.wikipedia", logging, rv_props))["Mock article 1"]
+    state.update("en.wikipedia", mock_wikimedia_server.page_id("Mock article 1"), "Mock article 1", history[9])
+    # already has the latest revision of Mock article 3
+    pageid = mock_wikimedia_server.page_id("Mock article 3")
+    state.update("en.wikipedia", pageid, "Mock article 3", pageid * mock_wikimedia_server.revid_stride + 19)
+
+    titles = ["Mock article 1", "Mock article 2", "Mock article 3", "Missing article"]
+    revisions = pulled(digobs.get_pages_revisions(titles, "en.wikipedia", logging, rv_props, state=state))
+    assert revisions["Mock article 1"] == history[10:]
+    assert len(revisions["Mock article 2"]) == 20
+    assert revisions["Mock article 3"] == []
+    assert revisions["Missing article"] == []
+    assert mock_server.stats()['requests'] == {'api' : 1 + 1 + 2}
+    state.close()
+
+all_rv_props = {'revid' : 'ids', 'timestamp' : 'timestamp', 'user' : 'user', 'userid' : 'userid',
+                'size' : 'size', 'sha1' : 'sha1', 'contentmodel' : 'contentmodel', 'tags' : 'tags',
+                'flags' : 'flags', 'comment' : 'comment', 'content' : 'content'}
+tsv_fields = ['title', 'pageid', 'namespace', 'revid', 'timestamp', 'user', 'userid', 'size',
+              'sha1', 'contentmodel', 'anon', 'minor', 'url', 'export_timestamp', 'export_commit']
+
+def test_required_rv_props():
+    assert digobs.required_rv_props(all_rv_props, tsv_fields, ['json']) == all_rv_props
+    assert digobs.required_rv_props(all_rv_props, tsv_fields, ['json', 'tsv']) == all_rv_props
+
+    # no content or comment, but flags for the minor field
+    tsv_props = digobs.required_rv_props(all_rv_props, tsv_fields, ['tsv'])
+    assert set(tsv_props.values()) == {'ids', 'timestamp', 'user', 'userid', 'size', 'sha1', 'contentmodel', 'flags'}
+
+    assert digobs.required_rv_props(all_rv_props, ['title', 'minor'], ['tsv']) == {'flags' : 'flags'}
+    assert digobs.required_rv_props(all_rv_props, ['anon', 'url'], ['tsv']) == {'revid' : 'ids', 'user' : 'user'}
+
+export_info = {'export_timestamp' : "20200402", 'export_commit' : "abc123"}
+
+def test_revision_rows():
+    rows = digobs.RevisionRows("en.wikipedia", tsv_fields, export_info)
+    page = {'pageid' : 7, 'ns' : 0, 'title' : "Pandemic"}
+    rev = {'revid' : 10, 'timestamp' : "2020-04-01T12:00:00Z", 'user' : "127.0.0.1", 'anon' : '', 'minor' : '',
+           'size' : 100, 'sha1' : "abc", 'tags' : ["mobile edit"], 'comment' : "left out",
+           'slots' : {'main' : {'contentmodel' : 'wikitext', '*' : "text"}}}
+    row = rows.row(rev, page)
+    assert list(row) == tsv_fields
+    assert row['title'] == "Pandemic" and row['pageid'] == 7 and row['namespace'] == 0
+    assert row['anon'] is True and row['minor'] is True
+    assert row['contentmodel'] == 'wikitext'
+    assert row['userid'] is None
+    assert (row['export_timestamp'], row['export_commit']) == ("20200402", "abc123")
+
+    hidden = rows.row({'revid' : 11, 'userhidden' : ''}, page)
+    assert (hidden['user'], hidden['userid'], hidden['sha1']) == ('', '', '')
+    assert hidden['anon'] is False and hidden['minor'] is False
+
+# URLs come from a template, but match what requests builds
+def test_revision_urls():
+    rows = digobs.RevisionRows("de.wikipedia", ['url'], export_info)
+    for title in ["Pandemic", "COVID-19 & Impfung", "Coronavirus/Übersicht", "Pandemic"]:
+        expected = requests.Request('GET', "https://de.wikipedia.org/w/index.php",
+                                    params={'title' : title.replace(" ", "_"), 'oldid' : 10}).prepare().url
+        assert rows.row({'revid' : 10}, {'title' : title})['url'] == expected
+
+def test_batch_rows(mock_server):
+    rows = digobs.RevisionRows("en.wikipedia", ['title', 'revid'], export_info)
+    revisions = digobs.get_pages_revisions(["Mock article 1", "Mock article 2"], "en.wikipedia", logging,
+                                           {'revid' : 'ids', 'contentmodel' : 'contentmodel'})
+    written = []
+    for title, batches in revisions:
+        for batch in batches:
+            written.extend(rows.batch_rows(batch))
+    assert [row['title'] for row in written] == ["Mock article 1"] * 20 + ["Mock article 2"] * 20
+    assert written[0]['revid'] == mock_wikimedia_server.page_id("Mock article 1") * mock_wikimedia_server.revid_stride
@@ -0,0 +1,82 @@
+# tests of SegmentOutput, the files the journaled fetchers write to
+import lzma
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import digobs
+
+def decompress(filename, compression):
+    command = {'xz' : ['xz', '-dc'], 'zstd' : ['zstd', '-dc']}[compression]
+    return subprocess.run(command + [filename], stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+
+def test_uncompressed_segments(tmp_path):
+    filename = str(tmp_path / "out.tsv")
+    with digobs.SegmentOutput(filename) as output:
+        assert output.tell() == 0
+        output.write("a\tb\n")
+        assert output.flush() == 4
+        output.write("c\td\n")
+        assert output.tell() == 8
+        assert output.flush() == 8
+        # never committed, so dropped
+        output.write("lost\n")
+    assert open(filename).read() == "a\tb\nc\td\n"
+
+    # a resumed run cuts the file back to what it had committed
+    with digobs.SegmentOutput(filename, size=4) as output:
+        assert output.tell() == 4
+        output.write("e\tf\n")
+        output.flush()
+    assert open(filename).read() == "a\tb\ne\tf\n"
+
+@pytest.mark.parametrize('compression', ['xz', 'zstd'])
+def test_compressed_segments(tmp_path, compression):
+    if shutil.which(compression) is None:
+        pytest.skip(f"{compression} not installed")
+
+    filename = str(tmp_path / "out.json")
+    with digobs.SegmentOutput(filename, compression=compression, threads=2) as output:
+        assert output.filename == filename + digobs.compressors[compression][1]
+        for segment in range(3):
+            for line in range(100):
+                output.write(f'{{"segment": {segment}, "line": {line}}}\n')
+            committed = output.flush()
+        # an empty segment adds nothing
+        assert output.flush() == committed
+        output.write('{"lost": true}\n')
+    expected = "".join(f'{{"segment": {segment}, "line": {line}}}\n' for segment in range(3) for line in range(100))
+    assert decompress(output.filename, compression) == expected
+
+    with digobs.SegmentOutput(filename, size=committed, compression=compression) as output:
+        output.write('{"resumed": true}\n')
+        output.flush()
+    assert decompress(output.filename, compression) == expected + '{"resumed": true}\n'
+
+def test_xz_without_the_binary(tmp_path, monkeypatch):
+    monkeypatch.setattr(digobs.shutil, 'which', lambda command: None)
+    filename = str(tmp_path / "out.json")
+    with digobs.SegmentOutput(filename, compression='xz') as output:
+        output.write("one\n")
+        output.flush()
+        output.write("two\n")
+        output.flush()
+        output.write("lost\n")
+    with lzma.open(output.filename, 'rt') as infile:
+        assert infile.read() == "one\ntwo\n"
+
+# a big segment goes to its file as it is written, rather than waiting in
+# memory for the commit
+def test_segments_stream_to_disk(tmp_path):
+    filename = str(tmp_path / "out.tsv")
+    line = "x" * 1023 + "\n"
+    with digobs.SegmentOutput(filename) as output:
+        for i in range(4096):
+            output.write(line)
+        assert output.tell() == 4 * 1024 * 1024
+        output.file.flush()
+        assert os.path.getsize(filename) == 4 * 1024 * 1024
+    # and is still dropped if it never gets committed
+    assert os.path.getsize(filename) == 0
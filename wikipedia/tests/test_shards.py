@@ -0,0 +1,121 @@
+# tests of splitting a crawl with --shard i/N and merging it back with
+# merge_shards.py, against mock_wikimedia_server.py
+import lzma
+import os
+import runpy
+import sqlite3
+import sys
+from os import path
+
+import pytest
+
+import digobs
+import merge_shards
+
+scripts = path.join(path.dirname(path.abspath(__file__)), '..', 'scripts')
+
+def test_shard_pages():
+    pages = [f"Page {n}" for n in range(100)]
+    shards = [digobs.shard_pages("en.wikipedia", pages, (index, 3)) for index in range(3)]
+    assert sorted(page for shard_pages, positions in shards for page in shard_pages) == sorted(pages)
+    for shard_pages, positions in shards:
+        assert shard_pages == sorted(shard_pages, key=pages.index)
+        assert all(pages[positions[page]] == page for page in shard_pages)
+    assert digobs.shard_pages("en.wikipedia", pages, None) == (pages, {page : n for n, page in enumerate(pages)})
+    assert digobs.shard_suffix((1, 3)) == ".shard1of3"
+
+def run_fetch_daily_views(tmp_path, monkeypatch, output_folder, *extra_args):
+    input_file = tmp_path / "articles.txt"
+    input_file.write_text("".join(f"Mock article {n}\n" for n in range(30)))
+    input_db = tmp_path / "items.sqlite"
+    if not input_db.exists():
+        db = sqlite3.connect(str(input_db))
+        db.execute("CREATE TABLE pagesPerProjectTable (project TEXT, page TEXT);")
+        db.executemany("INSERT INTO pagesPerProjectTable (project, page) VALUES (?, ?);",
+                       [("de.wikipedia", f"Mock article {n}") for n in range(20)])
+        db.commit()
+        db.close()
+    os.makedirs(output_folder)
+
+    monkeypatch.setattr(digobs.metrics, 'write_at_exit', lambda filename, job=None: None)
+    monkeypatch.setattr(sys, 'argv', ['fetch_daily_views.py',
+                                      '-o', str(output_folder),
+                                      '-i', str(input_file),
+                                      '-b', str(input_db),
+                                      '--pagelist_cache', str(tmp_path / "pagelist_cache.sqlite"),
+                                      '--title_cache', str(tmp_path / "title_cache.sqlite"),
+                                      '--journal', str(tmp_path / "journal.sqlite"),
+                                      '--http_cache', '',
+                                      '-d', '20200401',
+                                      '--segment_size', '4',
+                                      *extra_args])
+    runpy.run_path(path.join(scripts, 'fetch_daily_views.py'), run_name='__main__')
+
+def read(filename):
+    if filename.endswith('.xz'):
+        with lzma.open(filename, 'rb') as infile:
+            return infile.read()
+    with open(filename, 'rb') as infile:
+        return infile.read()
+
+def output_files(folder):
+    return sorted(path.relpath(path.join(root, filename), folder)
+                  for root, subfolders, filenames in os.walk(folder) for filename in filenames)
+
+# the merged shards are the files one unsharded run would have written
+@pytest.mark.parametrize('compression', [None, 'xz'])
+def test_merged_shards_match_a_single_run(mock_server, tmp_path, monkeypatch, compression):
+    extra_args = ['-z', compression] if compression else []
+    run_fetch_daily_views(tmp_path, monkeypatch, tmp_path / "single", *extra_args)
+    for index in range(3):
+        run_fetch_daily_views(tmp_path, monkeypatch, tmp_path / f"machine{index}", '--shard', f"{index}/3", *extra_args)
+
+    monkeypatch.setattr(sys, 'argv', ['merge_shards.py', *(str(tmp_path / f"machine{index}") for index in range(3)),
+                                      '-o', str(tmp_path / "merged")])
+    merge_shards.main()
+
+    expected = output_files(tmp_path / "single")
+    assert expected == output_files(tmp_path / "merged")
+    assert len(expected) == 4
+    for filename in expected:
+        assert read(str(tmp_path / "merged" / filename)) == read(str(tmp_path / "single" / filename))
+
+def test_missing_shards(mock_server, tmp_path, monkeypatch):
+    for index in range(2):
+        run_fetch_daily_views(tmp_path, monkeypatch, tmp_path / f"machine{index}", '--shard', f"{index}/3")
+
+    monkeypatch.setattr(sys, 'argv', ['merge_shards.py', str(tmp_path / "machine0"), str(tmp_path / "machine1"),
+                                      '-o', str(tmp_path / "merged")])
+    with pytest.raises(SystemExit):
+        merge_shards.main()
+
+    monkeypatch.setattr(sys, 'argv', sys.argv + ['--partial'])
+    merge_shards.main()
+    lines = read(str(tmp_path / "merged" / "en.wikipedia" / "20200401" / "digobs_covid19_en.wikipedia_dailyviews-20200401.tsv")).splitlines()
+    assert lines[0].startswith(b"access\t")
+    assert 1 < len(lines) < 31
+
+def test_index_must_match_the_shard(tmp_path):
+    shard = tmp_path / "views.shard0of1.tsv"
+    shard.write_text("header\na\nb\n")
+    (tmp_path / "views.shard0of1.tsv.index").write_text("0\t1\n")
+    entry = merge_shards.find_shard_files([str(tmp_path)])["views.tsv"]
+    with pytest.raises(ValueError, match="its index doesn't account for"):
+        merge_shards.merge_file("views.tsv", entry, str(tmp_path / "merged"))
+
+    (tmp_path / "views.shard0of1.tsv.index").write_text("1\t1\n0\t1\n")
+    with pytest.raises(ValueError, match="out of order"):
+        merge_shards.merge_file("views.tsv", entry, str(tmp_path / "merged"))
+
+def test_shards_that_disagree(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    (tmp_path / "a" / "views.shard0of2.tsv").write_text("")
+    (tmp_path / "b" / "views.shard1of3.tsv").write_text("")
+    with pytest.raises(ValueError, match="don't agree"):
+        merge_shards.find_shard_files([str(tmp_path / "a"), str(tmp_path / "b")])
+
+    (tmp_path / "b" / "views.shard1of3.tsv").unlink()
+    (tmp_path / "b" / "views.shard0of2.tsv").write_text("")
+    with pytest.raises(ValueError, match="is in both"):
+        merge_shards.find_shard_files([str(tmp_path / "a"), str(tmp_path / "b")])
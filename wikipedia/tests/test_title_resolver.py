@@ -0,0 +1,71 @@
+# tests of following normalization and redirects, and caching the results
+import logging
+from datetime import timedelta
+
+import digobs
+
+# stands in for an mwapi session, with one canned response per batch
+class FakeSession:
+    def __init__(self, query):
+        self.query = query
+        self.batches = []
+
+    def get(self, **params):
+        self.batches.append(params['titles'])
+        return [{'query' : self.query}]
+
+def test_redirect_chains():
+    session = FakeSession({'normalized' : [{'from' : "covid-19", 'to' : "Covid-19"}],
+                           'redirects' : [{'from' : "Covid-19", 'to' : "COVID-19"},
+                                          {'from' : "Loop a", 'to' : "Loop b"},
+                                          {'from' : "Loop b", 'to' : "Loop a"}],
+                           'pages' : {'1' : {'pageid' : 1, 'title' : "COVID-19"},
+                                      '2' : {'pageid' : 2, 'title' : "Loop a"},
+                                      '-1' : {'title' : "Gone", 'missing' : ''}}})
+    titles = ["covid-19", "COVID-19", "Loop a", "Gone"]
+    assert list(digobs.query_canonical_titles(titles, session, batch_size=3)) == \
+        [("covid-19", "COVID-19"), ("COVID-19", "COVID-19"), ("Loop a", "Loop a"), ("Gone", None)]
+    assert session.batches == [titles[:3], titles[3:]]
+
+def test_canonical_pages(mock_server):
+    resolver = digobs.TitleResolver()
+    titles = ["mock article 1", "Mock article 1", "Mock_article_2", "Missing article"]
+    assert resolver.canonical_pages("en.wikipedia", titles, logging) == ["Mock article 1", "Mock article 2"]
+    assert mock_server.stats()['requests'] == {'api' : 1}
+
+    # cached now, so no more queries
+    assert resolver.canonical_pages("en.wikipedia", titles, logging) == ["Mock article 1", "Mock article 2"]
+    assert mock_server.stats()['requests'] == {'api' : 1}
+
+    # but only for the project they were looked up on
+    assert resolver.canonical_pages("de.wikipedia", ["Mock article 3"], logging) == ["Mock article 3"]
+    assert mock_server.stats()['requests'] == {'api' : 2}
+    resolver.close()
+
+def test_cache_expires(mock_server, tmp_path):
+    db_path = str(tmp_path / "title_cache.sqlite")
+    resolver = digobs.TitleResolver(db_path)
+    resolver.canonical_pages("en.wikipedia", ["mock article 1"], logging)
+    resolver.close()
+
+    # the cache outlives the resolver
+    resolver = digobs.TitleResolver(db_path)
+    assert resolver.cached("en.wikipedia", ["mock article 1", "Mock article 2"]) == {"mock article 1" : "Mock article 1"}
+    resolver.close()
+
+    resolver = digobs.TitleResolver(db_path, ttl=timedelta(0))
+    assert resolver.cached("en.wikipedia", ["mock article 1"]) == {}
+    resolver.canonical_pages("en.wikipedia", ["mock article 1"], logging)
+    assert mock_server.stats()['requests'] == {'api' : 2}
+    resolver.close()
+
+# when the API can't be reached the titles are used as they are
+def test_unresolved_titles(mock_server):
+    mock_server.shutdown()
+    mock_server.server_close()
+    resolver = digobs.TitleResolver()
+    assert resolver.canonical_pages("en.wikipedia", ["Mock article 1", "mock article 1"], logging) == \
+        ["Mock article 1", "mock article 1"]
+    # and nothing is cached
+    assert resolver.cached("en.wikipedia", ["Mock article 1"]) == {}
+    resolver.close()